@@ -0,0 +1,707 @@
+# Benchmark of the question scripts on synthetic xAPI data, without AWS.
+# - The data is generated from the column profiles of xAPI-Edu-Data.csv (the categories of every column with their
+#   frequencies, the range of every numeric column), in chunks of generate_chunk_rows rows streamed to S3, so 1M, 10M or
+#   100M rows are generated with the memory of one chunk.
+# - S3 is a local moto server (moto[server]) started on a free port, or any S3 compatible endpoint given with
+#   --s3-endpoint-url. moto reads the whole object for every ranged GET, so MinIO is a better stand-in for 100M rows.
+#   The scripts create their own boto3 clients, they reach the stand-in through AWS_ENDPOINT_URL_S3.
+# - question 1: the filtered group by of the csv with the arrow and the select backends. moto does not evaluate the
+#   S3 Select SQL of the script, the select backend is skipped without --s3-endpoint-url.
+# - question 2: lambda_handler for the csv against a Postgres database (--postgres-dsn) behind
+#   PostgresRedshiftConnection, which runs the Redshift COPY of S3 objects as COPY FROM STDIN. Skipped without a dsn.
+# - question 3: lambda_handler backfilling hourly windows of a stub pm25 API serving api_items_per_window items each
+# - question 10: the transformation plan of the parquet with the local and the spark backends, from an empty watermark.
+#   The spark backend is skipped when pyspark and awsglue cannot be imported (see how_to_run_glue_locally.txt).
+# Every backend of a benchmark has its own bucket and result. A skipped one is saved with status 'skipped' and the
+# reason in error, so a results file always has every benchmark and backend asked for.
+# Every benchmark runs in its own process, so the peak RSS is its own, and records the wall time, the rows and MB per
+# second and the peak RSS. The results are saved as json, and --compare logs the benchmarks which are slower or use
+# more memory than in a previous results file by more than --threshold.
+#
+# usage: python benchmark.py --rows 1000000 10000000 --benchmarks question_1 question_10 --output benchmark_results.json
+#        python benchmark.py --rows 1000000 --postgres-dsn postgresql://postgres@localhost/postgres --compare baseline.json
+##################################################################################################################################################################
+
+import os
+import io
+import re
+import sys
+import json
+import math
+import time
+import zlib
+import random
+import socket
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import importlib.util
+import multiprocessing
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import boto3
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from s3_metadata import list_keys
+from s3_archive import delete_sources
+from s3_multipart import S3MultipartWriter
+from s3_partitions import read_manifest, get_manifest_key
+
+
+logging.basicConfig(level = logging.INFO)
+
+repo_path = os.path.dirname(os.path.abspath(__file__))
+sample_path = os.path.join(repo_path, 'xAPI-Edu-Data.csv')
+scripts = {
+    'question_1': 'question 1.py',
+    'question_2': 'question 2.py',
+    'question_3': 'question 3.py',
+    'question_10': 'question 10.py',
+}
+
+# Data: rows are generated in chunks of generate_chunk_rows, chunk i with the random generator seeded by (seed, i),
+# so a number of rows always gives the same data
+default_rows = [1000000]
+generate_chunk_rows = 1000000
+seed = 42
+csv_file_key = 'demo/ingestion/year=2023/month=09/day=15/xAPI-Edu-Data.csv'
+parquet_file_key = 'demo/ingestion/year=2023/month=09/day=15/xAPI-Edu-Data.parquet'
+
+# S3 stand-in and the fake credentials the scripts read from ~/.aws/credentials
+benchmark_region_name = 'us-east-1'
+benchmark_access_key = 'testing'
+moto_start_timeout_seconds = 30
+
+# Question 2: the table loaded in Postgres, and the slices the stand-in reports for the split of the files
+postgres_table = 'xapi_edu_data_benchmark'
+postgres_slices = 4
+
+# Question 3: every hourly window of the stub API returns api_items_per_window items, the rate limit of the script is
+# lifted to api_rate_per_second so the benchmark measures the pipeline and not the limit of the real API
+api_items_per_window = 1000
+api_start_date_time = datetime(2023, 9, 1)
+api_rate_per_second = 100000
+pm25_regions = ['west', 'east', 'central', 'south', 'north']
+
+# a benchmark is a regression when its wall time or peak RSS grew by more than regression_threshold
+regression_threshold = 0.1
+
+
+def get_bucket_name(benchmark, rows, backend=None):
+    suffix = f'-{backend}' if backend else ''
+    return f"benchmark-{benchmark.replace('_', '-')}-{rows}{suffix}"
+
+# {column: ('integer', min, max) or ('category', values, frequencies)} of the sample
+def get_column_profiles(path):
+    sample = pd.read_csv(path)
+    profiles = {}
+    for name in sample.columns:
+        column = sample[name]
+        if pd.api.types.is_integer_dtype(column):
+            profiles[name] = ('integer', int(column.min()), int(column.max()))
+        else:
+            frequencies = column.astype(str).value_counts(normalize=True, sort=False)
+            profiles[name] = ('category', pa.array(frequencies.index.tolist()), frequencies.to_numpy())
+    return profiles
+
+def generate_xapi_chunk(profiles, rows, rng):
+    columns = {}
+    for name, profile in profiles.items():
+        if profile[0] == 'integer':
+            columns[name] = pa.array(rng.integers(profile[1], profile[2], size=rows, endpoint=True))
+        else:
+            values, frequencies = profile[1], profile[2]
+            columns[name] = values.take(pa.array(rng.choice(len(values), size=rows, p=frequencies / frequencies.sum())))
+    return pa.table(columns)
+
+# targets is [(bucket, key, 'csv' or 'parquet')], every chunk is written to all of them so the csv of question 1 and
+# question 2 is only generated once. Returns {(bucket, key): bytes written}.
+def generate_xapi(s3_client, profiles, rows, targets, chunk_rows):
+    sinks = []
+    writers = []
+    try:
+        for index, start in enumerate(range(0, rows, chunk_rows)):
+            chunk = generate_xapi_chunk(profiles, min(chunk_rows, rows - start), np.random.default_rng([seed, index]))
+            if not writers:
+                for bucket_name, file_key, file_format in targets:
+                    sink = S3MultipartWriter(s3_client, bucket_name, file_key)
+                    sinks.append(sink)
+                    writers.append(pa_csv.CSVWriter(sink, chunk.schema) if file_format == 'csv'
+                                   else pq.ParquetWriter(sink, chunk.schema))
+            for writer in writers:
+                writer.write_table(chunk)
+        for writer in writers:
+            writer.close()
+        return {(sink.bucket_name, sink.file_key): sink.close() for sink in sinks}
+    except Exception:
+        for sink in sinks:
+            sink.abort()
+        raise
+
+def delete_bucket(s3_client, bucket_name):
+    delete_sources(s3_client, bucket_name, list(list_keys(s3_client, bucket_name, '')))
+    s3_client.delete_bucket(Bucket=bucket_name)
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, is_running, timeout_seconds):
+    deadline = time.monotonic() + timeout_seconds
+    while time.monotonic() < deadline:
+        if not is_running():
+            raise RuntimeError(f'the server of port {port} stopped before it was ready')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'the server of port {port} is not ready after {timeout_seconds} seconds')
+
+def start_moto_server():
+    port = get_free_port()
+    process = subprocess.Popen([sys.executable, '-m', 'moto.server', '-H', '127.0.0.1', '-p', str(port)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port, lambda: process.poll() is None, moto_start_timeout_seconds)
+    logging.info(f'moto server started on port {port}')
+    return process, f'http://127.0.0.1:{port}'
+
+# a home with the fake credentials, as the scripts read ~/.aws/credentials
+def make_benchmark_home():
+    home = tempfile.mkdtemp(prefix='benchmark-home-')
+    os.makedirs(os.path.join(home, '.aws'))
+    with open(os.path.join(home, '.aws', 'credentials'), 'w') as f:
+        f.write(f'[default]\naws_access_key_id = {benchmark_access_key}\naws_secret_access_key = {benchmark_access_key}\n')
+    return home
+
+
+# Stub of the pm25 API: the items of a window are spread over its hour, with readings seeded by the window so every
+# run gets the same items
+def get_stub_pm25_body(date_time, item_count):
+    rng = random.Random(date_time.isoformat())
+    hour = date_time.replace(minute=0, second=0, microsecond=0)
+    items = []
+    for index in range(item_count):
+        timestamp = (hour + timedelta(seconds=index * 3600 // item_count)).isoformat() + '+08:00'
+        items.append({'timestamp': timestamp, 'update_timestamp': timestamp,
+                      'readings': {'pm25_one_hourly': {region: rng.randint(0, 80) for region in pm25_regions}}})
+    return json.dumps({'region_metadata': [], 'items': items, 'api_info': {'status': 'healthy'}}).encode('utf-8')
+
+class StubPm25Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    item_count = api_items_per_window
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        body = get_stub_pm25_body(datetime.fromisoformat(query['date_time'][0]), self.item_count)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_stub_api(port, item_count):
+    StubPm25Handler.item_count = item_count
+    ThreadingHTTPServer(('127.0.0.1', port), StubPm25Handler).serve_forever()
+
+def start_stub_api(context, item_count):
+    port = get_free_port()
+    process = context.Process(target=serve_stub_api, args=(port, item_count), daemon=True)
+    process.start()
+    wait_for_port(port, process.is_alive, moto_start_timeout_seconds)
+    logging.info(f'stub pm25 API started on port {port}')
+    return process, f'http://127.0.0.1:{port}/v1/environment/pm25'
+
+
+# Postgres stand-in for Redshift: a DB-API connection over psycopg2 for the statements of question 2. The COPY of S3
+# objects (one object, or the entries of a MANIFEST, GZIP or ZSTD compressed) is run as a COPY FROM STDIN of every
+# object read from S3, and stv_slices, pg_last_copy_id()/pg_last_copy_count() and stl_load_commits are answered from
+# the COPY of the session. Any other statement is run by Postgres, with GETDATE() as now().
+copy_pattern = re.compile(r"^COPY\s+(\S+)\s+FROM\s+'s3://([^/']+)/([^']+)'", re.IGNORECASE)
+ignore_header_pattern = re.compile(r'\bIGNOREHEADER\s+(\d+)', re.IGNORECASE)
+load_commits_pattern = re.compile(r'\bWHERE\s+query\s*=\s*(\d+)', re.IGNORECASE)
+
+def get_decompressor(compression):
+    if compression == 'GZIP':
+        return zlib.decompressobj(31)
+    if compression == 'ZSTD':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+# file object over the decompressed lines of an S3 object for COPY FROM STDIN, which skips the header lines and counts
+# the lines scanned (header included, like stl_load_commits)
+class S3CopyStream(io.RawIOBase):
+    def __init__(self, body, compression, header_lines, chunk_size=1024 * 1024):
+        self.chunks = body.iter_chunks(chunk_size)
+        self.decompressor = get_decompressor(compression)
+        self.header_lines = header_lines
+        self.buffer = bytearray()
+        self.lines = 0
+        self.last_byte = b'\n'
+        self.done = False
+
+    def readable(self):
+        return True
+
+    def fill(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.done = True
+            data = self.decompressor.flush() if self.decompressor else b''
+        else:
+            data = self.decompressor.decompress(chunk) if self.decompressor else chunk
+        if data:
+            self.lines += data.count(b'\n')
+            self.last_byte = data[-1:]
+            self.buffer += data
+
+    def read(self, size=-1):
+        while not self.done and (self.header_lines or size is None or size < 0 or len(self.buffer) < size):
+            self.fill()
+            while self.header_lines and b'\n' in self.buffer:
+                del self.buffer[:self.buffer.index(b'\n') + 1]
+                self.header_lines -= 1
+        size = len(self.buffer) if size is None or size < 0 else size
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    # a last line without a line end is scanned as well
+    def lines_scanned(self):
+        return self.lines + (self.last_byte != b'\n')
+
+class PostgresRedshiftConnection:
+    def __init__(self, dsn, s3_client, slices):
+        import psycopg2
+        self.conn = psycopg2.connect(dsn)
+        self.s3_client = s3_client
+        self.slices = slices
+        self.last_copy_id = 0
+        self.last_copy_count = 0
+        # {copy id: {s3 url: lines scanned}}
+        self.load_commits = {}
+
+    def cursor(self):
+        return PostgresRedshiftCursor(self)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+    # the s3 urls of a COPY, the entries of the manifest when the COPY loads a manifest
+    def get_copy_urls(self, bucket_name, file_key, manifest):
+        if not manifest:
+            return [f's3://{bucket_name}/{file_key}']
+        entries = json.loads(self.s3_client.get_object(Bucket=bucket_name, Key=file_key)['Body'].read())['entries']
+        return [entry['url'] for entry in entries]
+
+    def copy_from_s3(self, cursor, statement):
+        table, bucket_name, file_key = copy_pattern.match(statement).groups()
+        words = set(statement.upper().split())
+        compression = 'GZIP' if 'GZIP' in words else 'ZSTD' if 'ZSTD' in words else None
+        header = ignore_header_pattern.search(statement)
+        copy_id = self.last_copy_id + 1
+        rows = 0
+        file_lines = {}
+        for url in self.get_copy_urls(bucket_name, file_key, 'MANIFEST' in words):
+            url_bucket, url_key = url[len('s3://'):].split('/', 1)
+            body = self.s3_client.get_object(Bucket=url_bucket, Key=url_key)['Body']
+            stream = S3CopyStream(body, compression, int(header.group(1)) if header else 0)
+            try:
+                cursor.copy_expert(f"COPY {table} FROM STDIN WITH (FORMAT csv, DELIMITER ',')", stream)
+            finally:
+                body.close()
+            rows += cursor.rowcount
+            file_lines[url] = stream.lines_scanned()
+        self.last_copy_id, self.last_copy_count = copy_id, rows
+        self.load_commits[copy_id] = file_lines
+
+class PostgresRedshiftCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.conn.cursor()
+        # rows answered by the stand-in instead of Postgres
+        self.rows = None
+
+    def execute(self, query, params=None):
+        self.rows = None
+        statement = ' '.join(query.split())
+        upper = statement.upper()
+        if copy_pattern.match(statement):
+            self.connection.copy_from_s3(self.cursor, statement)
+        elif 'PG_LAST_COPY_ID()' in upper:
+            self.rows = [(self.connection.last_copy_id, self.connection.last_copy_count)]
+        elif 'FROM STV_SLICES' in upper:
+            self.rows = [(self.connection.slices,)]
+        elif 'FROM STL_LOAD_COMMITS' in upper:
+            copy_id = int(load_commits_pattern.search(statement).group(1))
+            self.rows = sorted(self.connection.load_commits.get(copy_id, {}).items())
+        else:
+            self.cursor.execute(re.sub(r'\bGETDATE\(\)', 'now()', query, flags=re.IGNORECASE), params)
+
+    def executemany(self, query, rows):
+        self.cursor.executemany(query, rows)
+
+    def fetchone(self):
+        if self.rows is not None:
+            return self.rows.pop(0) if self.rows else None
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        if self.rows is not None:
+            rows, self.rows = self.rows, []
+            return rows
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+
+# peak RSS of this process in bytes. On linux ru_maxrss keeps the peak of the parent the process was forked from,
+# VmHWM only has the peak of the process itself. ru_maxrss is in bytes on macOS.
+def get_peak_rss_bytes():
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def measure(run, rows, input_bytes):
+    setup_rss_bytes = get_peak_rss_bytes()
+    start = time.perf_counter()
+    details = run() or {}
+    wall_seconds = time.perf_counter() - start
+    return {
+        'wall_seconds': round(wall_seconds, 3),
+        'rows_per_second': round(rows / wall_seconds),
+        'mb_per_second': round(input_bytes / wall_seconds / 1024 / 1024, 2) if input_bytes else None,
+        'input_bytes': input_bytes,
+        'peak_rss_bytes': get_peak_rss_bytes(),
+        'setup_rss_bytes': setup_rss_bytes,
+        'details': details,
+    }
+
+def load_script(benchmark, log_level):
+    if repo_path not in sys.path:
+        sys.path.insert(0, repo_path)
+    spec = importlib.util.spec_from_file_location(benchmark, os.path.join(repo_path, scripts[benchmark]))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # the scripts log at INFO on import, every window or file would be logged in the timing
+    logging.getLogger().setLevel(log_level)
+    return module
+
+def get_s3_event(bucket_name, file_key):
+    return {'Records': [{'s3': {'bucket': {'name': bucket_name}, 'object': {'key': file_key}}}]}
+
+def get_object_size(s3_client, bucket_name, file_key):
+    return s3_client.head_object(Bucket=bucket_name, Key=file_key)['ContentLength']
+
+def benchmark_question_1(rows, backend, options):
+    q1 = load_script('question_1', options['log_level'])
+    bucket_name = get_bucket_name('question_1', rows, backend)
+    s3_client = boto3.client('s3')
+
+    def run():
+        if backend == 'arrow':
+            aggregator = q1.GroupByAggregator(q1.source_columns, q1.group_by_columns, q1.metric_columns,
+                                              q1.filter_spec)
+            result = q1.arrow_aggregate(s3_client, bucket_name, csv_file_key, aggregator, q1.get_range_size,
+                                        q1.arrow_block_size)
+        else:
+            query = q1.SelectQuery(list(dict.fromkeys(q1.group_by_columns + q1.metric_columns)), q1.filter_spec)
+            aggregator = q1.GroupByAggregator(query.columns, q1.group_by_columns, q1.metric_columns)
+            result = q1.parallel_select_aggregate(s3_client, bucket_name, csv_file_key, query, aggregator,
+                                                  q1.scan_range_size, q1.max_workers)
+        # S3 Select does not report the rows it scanned, only its bytes
+        if result.rows_scanned is not None and result.rows_scanned != rows:
+            raise RuntimeError(f'{result.rows_scanned} rows scanned, {rows} expected')
+        return {'rows_matched': result.rows_matched, 'groups': len(result.groups),
+                'get_requests': result.stats.get('GetRequests'), 'bytes_scanned': result.stats.get('BytesScanned'),
+                'bytes_returned': result.stats.get('BytesReturned')}
+
+    return measure(run, rows, get_object_size(s3_client, bucket_name, csv_file_key))
+
+def benchmark_question_2(rows, backend, options):
+    q2 = load_script('question_2', options['log_level'])
+    bucket_name = get_bucket_name('question_2', rows, backend)
+    s3_client = boto3.client('s3')
+    input_bytes = get_object_size(s3_client, bucket_name, csv_file_key)
+
+    # the table has the columns of the csv, recreated empty for every run
+    connection = PostgresRedshiftConnection(options['postgres_dsn'], s3_client, postgres_slices)
+    cur = connection.cursor()
+    columns = ',\n'.join(f'"{name}" INTEGER' if profile[0] == 'integer' else f'"{name}" VARCHAR(64)'
+                         for name, profile in get_column_profiles(sample_path).items())
+    cur.execute(f'DROP TABLE IF EXISTS {postgres_table};')
+    cur.execute(f'CREATE TABLE {postgres_table} (\n{columns}\n);')
+    connection.commit()
+
+    q2.table = postgres_table
+    q2.redshift_connection = q2.RedshiftConnectionManager(
+        lambda: PostgresRedshiftConnection(options['postgres_dsn'], s3_client, postgres_slices),
+        q2.connection_idle_check_seconds, q2.connection_max_age_seconds)
+    result = measure(lambda: q2.lambda_handler(get_s3_event(bucket_name, csv_file_key), 'context'), rows, input_bytes)
+    q2.redshift_connection.close()
+
+    # lambda_handler logs its errors instead of raising them, the load is checked from the table
+    cur.execute(f'SELECT COUNT(*) FROM {postgres_table};')
+    rows_loaded = cur.fetchone()[0]
+    connection.close()
+    if rows_loaded != rows:
+        raise RuntimeError(f'{rows_loaded} rows loaded, {rows} expected')
+    result['details'] = {'rows_loaded': rows_loaded, 'slices': postgres_slices,
+                         'split_compression': q2.split_compression if q2.split_mode else None}
+    return result
+
+def benchmark_question_3(rows, backend, options):
+    q3 = load_script('question_3', options['log_level'])
+    bucket_name = get_bucket_name('question_3', rows, backend)
+    s3_client = boto3.client('s3')
+    windows = math.ceil(rows / options['api_items_per_window'])
+    rows = windows * options['api_items_per_window']
+    event = get_s3_event(bucket_name, '')
+    event['start_date_time'] = api_start_date_time.isoformat()
+    event['end_date_time'] = (api_start_date_time + timedelta(hours=windows - 1)).isoformat()
+
+    q3.URL = options['api_url']
+    q3.api_rate_per_second = q3.api_burst = api_rate_per_second
+    result = measure(lambda: q3.lambda_handler(event, 'context'), rows, None)
+
+    # lambda_handler logs its errors instead of raising them, the rows written are checked from the manifest
+    manifest = read_manifest(s3_client, bucket_name, get_manifest_key(q3.key_prefix))
+    rows_written = sum(entry['rows'] for entry in manifest['partitions'].values())
+    if rows_written != rows:
+        raise RuntimeError(f'{rows_written} rows written, {rows} expected')
+    result['details'] = {'windows': windows, 'partitions': len(manifest['partitions']),
+                         'items_per_window': options['api_items_per_window']}
+    return result
+
+def benchmark_question_10(rows, backend, options):
+    q10 = load_script('question_10', options['log_level'])
+    bucket_name = get_bucket_name('question_10', rows, backend)
+    s3_client = boto3.client('s3')
+    q10.bucket_name = bucket_name
+    run_backend = q10.run_local if backend == 'local' else q10.run_spark
+
+    def run():
+        watermark = q10.read_watermark(s3_client)
+        input_files = q10.get_input_files(s3_client, watermark)
+        if not run_backend(s3_client, input_files):
+            raise RuntimeError(f'the {backend} backend failed, see the log of question 10')
+        q10.commit_watermark(s3_client, watermark, input_files)
+        return {'input_files': len(input_files),
+                'output_files': len([key for key in list_keys(s3_client, bucket_name, q10.destination_prefix_key)
+                                     if key.endswith('.parquet')])}
+
+    return measure(run, rows, get_object_size(s3_client, bucket_name, parquet_file_key))
+
+benchmarks = {
+    'question_1': benchmark_question_1,
+    'question_2': benchmark_question_2,
+    'question_3': benchmark_question_3,
+    'question_10': benchmark_question_10,
+}
+
+# the backends of each script, None for the scripts with one way to run
+benchmark_backends = {
+    'question_1': ['arrow', 'select'],
+    'question_2': [None],
+    'question_3': [None],
+    'question_10': ['local', 'spark'],
+}
+
+# the data each benchmark reads from its bucket
+benchmark_data = {
+    'question_1': [(csv_file_key, 'csv')],
+    'question_2': [(csv_file_key, 'csv')],
+    'question_3': [],
+    'question_10': [(parquet_file_key, 'parquet')],
+}
+
+def get_label(benchmark, backend):
+    return f'{benchmark} {backend}' if backend else benchmark
+
+# the reason a backend cannot run in this environment, None when it can
+def get_skip_reason(benchmark, backend, args):
+    if benchmark == 'question_2' and not args.postgres_dsn:
+        return 'no Postgres database, give --postgres-dsn or BENCHMARK_POSTGRES_DSN'
+    if benchmark == 'question_1' and backend == 'select' and not args.s3_endpoint_url:
+        return 'the moto stand-in does not evaluate the S3 Select SQL, give --s3-endpoint-url of an endpoint with S3 Select'
+    if benchmark == 'question_10' and backend == 'spark':
+        missing = [name for name in ('pyspark', 'awsglue') if importlib.util.find_spec(name) is None]
+        if missing:
+            return f"{' and '.join(missing)} not installed, the spark backend runs with aws-glue-libs"
+    return None
+
+def run_benchmark_process(benchmark, rows, backend, options, queue):
+    os.environ.update(options['environment'])
+    try:
+        result = benchmarks[benchmark](rows, backend, options)
+        result['status'] = 'ok'
+    except Exception as e:
+        logging.exception(f'{get_label(benchmark, backend)} failed for {rows} rows')
+        result = {'status': 'failed', 'error': repr(e)}
+    queue.put(result)
+
+# runs the benchmark in a new process, a process killed (e.g. out of memory) is recorded as failed
+def run_benchmark(context, benchmark, rows, backend, options):
+    queue = context.Queue()
+    process = context.Process(target=run_benchmark_process, args=(benchmark, rows, backend, options, queue))
+    process.start()
+    result = None
+    while result is None and (process.is_alive() or not queue.empty()):
+        try:
+            result = queue.get(timeout=1)
+        except Exception:
+            pass
+    process.join()
+    if result is None:
+        result = {'status': 'failed', 'error': f'the benchmark process exited with code {process.exitcode}'}
+    return {'benchmark': benchmark, 'backend': backend, 'rows': rows, **result}
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_path, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# [(benchmark, backend, rows, metric, previous, current)] of the metrics which grew by more than threshold since the
+# baseline. Results saved before the backends were recorded have the default backend of their benchmark.
+def compare_results(results, baseline, threshold):
+    previous_results = {(result['benchmark'], result.get('backend', benchmark_backends[result['benchmark']][0]),
+                         result['rows']): result for result in baseline['results'] if result['status'] == 'ok'}
+    regressions = []
+    for result in results:
+        key = (result['benchmark'], result['backend'], result['rows'])
+        previous = previous_results.get(key)
+        if result['status'] != 'ok' or previous is None:
+            continue
+        for metric in ('wall_seconds', 'peak_rss_bytes'):
+            change = result[metric] / previous[metric] - 1
+            logging.info(f"{get_label(result['benchmark'], result['backend'])} {result['rows']} rows {metric}: "
+                         f"{previous[metric]} -> {result[metric]} ({change:+.1%})")
+            if change > threshold:
+                regressions.append((*key, metric, previous[metric], result[metric]))
+    return regressions
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the question scripts on synthetic xAPI data')
+    parser.add_argument('--rows', type=int, nargs='+', default=default_rows,
+                        help='numbers of rows to generate, e.g. 1000000 10000000 100000000')
+    parser.add_argument('--benchmarks', nargs='+', choices=list(benchmarks), default=list(benchmarks))
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='a previous results json to compare with')
+    parser.add_argument('--threshold', type=float, default=regression_threshold)
+    parser.add_argument('--s3-endpoint-url', help='an S3 compatible endpoint instead of a local moto server')
+    parser.add_argument('--postgres-dsn', default=os.environ.get('BENCHMARK_POSTGRES_DSN'),
+                        help='Postgres database of the question 2 benchmark (default $BENCHMARK_POSTGRES_DSN)')
+    parser.add_argument('--api-items-per-window', type=int, default=api_items_per_window)
+    parser.add_argument('--log-level', default='WARNING', help='log level of the scripts during the benchmarks')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    context = multiprocessing.get_context('spawn')
+    moto_process = stub_api_process = None
+    started_date_time = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+
+    # 0. start the S3 stand-in (and the stub API for question 3), the scripts reach S3 through AWS_ENDPOINT_URL_S3
+    if args.s3_endpoint_url:
+        endpoint_url = args.s3_endpoint_url
+    else:
+        moto_process, endpoint_url = start_moto_server()
+    environment = {
+        'AWS_ENDPOINT_URL_S3': endpoint_url,
+        'AWS_ACCESS_KEY_ID': benchmark_access_key,
+        'AWS_SECRET_ACCESS_KEY': benchmark_access_key,
+        'AWS_DEFAULT_REGION': benchmark_region_name,
+        'HOME': make_benchmark_home(),
+    }
+    os.environ.update(environment)
+    options = {'environment': environment, 'postgres_dsn': args.postgres_dsn, 'log_level': args.log_level.upper(),
+               'api_items_per_window': args.api_items_per_window, 'api_url': None}
+
+    results = []
+    try:
+        if 'question_3' in args.benchmarks:
+            stub_api_process, options['api_url'] = start_stub_api(context, args.api_items_per_window)
+        s3_client = boto3.client('s3')
+        profiles = get_column_profiles(sample_path)
+
+        runs = [(benchmark, backend, get_skip_reason(benchmark, backend, args)) for benchmark in args.benchmarks
+                for backend in benchmark_backends[benchmark]]
+        for rows in args.rows:
+            # 1. generate the data of every backend which runs in its own bucket, the csv is generated once for all
+            # its buckets
+            bucket_names = {(benchmark, backend): get_bucket_name(benchmark, rows, backend)
+                            for benchmark, backend, skip_reason in runs if skip_reason is None}
+            for bucket_name in bucket_names.values():
+                s3_client.create_bucket(Bucket=bucket_name)
+            targets = [(bucket_name, file_key, file_format) for (benchmark, backend), bucket_name in bucket_names.items()
+                       for file_key, file_format in benchmark_data[benchmark]]
+            start = time.perf_counter()
+            sizes = generate_xapi(s3_client, profiles, rows, targets, generate_chunk_rows) if targets else {}
+            logging.info(f'{rows} rows generated in {time.perf_counter() - start:.1f} seconds: {sizes}')
+
+            # 2. run every backend in its own process, the skipped ones are saved with their reason
+            for benchmark, backend, skip_reason in runs:
+                if skip_reason is not None:
+                    result = {'benchmark': benchmark, 'backend': backend, 'rows': rows, 'status': 'skipped',
+                              'error': skip_reason}
+                    logging.warning(f'{get_label(benchmark, backend)} skipped for {rows} rows: {skip_reason}')
+                else:
+                    result = run_benchmark(context, benchmark, rows, backend, options)
+                    logging.info(result)
+                results.append(result)
+
+            # 3. drop the data of this number of rows before the next one
+            for bucket_name in bucket_names.values():
+                delete_bucket(s3_client, bucket_name)
+    finally:
+        for process in (moto_process, stub_api_process):
+            if process is not None:
+                process.terminate()
+
+    # 4. save the results, and compare them with a previous run
+    run = {
+        'started_date_time': started_date_time,
+        'git_commit': get_git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        's3_endpoint_url': args.s3_endpoint_url or 'moto',
+        'seed': seed,
+    }
+    with open(args.output, 'w') as f:
+        json.dump({'run': run, 'results': results}, f, indent=2)
+    logging.info(f'{len(results)} results saved to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(results, json.load(f), args.threshold)
+        for benchmark, backend, rows, metric, previous, current in regressions:
+            logging.error(f'regression of {get_label(benchmark, backend)} for {rows} rows: {metric} {previous} -> {current}')
+        if regressions:
+            sys.exit(1)
@@ -4,9 +4,23 @@
 ##################################################################################################################################################################
 
 import os
+import io
+import math
+import base64
+import random
+import hashlib
+import csv
+import codecs
 import logging
+import operator
 import boto3
+import dataclasses
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.compute as pc
+from concurrent.futures import ThreadPoolExecutor
 import configparser
+from s3_metadata import bucket_exist, file_exist
 
 
 # Set up AWS credentials (ensure AWS CLI or environment variables are configured)
@@ -26,8 +40,40 @@ aws_credentials_path = '~/.aws/credentials'
 bucket_name = ''
 file_key = r'demo/ingestion/year=2023/month=09/day=15/xAPI-Edu-Data.csv'
 
-# example query, modify to fit to the testing
-SQL_query = 'SELECT * FROM s3object limit 100'
+# columns of the source file
+source_columns = ['gender', 'NationalITy', 'PlaceofBirth', 'StageID', 'GradeID', 'SectionID', 'Topic', 'Semester',
+                  'Relation', 'raisedhands', 'VisITedResources', 'AnnouncementsView', 'Discussion',
+                  'ParentAnsweringSurvey', 'ParentschoolSatisfaction', 'StudentAbsenceDays', 'Class']
+
+# example aggregation, modify to fit to the testing
+# filter_spec is a list of (column, operator, value) which are AND together
+# only the group by and metric columns are selected and the filter is pushed down to S3 Select as the WHERE clause
+group_by_columns = ['Topic', 'Class']
+metric_columns = ['raisedhands', 'VisITedResources']
+filter_spec = [('Semester', '=', 'F')]
+
+# aggregation = 'exact' for the group by metrics above, aggregation = 'sketch' for approximate distinct counts and
+# quantiles in fixed memory per group, e.g. distinct NationalITy per Topic and p50/p95 of raisedhands
+aggregation = 'exact'
+sketch_group_by_columns = ['Topic']
+distinct_columns = ['NationalITy']
+quantile_columns = ['raisedhands']
+quantiles = [0.5, 0.95]
+
+# input_format is 'CSV' or 'Parquet', compression_type is 'NONE', 'GZIP' or 'BZIP2' (CSV only)
+input_format = 'CSV'
+compression_type = 'NONE'
+
+# split the object into byte ranges (ScanRange) which are scanned at the same time, set max_workers to 1 for a serial scan
+# S3 Select processes every record that starts inside a range, so rows are never counted twice across ranges
+scan_range_size = 64 * 1024 * 1024
+max_workers = 8
+
+# backend = 'select' uses S3 Select, backend = 'arrow' streams the object with ranged get_object into the pyarrow csv
+# reader and aggregates the record batches with arrow compute, for regions or buckets without S3 Select
+backend = 'select'
+get_range_size = 16 * 1024 * 1024
+arrow_block_size = 4 * 1024 * 1024
 
 logging.basicConfig(level = logging.INFO)
 
@@ -43,21 +89,6 @@ def get_aws_credentials(aws_credentials_path):
         logging.error(f'{config_path[0]} is not a aws config file')
     
 
-def bucket_exist(s3,bucket_name):
-    buckets = s3.list_buckets()['Buckets']
-    for bucket in buckets:
-        if bucket['Name'] == bucket_name:
-            logging.info(f'This bucket {bucket_name} is found')
-        else:
-            logging.error(f'This bucket {bucket_name} is not found...')
-
-def file_exist(s3, bucket_name, file_key):
-    keys = s3.list_objects_v2(Bucket=bucket_name)['Contents']
-    for key in keys:
-        if key['Key'] == file_key:
-            logging.info(f'{file_key} is found in {bucket_name}')
-    file_format_csv(file_key)
-
 def file_format_csv(file_key):
     file_extension = file_key.split('.')[-1]
     if file_extension == 'csv':
@@ -65,6 +96,630 @@ def file_format_csv(file_key):
     else:
         logging.error(f'{file_key} is not csv file')
 
+# The Records events of select_object_content are cut at arbitrary byte positions, so a row (or a utf-8 character)
+# can be split across two events. The incremental decoder keeps the partial character and the remainder keeps the
+# partial line until the next event completes it.
+def iter_payload_lines(payload, stats):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    remainder = ''
+    for event in payload:
+        if 'Records' in event:
+            lines = (remainder + decoder.decode(event['Records']['Payload'])).split('\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        elif 'Stats' in event:
+            stats.update(event['Stats']['Details'])
+    remainder += decoder.decode(b'', final=True)
+    if remainder:
+        yield remainder
+
+# csv.reader pulls more lines itself when a quoted field contains a newline
+def iter_payload_rows(payload, stats):
+    return csv.reader(iter_payload_lines(payload, stats))
+
+def to_number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+filter_operators = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    'in': lambda value, options: value in options,
+}
+
+def is_numeric_filter(op, value):
+    options = value if op == 'in' else [value]
+    return all(isinstance(option, (int, float)) for option in options)
+
+# (column position, compare function, value, numeric) for each filter_spec condition
+def compile_filters(columns, filter_spec):
+    return [(columns.index(column), filter_operators[op], value, is_numeric_filter(op, value))
+            for column, op, value in filter_spec]
+
+def row_matches(filters, row):
+    for index, compare, value, numeric in filters:
+        field = row[index]
+        if numeric:
+            try:
+                field = to_number(field)
+            except ValueError:
+                return False
+        if not compare(field, value):
+            return False
+    return True
+
+class AggregationResult:
+    def __init__(self, group_by, metrics, groups, rows_scanned, rows_matched, stats):
+        self.group_by = group_by
+        self.metrics = metrics
+        self.groups = groups
+        self.rows_scanned = rows_scanned
+        self.rows_matched = rows_matched
+        self.stats = stats
+
+    # one record per group, e.g. {'Topic': 'IT', 'Class': 'M', 'raisedhands_count': 10, 'raisedhands_sum': 150, ...}
+    def to_records(self):
+        records = []
+        for key in sorted(self.groups):
+            record = dict(zip(self.group_by, key))
+            for metric in self.metrics:
+                count, total, minimum, maximum = self.groups[key][metric]
+                record[f'{metric}_count'] = count
+                record[f'{metric}_sum'] = total
+                record[f'{metric}_mean'] = total / count if count else None
+                record[f'{metric}_min'] = minimum
+                record[f'{metric}_max'] = maximum
+            records.append(record)
+        return records
+
+# Running count/sum/min/max per group and metric, so memory grows with the number of groups and not with the rows.
+# Rows are plain lists in the order of columns, the column positions are looked up once.
+class GroupByAggregator:
+    def __init__(self, columns, group_by, metrics, filter_spec=None):
+        self.columns = list(columns)
+        self.group_by = list(group_by)
+        self.metrics = list(metrics)
+        self.filter_spec = list(filter_spec or [])
+        self.group_index = [self.columns.index(column) for column in self.group_by]
+        self.metric_index = [self.columns.index(column) for column in self.metrics]
+        self.filters = compile_filters(self.columns, self.filter_spec)
+        self.groups = {}
+        self.rows_scanned = 0
+        self.rows_matched = 0
+
+    def matches(self, row):
+        return row_matches(self.filters, row)
+
+    def add(self, row):
+        if not row:
+            return
+        self.rows_scanned += 1
+        if not self.matches(row):
+            return
+        self.rows_matched += 1
+        key = tuple(row[index] for index in self.group_index)
+        states = self.groups.get(key)
+        if states is None:
+            states = self.groups[key] = {metric: [0, 0, None, None] for metric in self.metrics}
+        for metric, index in zip(self.metrics, self.metric_index):
+            try:
+                value = to_number(row[index])
+            except ValueError:
+                # empty or non numeric values are left out of the metric like sql NULL
+                continue
+            state = states[metric]
+            state[0] += 1
+            state[1] += value
+            if state[2] is None or value < state[2]:
+                state[2] = value
+            if state[3] is None or value > state[3]:
+                state[3] = value
+
+    # an empty aggregator with the same query, used for the partial aggregate of a scan range
+    def empty_copy(self):
+        return GroupByAggregator(self.columns, self.group_by, self.metrics, self.filter_spec)
+
+    def merge(self, other):
+        self.rows_scanned += other.rows_scanned
+        self.rows_matched += other.rows_matched
+        return self.merge_groups(other.groups)
+
+    # groups is {group key: {metric: [count, sum, min, max]}}
+    def merge_groups(self, groups):
+        for key, other_states in groups.items():
+            states = self.groups.get(key)
+            if states is None:
+                self.groups[key] = {metric: list(state) for metric, state in other_states.items()}
+                continue
+            for metric, (count, total, minimum, maximum) in other_states.items():
+                state = states[metric]
+                state[0] += count
+                state[1] += total
+                if minimum is not None and (state[2] is None or minimum < state[2]):
+                    state[2] = minimum
+                if maximum is not None and (state[3] is None or maximum > state[3]):
+                    state[3] = maximum
+        return self
+
+    def result(self, stats=None):
+        return AggregationResult(self.group_by, self.metrics, self.groups,
+                                 self.rows_scanned, self.rows_matched, stats or {})
+
+# Builds the S3 Select SQL and InputSerialization from a column list and a filter_spec. Only the listed columns are
+# returned, in that order, and the filter is evaluated by S3 Select so filtered rows are never returned.
+# CSV values are strings in S3 Select, so columns compared with a number are CAST to FLOAT.
+@dataclasses.dataclass
+class SelectQuery:
+    columns: list
+    filter_spec: list = dataclasses.field(default_factory=list)
+    input_format: str = 'CSV'
+    compression_type: str = 'NONE'
+
+    def __post_init__(self):
+        if not self.columns:
+            raise ValueError('at least one column must be selected')
+        if self.input_format not in ('CSV', 'Parquet'):
+            raise ValueError(f'unsupported input_format {self.input_format}')
+        if self.compression_type not in ('NONE', 'GZIP', 'BZIP2'):
+            raise ValueError(f'unsupported compression_type {self.compression_type}')
+        if self.input_format == 'Parquet' and self.compression_type != 'NONE':
+            raise ValueError('Parquet objects are compressed per column, compression_type must be NONE')
+        for column, op, value in self.filter_spec:
+            if op not in filter_operators:
+                raise ValueError(f'unsupported filter operator {op} on {column}')
+
+    def column_sql(self, column):
+        return 's."' + column.replace('"', '""') + '"'
+
+    def value_sql(self, value):
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            raise ValueError(f'unsupported filter value {value!r}')
+        if isinstance(value, str):
+            return "'" + value.replace("'", "''") + "'"
+        return repr(value)
+
+    def condition_sql(self, column, op, value):
+        options = list(value) if op == 'in' else [value]
+        column_sql = self.column_sql(column)
+        if self.input_format == 'CSV' and is_numeric_filter(op, value):
+            column_sql = f'CAST({column_sql} AS FLOAT)'
+        if op == 'in':
+            return f"{column_sql} IN ({', '.join(self.value_sql(option) for option in options)})"
+        return f'{column_sql} {op} {self.value_sql(value)}'
+
+    def to_sql(self):
+        sql = f"SELECT {', '.join(self.column_sql(column) for column in self.columns)} FROM s3object s"
+        if self.filter_spec:
+            sql += ' WHERE ' + ' AND '.join(self.condition_sql(*condition) for condition in self.filter_spec)
+        return sql
+
+    def input_serialization(self):
+        if self.input_format == 'Parquet':
+            return {'Parquet': {}}
+        return {'CSV': {'FileHeaderInfo': 'Use'}, 'CompressionType': self.compression_type}
+
+    # S3 Select accepts ScanRange on uncompressed CSV (without quoted line breaks) and on Parquet, where a row group
+    # is scanned by the range holding its first byte
+    def supports_scan_range(self):
+        return self.input_format == 'Parquet' or self.compression_type == 'NONE'
+
+# HyperLogLog distinct count with 2**precision one byte registers (16 KB at the default precision of 14).
+# The relative standard error is 1.04 / sqrt(2**precision), about 0.8% at precision 14, so 95% of the estimates are
+# within about 1.6% of the true count. Small counts use linear counting and are close to exact.
+# Values are hashed with blake2b so registers built in different processes or on different days can be merged.
+class HyperLogLog:
+    def __init__(self, precision=14, registers=None):
+        if not 4 <= precision <= 18:
+            raise ValueError(f'precision {precision} is not between 4 and 18')
+        self.precision = precision
+        self.registers = registers if registers is not None else bytearray(1 << precision)
+
+    def add(self, value):
+        hashed = int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'big')
+        index = hashed >> (64 - self.precision)
+        remaining = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remaining.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('HyperLogLog sketches with a different precision cannot be merged')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+    def to_dict(self):
+        return {'precision': self.precision, 'registers': base64.b64encode(bytes(self.registers)).decode('ascii')}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['precision'], bytearray(base64.b64decode(data['registers'])))
+
+# KLL quantile sketch (Karnin, Lang and Liberty 2016). Level h keeps items that each stand for 2**h input values, a
+# full level is sorted and every other item (random offset) is promoted to the next level. Memory stays at about
+# 3 * k items whatever the input size. With k = 200 the rank error is about 1.65% at 99% confidence, e.g. the p95
+# estimate is a value whose true rank is between p93.35 and p96.65.
+class KLLSketch:
+    def __init__(self, k=200, c=2 / 3, compactors=None):
+        self.k = k
+        self.c = c
+        self.compactors = compactors if compactors is not None else [[]]
+        self.count = sum(len(items) << height for height, items in enumerate(self.compactors))
+
+    def capacity(self, height):
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.k * self.c ** depth)) + 1
+
+    def size(self):
+        return sum(len(items) for items in self.compactors)
+
+    def max_size(self):
+        return sum(self.capacity(height) for height in range(len(self.compactors)))
+
+    def add(self, value):
+        self.compactors[0].append(value)
+        self.count += 1
+        if len(self.compactors[0]) >= self.capacity(0):
+            self.compress()
+
+    def compress(self):
+        while self.size() >= self.max_size():
+            for height, items in enumerate(self.compactors):
+                if len(items) >= self.capacity(height):
+                    if height + 1 == len(self.compactors):
+                        self.compactors.append([])
+                    items.sort()
+                    # an odd item stays on its level so the total weight is kept
+                    kept = [items.pop()] if len(items) % 2 else []
+                    self.compactors[height + 1].extend(items[random.randint(0, 1)::2])
+                    self.compactors[height] = kept
+                    break
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for height, items in enumerate(other.compactors):
+            self.compactors[height].extend(items)
+        self.count += other.count
+        self.compress()
+        return self
+
+    def quantile(self, q):
+        weighted = sorted((value, 1 << height) for height, items in enumerate(self.compactors) for value in items)
+        if not weighted:
+            return None
+        target = q * self.count
+        cumulative = 0
+        for value, weight in weighted:
+            cumulative += weight
+            if cumulative >= target:
+                return value
+        return weighted[-1][0]
+
+    def to_dict(self):
+        return {'k': self.k, 'c': self.c, 'compactors': self.compactors}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['k'], data['c'], [list(items) for items in data['compactors']])
+
+# Fixed memory per group: one HyperLogLog per distinct column and one KLLSketch per quantile column. It has the same
+# add/empty_copy/merge/result interface as GroupByAggregator so it runs on the serial and the scan range S3 Select
+# paths, and to_dict/from_dict keep the sketches of a daily partition to merge later without rescanning it.
+class SketchAggregator:
+    def __init__(self, columns, group_by, distinct_columns, quantile_columns, filter_spec=None,
+                 precision=14, k=200):
+        self.columns = list(columns)
+        self.group_by = list(group_by)
+        self.distinct_columns = list(distinct_columns)
+        self.quantile_columns = list(quantile_columns)
+        self.filter_spec = list(filter_spec or [])
+        self.precision = precision
+        self.k = k
+        self.group_index = [self.columns.index(column) for column in self.group_by]
+        self.distinct_index = [self.columns.index(column) for column in self.distinct_columns]
+        self.quantile_index = [self.columns.index(column) for column in self.quantile_columns]
+        self.filters = compile_filters(self.columns, self.filter_spec)
+        self.groups = {}
+        self.rows_scanned = 0
+        self.rows_matched = 0
+
+    def new_group(self):
+        return ({column: HyperLogLog(self.precision) for column in self.distinct_columns},
+                {column: KLLSketch(self.k) for column in self.quantile_columns})
+
+    def add(self, row):
+        if not row:
+            return
+        self.rows_scanned += 1
+        if not row_matches(self.filters, row):
+            return
+        self.rows_matched += 1
+        key = tuple(row[index] for index in self.group_index)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = self.new_group()
+        distinct, quantile = group
+        for column, index in zip(self.distinct_columns, self.distinct_index):
+            if row[index] != '':
+                distinct[column].add(row[index])
+        for column, index in zip(self.quantile_columns, self.quantile_index):
+            try:
+                quantile[column].add(to_number(row[index]))
+            except ValueError:
+                continue
+
+    def empty_copy(self):
+        return SketchAggregator(self.columns, self.group_by, self.distinct_columns, self.quantile_columns,
+                                self.filter_spec, self.precision, self.k)
+
+    def merge(self, other):
+        self.rows_scanned += other.rows_scanned
+        self.rows_matched += other.rows_matched
+        for key, (other_distinct, other_quantile) in other.groups.items():
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = self.new_group()
+            distinct, quantile = group
+            for column in self.distinct_columns:
+                distinct[column].merge(other_distinct[column])
+            for column in self.quantile_columns:
+                quantile[column].merge(other_quantile[column])
+        return self
+
+    def result(self, stats=None):
+        return SketchResult(self.group_by, self.groups, self.rows_scanned, self.rows_matched, stats or {})
+
+    def to_dict(self):
+        return {
+            'group_by': self.group_by,
+            'distinct_columns': self.distinct_columns,
+            'quantile_columns': self.quantile_columns,
+            'precision': self.precision,
+            'k': self.k,
+            'rows_scanned': self.rows_scanned,
+            'rows_matched': self.rows_matched,
+            'groups': [{'key': list(key),
+                        'distinct': {column: sketch.to_dict() for column, sketch in distinct.items()},
+                        'quantile': {column: sketch.to_dict() for column, sketch in quantile.items()}}
+                       for key, (distinct, quantile) in self.groups.items()],
+        }
+
+    # the columns and filter are those of the saved scan, only the sketches are needed to merge or query them. The
+    # saved precision and k are kept, so the groups added by a later merge have sketches of the same size.
+    @classmethod
+    def from_dict(cls, data):
+        aggregator = cls(data['group_by'], data['group_by'], [], [], precision=data['precision'], k=data['k'])
+        aggregator.distinct_columns = list(data['distinct_columns'])
+        aggregator.quantile_columns = list(data['quantile_columns'])
+        aggregator.rows_scanned = data['rows_scanned']
+        aggregator.rows_matched = data['rows_matched']
+        for group in data['groups']:
+            distinct = {column: HyperLogLog.from_dict(sketch) for column, sketch in group['distinct'].items()}
+            quantile = {column: KLLSketch.from_dict(sketch) for column, sketch in group['quantile'].items()}
+            aggregator.groups[tuple(group['key'])] = (distinct, quantile)
+        return aggregator
+
+class SketchResult:
+    def __init__(self, group_by, groups, rows_scanned, rows_matched, stats):
+        self.group_by = group_by
+        self.groups = groups
+        self.rows_scanned = rows_scanned
+        self.rows_matched = rows_matched
+        self.stats = stats
+
+    # one record per group, e.g. {'Topic': 'IT', 'NationalITy_distinct': 12, 'raisedhands_p50': 40, ...}
+    def to_records(self, quantiles=(0.5, 0.95)):
+        records = []
+        for key in sorted(self.groups):
+            distinct, quantile = self.groups[key]
+            record = dict(zip(self.group_by, key))
+            for column, sketch in distinct.items():
+                record[f'{column}_distinct'] = sketch.count()
+            for column, sketch in quantile.items():
+                for q in quantiles:
+                    record[f'{column}_p{round(q * 100):g}'] = sketch.quantile(q)
+            records.append(record)
+        return records
+
+# S3 Select returns the matching rows only and its Stats have no row count, so the rows scanned of a select result are
+# not known (None). stats['BytesScanned'] has the size of the scan.
+def select_result(aggregator, stats):
+    result = aggregator.result(stats)
+    result.rows_scanned = None
+    return result
+
+def select_aggregate(s3, bucket_name, file_key, query, aggregator, scan_range=None):
+    select_args = dict(
+    Bucket=bucket_name,
+    Key=file_key,
+    ExpressionType='SQL',
+    Expression=query.to_sql(),
+    InputSerialization = query.input_serialization(),
+    OutputSerialization = {'CSV': {}},
+    )
+    if scan_range is not None:
+        select_args['ScanRange'] = {'Start': scan_range[0], 'End': scan_range[1]}
+    resp = s3.select_object_content(**select_args)
+    stats = {}
+    for row in iter_payload_rows(resp['Payload'], stats):
+        aggregator.add(row)
+    return select_result(aggregator, stats)
+
+# inclusive (start, end) byte ranges covering the object
+def get_scan_ranges(object_size, range_size):
+    return [(start, min(start + range_size, object_size) - 1) for start in range(0, object_size, range_size)]
+
+# Every scan range is sent as its own select_object_content request on the thread pool and aggregated into its own
+# partial aggregator, the partial aggregates and the stats are merged once all the ranges are done.
+def parallel_select_aggregate(s3, bucket_name, file_key, query, aggregator, range_size, max_workers):
+    if not query.supports_scan_range():
+        logging.info(f'{query.input_format} {query.compression_type} input cannot be split, scanning {file_key} serially')
+        return select_aggregate(s3, bucket_name, file_key, query, aggregator)
+    object_size = s3.head_object(Bucket=bucket_name, Key=file_key)['ContentLength']
+    scan_ranges = get_scan_ranges(object_size, range_size)
+    logging.info(f'scanning {file_key} ({object_size} bytes) in {len(scan_ranges)} ranges with {max_workers} workers')
+
+    def scan(scan_range):
+        partial = aggregator.empty_copy()
+        partial_stats = select_aggregate(s3, bucket_name, file_key, query, partial, scan_range).stats
+        return partial, partial_stats
+
+    stats = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for partial, partial_stats in executor.map(scan, scan_ranges):
+            aggregator.merge(partial)
+            for name, value in partial_stats.items():
+                stats[name] = stats.get(name, 0) + value
+    return select_result(aggregator, stats)
+
+# Read-only file object over an S3 object which streams one ranged get_object at a time, so the pyarrow csv reader
+# never holds more than its current block of the object.
+class S3RangedReader(io.RawIOBase):
+    def __init__(self, s3, bucket_name, file_key, range_size):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.file_key = file_key
+        self.range_size = range_size
+        self.size = s3.head_object(Bucket=bucket_name, Key=file_key)['ContentLength']
+        self.position = 0
+        self.body = None
+        self.requests = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.position < self.size:
+            if self.body is None:
+                end = min(self.position + self.range_size, self.size) - 1
+                self.body = self.s3.get_object(Bucket=self.bucket_name, Key=self.file_key,
+                                               Range=f'bytes={self.position}-{end}')['Body']
+                self.requests += 1
+            data = self.body.read(len(buffer))
+            if data:
+                buffer[:len(data)] = data
+                self.position += len(data)
+                return len(data)
+            self.body.close()
+            self.body = None
+        return 0
+
+    def close(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+        super().close()
+
+arrow_filter_functions = {
+    '=': pc.equal,
+    '!=': pc.not_equal,
+    '>': pc.greater,
+    '>=': pc.greater_equal,
+    '<': pc.less,
+    '<=': pc.less_equal,
+    'in': lambda column, options: pc.is_in(column, value_set=pa.array(options)),
+}
+
+integer_pattern = r'^\s*[-+]?\d+\s*$'
+decimal_pattern = r'^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$'
+
+# (integers, decimals) of a string column like to_number: the integer values as int64, the other numbers as float64,
+# null in both for the empty and non numeric values
+def arrow_numbers(column):
+    integers = pc.match_substring_regex(column, integer_pattern)
+    decimals = pc.and_(pc.invert(integers), pc.match_substring_regex(column, decimal_pattern))
+    null = pa.scalar(None, pa.string())
+    return (pc.cast(pc.utf8_trim_whitespace(pc.if_else(integers, column, null)), pa.int64()),
+            pc.cast(pc.utf8_trim_whitespace(pc.if_else(decimals, column, null)), pa.float64()))
+
+# Same filter as GroupByAggregator.matches, rows with a null (non numeric) value in a numeric filter are dropped
+def arrow_filter_mask(batch, filter_spec):
+    mask = None
+    for column, op, value in filter_spec:
+        values = batch.column(column)
+        if is_numeric_filter(op, value):
+            integers, decimals = arrow_numbers(values)
+            values = pc.coalesce(pc.cast(integers, pa.float64()), decimals)
+        condition = arrow_filter_functions[op](values, value)
+        mask = condition if mask is None else pc.and_(mask, condition)
+    return mask
+
+# Every column is read as a string so every block of the file gets the same type. The metrics are converted per
+# batch by arrow_numbers, so integer values stay integers and the records are the same as the S3 Select backend's.
+def arrow_convert_options(aggregator):
+    include_columns = list(aggregator.group_by) + list(aggregator.metrics)
+    include_columns += [column for column, _, _ in aggregator.filter_spec]
+    include_columns = list(dict.fromkeys(include_columns))
+    return pa_csv.ConvertOptions(column_types={column: pa.string() for column in include_columns},
+                                 include_columns=include_columns, strings_can_be_null=False)
+
+# the count/sum/min/max of the integer and decimal values of a metric are combined like GroupByAggregator.add
+# combines the values, a decimal value makes the sum a float
+def combine_metric_states(integer_state, decimal_state):
+    count = integer_state[0] + decimal_state[0]
+    total = integer_state[1] + decimal_state[1] if decimal_state[0] else integer_state[1]
+    minimum = min((value for value in (integer_state[2], decimal_state[2]) if value is not None), default=None)
+    maximum = max((value for value in (integer_state[3], decimal_state[3]) if value is not None), default=None)
+    return [count, total, minimum, maximum]
+
+def arrow_aggregate_batch(aggregator, batch):
+    aggregator.rows_scanned += batch.num_rows
+    if aggregator.filter_spec:
+        batch = batch.filter(arrow_filter_mask(batch, aggregator.filter_spec))
+    aggregator.rows_matched += batch.num_rows
+    if batch.num_rows == 0:
+        return
+    columns = {column: batch.column(column) for column in aggregator.group_by}
+    for metric in aggregator.metrics:
+        columns[f'{metric}_integer'], columns[f'{metric}_decimal'] = arrow_numbers(batch.column(metric))
+    aggregations = [(f'{metric}_{kind}', function) for metric in aggregator.metrics for kind in ('integer', 'decimal')
+                    for function in ('count', 'sum', 'min', 'max')]
+    grouped = pa.table(columns).group_by(aggregator.group_by).aggregate(aggregations)
+    groups = {}
+    for row in grouped.to_pylist():
+        key = tuple(row[column] for column in aggregator.group_by)
+        groups[key] = {metric: combine_metric_states(*[[row[f'{metric}_{kind}_count'], row[f'{metric}_{kind}_sum'] or 0,
+                                                         row[f'{metric}_{kind}_min'], row[f'{metric}_{kind}_max']]
+                                                        for kind in ('integer', 'decimal')])
+                       for metric in aggregator.metrics}
+    aggregator.merge_groups(groups)
+
+arrow_compression_codecs = {'NONE': None, 'GZIP': 'gzip', 'BZIP2': 'bz2'}
+
+def arrow_aggregate(s3, bucket_name, file_key, aggregator, range_size, block_size, compression_type='NONE'):
+    if compression_type not in arrow_compression_codecs:
+        raise ValueError(f'unsupported compression_type {compression_type} for the arrow backend')
+    reader = S3RangedReader(s3, bucket_name, file_key, range_size)
+    try:
+        stream = reader
+        if arrow_compression_codecs[compression_type]:
+            stream = pa.CompressedInputStream(reader, arrow_compression_codecs[compression_type])
+        batches = pa_csv.open_csv(stream, read_options=pa_csv.ReadOptions(block_size=block_size),
+                                  convert_options=arrow_convert_options(aggregator))
+        for batch in batches:
+            arrow_aggregate_batch(aggregator, batch)
+    finally:
+        reader.close()
+    return aggregator.result({'BytesScanned': reader.size, 'BytesProcessed': reader.position,
+                              'GetRequests': reader.requests})
+
 if __name__=='__main__':
 
     # 0. connecting to AWS and S3
@@ -77,25 +732,41 @@ if __name__=='__main__':
     # 1. Check if the bucket and csv file exists
     bucket_exist(s3_client,bucket_name)
     file_exist(s3_client, bucket_name, file_key)
+    file_format_csv(file_key)
 
     # 2. Create an S3 select_object_content to read the CSV via SQL expression
-    resp = s3_client.select_object_content(
-    Bucket=bucket_name,
-    Key=file_key,
-    ExpressionType='SQL',
-    Expression=SQL_query,
-    InputSerialization = {'CSV': {"FileHeaderInfo": "Use"}, 'CompressionType': 'NONE'},
-    OutputSerialization = {'CSV': {}},
-    )
-    for event in resp['Payload']:
-        if 'Records' in event:
-            records = event['Records']['Payload'].decode('utf-8')
-            logging.info(records)
-        elif 'Stats' in event:
-            statsDetails = event['Stats']['Details']
-            logging.info("Stats details bytesScanned: ")
-            logging.info(statsDetails['BytesScanned'])
-            logging.info("Stats details bytesProcessed: ")
-            logging.info(statsDetails['BytesProcessed'])
-            logging.info("Stats details bytesReturned: ")
-            logging.info(statsDetails['BytesReturned'])
\ No newline at end of file
+    # 3. Rebuild the rows across the streamed chunks, filter and aggregate them by group
+    if aggregation == 'sketch':
+        columns = list(dict.fromkeys(sketch_group_by_columns + distinct_columns + quantile_columns))
+        query = SelectQuery(columns, filter_spec, input_format, compression_type)
+        aggregator = SketchAggregator(query.columns, sketch_group_by_columns, distinct_columns, quantile_columns)
+        result = parallel_select_aggregate(s3_client, bucket_name, file_key, query, aggregator,
+                                           scan_range_size, max_workers)
+    elif backend == 'arrow':
+        if input_format != 'CSV':
+            raise ValueError('the arrow backend only reads CSV input')
+        aggregator = GroupByAggregator(source_columns, group_by_columns, metric_columns, filter_spec)
+        result = arrow_aggregate(s3_client, bucket_name, file_key, aggregator, get_range_size, arrow_block_size,
+                                 compression_type)
+    else:
+        # only the needed columns are returned and the filter is already applied by S3 Select
+        query = SelectQuery(list(dict.fromkeys(group_by_columns + metric_columns)), filter_spec,
+                            input_format, compression_type)
+        logging.info(query.to_sql())
+        aggregator = GroupByAggregator(query.columns, group_by_columns, metric_columns)
+        result = parallel_select_aggregate(s3_client, bucket_name, file_key, query, aggregator,
+                                           scan_range_size, max_workers)
+
+    if result.rows_scanned is None:
+        logging.info(f"{result.rows_matched} rows matched {filter_spec} in {result.stats.get('BytesScanned')} bytes scanned")
+    else:
+        logging.info(f'{result.rows_matched} of {result.rows_scanned} rows matched {filter_spec}')
+    records = result.to_records(quantiles) if aggregation == 'sketch' else result.to_records()
+    for record in records:
+        logging.info(record)
+    logging.info("Stats details bytesScanned: ")
+    logging.info(result.stats.get('BytesScanned'))
+    logging.info("Stats details bytesProcessed: ")
+    logging.info(result.stats.get('BytesProcessed'))
+    logging.info("Stats details bytesReturned: ")
+    logging.info(result.stats.get('BytesReturned'))
\ No newline at end of file
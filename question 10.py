@@ -6,7 +6,7 @@
 # Instruction to enable the running of local glue development is found in how_to_run_glue_locally.txt
 
 # Assumption: 
-# - The dataset is only one file and it is in parquet format
+# - The dataset is in parquet files under the ingestion prefix, only the files new or changed since the last run are read
 # - This is a batch ETL not streaming (real-time) ETL
 # - IAM role permission is set up
 
@@ -14,45 +14,105 @@
 # This python (3.11.4) is developed with aws-glue-lib.4.0.0.
 # The data is from xAPI-Edu-Data.csv in the repo.
 
-# Step 0. set up the s3 and glue_client
-# Step 1. start the spark session since to prepare for large data processing
-# Step 2. check if the file exist. use spark to read the parquet file
+# Step 0. set up the s3 and glue_client, and find the input files new or changed since the watermark of the last run
+# Step 1. pick the backend from the input size, and start the spark session if the input is large (spark backend)
+# Step 2. check if the file exist. use spark (or pyarrow for the local backend) to read the parquet file
 # Step 3. transform the data to make it available for analysis (two option: spark transformation or spark SQL)
 # Step 3.1 Set up a sql query to prepare the data for partitioning and analysis
-# Step 4. load the transformed data to S3
-# Step 5. check if the destination file exist
+# Step 3-4 run as one transformation plan: the source is read and cached once, the named outputs of the plan are all
+# computed from the cache and written together, then the cache is dropped
+# the local backend does the same two transformations with vectorized pyarrow, without spark
+# Step 3.2 the categorical columns of the fact output are replaced by the integer keys of their dimension tables,
+# new values get the next keys and the dimension tables are rewritten
+# Step 4. load the transformed data to S3, partitioned by year/month/day (the filtered output by source file). Only
+# the partitions in the output are replaced (dynamic partition overwrite), the files are cut at max_records_per_file or about target_file_bytes
+# Step 4.1 the fact output is merged as a slowly changing dimension (type 2) on fact_guid: the current rows whose
+# tracked columns changed are expired, the new versions and new keys are appended, and only the partitions holding
+# those rows are rewritten. The current rows are looked up in an index written with every merge, so the other
+# partitions are not read
+# Step 5. check if the destination file exist, then commit the watermark with the input files read
 # Step 6. close the spark session
 ##################################################################################################################################################################
 
 import logging
 import os, boto3
-from pyspark.context import SparkContext
-from awsglue.transforms import *
-from awsglue.utils import getResolvedOptions
-from pyspark.context import SparkContext
-from awsglue.context import GlueContext
-from awsglue.job import Job
+import hashlib
+import json
+import posixpath
+from fnmatch import fnmatch
+import uuid
+import xxhash
+from datetime import date, datetime
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import configparser
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from s3_metadata import file_exist, list_keys, invalidate
+from s3_multipart import S3MultipartWriter
+from s3_archive import delete_sources
 
 
 logging.basicConfig(level = logging.INFO)
 
 sql_table = 'source_table'
 
+# backend: 'spark' (glue), 'local' (pyarrow in this process) or 'auto'. auto runs the input locally when it is at
+# most local_max_bytes, as the JVM and cluster start up take longer than the whole transformation of a small file.
+backend = 'auto'
+local_max_bytes = 512 * 1024 * 1024
+
+# Output: the fact output is written in hive partitions of partition_columns, and a run replaces only the partitions
+# it has rows for. A file holds at most max_records_per_file rows, or the rows of about target_file_bytes (estimated
+# from the bytes per row of the source) when target_file_bytes is set.
+partition_columns = ['year', 'month', 'day']
+max_records_per_file = 1000000
+target_file_bytes = 128 * 1024 * 1024
+
+# SCD2 merge of the fact output: a batch row is new when its fact_guid has no current row, and changed when the
+# row_hash of its scd_tracked_columns differs from the current row. key_hash is 'md5' (32 character string) or
+# 'xxhash64' (64 bit integer, cheaper to compute, store and join) for fact_guid and row_hash, both backends give the
+# same values. Changing key_hash on an existing output makes every row look new.
+fact_merge_mode = 'scd2'
+key_hash = 'md5'
+scd_tracked_columns = ['Relation_key', 'raisedhands', 'gender', 'random_combined_column', 'source']
+key_hash_sql = {'md5': 'MD5', 'xxhash64': 'XXHASH64'}[key_hash]
+# fact_guid is the key_hash of fact_key_columns. The source has no student id, so a row is identified by its columns
+# which the SCD2 does not track. Rows of a batch with the same fact_guid and different tracked columns cannot be told
+# apart, they are written to {fact output}_quarantine instead of being merged.
+fact_key_columns = ['NationalITy', 'PlaceofBirth', 'StageID', 'GradeID', 'SectionID', 'Topic', 'Semester',
+                    'AnnouncementsView', 'Discussion', 'ParentAnsweringSurvey', 'ParentschoolSatisfaction',
+                    'StudentAbsenceDays', 'Class']
+
+# Dimensions: every column of dimension_columns in the fact output is replaced by {column}_key, an integer surrogate
+# key from the dimension table {column}.parquet ({column}_key, {column}) under dimension_prefix_key. A value keeps its
+# key for good, new values get the next keys (in sorted order), null stays null.
+dimension_columns = ['NationalITy', 'PlaceofBirth', 'StageID', 'GradeID', 'SectionID', 'Topic', 'Relation',
+                     'StudentAbsenceDays', 'Class']
+
 # 3.1. Set up a sql query to prepare the data for partitioning and analysis
 # This query is based on principles of data warehouse and optimise partitioning for athena query to prepare for analysis. 
-# fact_guid is used as unique primary key.
-# gender is categorical encoded to be stored in a fact_table
+# fact_guid is used as unique primary key (MD5, or XXHASH64 with key_hash = 'xxhash64').
+# gender is categorical encoded to be stored in a fact_table, the other categorical columns are encoded with the
+# dimension tables (see dimension_columns)
 # created_date_time and current_version columns are used as a way to manage slowly changing dimension
 # year,month and day columns are used for partitioning
 
+fact_key_sql = " || '-' || ".join(f"NVL({column},'')" for column in fact_key_columns)
+
 sql_query = f"""
     SELECT
-        MD5(NVL(Relation,'') || '-' ||
-        NVL(raisedhands,'') || '-' ||
-        NVL(VisITedResources,'')
-        ) as fact_guid, 
+        {key_hash_sql}({fact_key_sql}) as fact_guid, 
         Relation,
+        NationalITy,
+        PlaceofBirth,
+        StageID,
+        GradeID,
+        SectionID,
+        Topic,
+        StudentAbsenceDays,
+        Class,
         raisedhands,
         case when gender = 'M' then 0
         when gender = 'F' then 1 end as gender,
@@ -77,30 +137,414 @@ def get_aws_credentials(aws_credentials_path):
     else:
         logging.error(f'{config_path[0]} is not a aws config file')
 
-def file_exist(s3, bucket_name, file_key):
-    keys = s3.list_objects_v2(Bucket=bucket_name)['Contents']
-    for key in keys:
-        if key['Key'] == file_key:
-            logging.info(f'{file_key} is found in {bucket_name}')
+# input_files is {file_key: {'Size', 'ETag', 'LastModified'}}
+def get_backend(input_files):
+    if backend != 'auto':
+        return backend
+    size = sum(metadata['Size'] for metadata in input_files.values())
+    selected = 'local' if size <= local_max_bytes else 'spark'
+    logging.info(f'{len(input_files)} input files have {size} bytes, the {selected} backend is used')
+    return selected
+
+# Watermark of the input files already processed: {'files': {file_key: {'ETag', 'LastModified'}}, 'updated_date_time'}
+def read_watermark(s3_client):
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=watermark_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        return {'files': {}}
+    return json.loads(response['Body'].read())
+
+def get_watermark_entry(metadata):
+    return {'ETag': metadata['ETag'], 'LastModified': metadata['LastModified'].isoformat()}
+
+# the files under source_prefix_key matching source_file_pattern which are not in the watermark, or were rewritten
+# since (another ETag or LastModified)
+def get_input_files(s3_client, watermark):
+    # the listing has to be fresh, a cached one would miss the files written since
+    invalidate(bucket_name, source_prefix_key)
+    index = list_keys(s3_client, bucket_name, source_prefix_key)
+    input_files = {key: metadata for key, metadata in sorted(index.items())
+                   if fnmatch(posixpath.basename(key), source_file_pattern)
+                   and watermark['files'].get(key) != get_watermark_entry(metadata)}
+    logging.info(f'{len(input_files)} new or changed input files under {source_prefix_key}')
+    return input_files
+
+# partition value of the rows of a source file in the filtered output, the same for both backends
+def get_source_file_id(file_key):
+    return hashlib.md5(file_key.encode('utf-8')).hexdigest()[:16]
+
+# one put_object, so the watermark is either the old or the new one, never a part of it
+def commit_watermark(s3_client, watermark, input_files):
+    watermark['files'].update({key: get_watermark_entry(metadata) for key, metadata in input_files.items()})
+    watermark['updated_date_time'] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    s3_client.put_object(Bucket=bucket_name, Key=watermark_key, Body=json.dumps(watermark, indent=2).encode('utf-8'),
+                         ContentType='application/json')
+    invalidate(bucket_name, watermark_key)
+    logging.info(f'watermark {watermark_key} committed with {len(input_files)} input files')
+
+# spark and glue are only imported for the spark backend, the local backend runs without them
+def start_spark():
+    from pyspark.context import SparkContext
+    from awsglue.context import GlueContext
+    from awsglue.job import Job
+    sc = SparkContext()
+    glueContext = GlueContext(sc)
+    spark = glueContext.spark_session
+    job = Job(glueContext)
+    return spark, job
 
-def glue_read_parquet(spark,s3_file_key):
-    source_data = spark.read.parquet(s3_file_key, header=True, inferSchema=True)
+# the source is persisted and counted so it is scanned from S3 once, the show and every output of the plan read the cache.
+# Every row has the source_file_column of its file.
+def glue_read_parquet(spark,file_keys):
+    from functools import reduce
+    from pyspark import StorageLevel
+    from pyspark.sql import functions as F
+    file_data = [spark.read.parquet(f's3://{bucket_name}/{file_key}', header=True, inferSchema=True)
+                 .withColumn(source_file_column, F.lit(get_source_file_id(file_key))) for file_key in file_keys]
+    source_data = reduce(lambda data, other: data.unionByName(other, allowMissingColumns=True), file_data)
+    source_data.persist(StorageLevel.MEMORY_AND_DISK)
+    source_rows = source_data.count()
+    logging.info(f"{source_rows} rows cached from {len(file_keys)} files")
     logging.info("Original Data:")
     source_data.show(5)
-    return source_data
+    return source_data, source_rows
 
 def transformation_source_data(data):
     # This is a example of a transformation. This example is to filter by students who raisedhands more than 60 times.
-    transformed_data = data.select("gender", "GradeID", "raisedhands").filter(source_data["raisedhands"] > 60)
+    transformed_data = data.select("gender", "GradeID", "raisedhands", source_file_column).filter(data[filter_column] > 60)
     logging.info(f"Transformed Data with student {filter_column} > 60:")
     transformed_data.show(5)
     return transformed_data
 
-def transformation_source_data_via_sql(data,sql_query,table):
+def transformation_source_data_via_sql(spark,data,sql_query,table):
     data.createOrReplaceTempView(table)
     transformed_df = spark.sql(sql_query)
     logging.info("Query Results:")
     transformed_df.show()
+    return transformed_df
+
+# Local backend: the same reads and transformations on pyarrow tables
+
+def local_read_parquet(s3_client, bucket_name, file_keys):
+    tables = []
+    for file_key in file_keys:
+        table = pq.read_table(pa.BufferReader(s3_client.get_object(Bucket=bucket_name, Key=file_key)['Body'].read()))
+        tables.append(table.append_column(source_file_column,
+                                          pa.array([get_source_file_id(file_key)] * table.num_rows, pa.string())))
+    source_data = pa.concat_tables(tables, promote_options='permissive')
+    logging.info("Original Data:")
+    logging.info(source_data.slice(0, 5).to_pandas())
+    return source_data
+
+def local_transformation_source_data(data):
+    transformed_data = data.select(["gender", "GradeID", "raisedhands", source_file_column]).filter(
+        pc.greater(data[filter_column], 60))
+    logging.info(f"Transformed Data with student {filter_column} > 60:")
+    logging.info(transformed_data.slice(0, 5).to_pandas())
+    return transformed_data
+
+# NVL(column,'') of the sql_query, the column as a string with '' for null
+def nvl_string(data, column):
+    return pc.fill_null(pc.cast(data[column], pa.string()), '')
+
+# key_hash of every string, the same as MD5 (hex string) or XXHASH64 (seed 42, signed long) in spark sql
+def hash_strings(values):
+    if key_hash == 'xxhash64':
+        hashes = [xxhash.xxh64_intdigest(value.encode('utf-8'), seed=42) for value in values.to_pylist()]
+        return pa.array([value - 2 ** 64 if value >= 2 ** 63 else value for value in hashes], pa.int64())
+    return pa.array([hashlib.md5(value.encode('utf-8')).hexdigest() for value in values.to_pylist()], pa.string())
+
+# Same columns and types as sql_query in spark. The hash has no vectorized kernel so it runs over the joined keys,
+# everything else is computed on whole columns.
+def local_transformation_source_data_via_sql(data, today=None):
+    today = today or date.today()
+    rows = data.num_rows
+    guid_keys = pc.binary_join_element_wise(*[nvl_string(data, column) for column in fact_key_columns], '-')
+    transformed_data = pa.table({
+        'fact_guid': hash_strings(guid_keys),
+        'Relation': data['Relation'],
+        **{column: data[column] for column in ['NationalITy', 'PlaceofBirth', 'StageID', 'GradeID', 'SectionID', 'Topic',
+                                               'StudentAbsenceDays', 'Class']},
+        'raisedhands': data['raisedhands'],
+        # position in ['M', 'F'], null for any other gender like the CASE without ELSE
+        'gender': pc.index_in(data['gender'], value_set=pa.array(['M', 'F'])),
+        'random_combined_column': pc.add(data['raisedhands'], data['VisITedResources']),
+        'source': pa.array(['Townville Primary School'] * rows, pa.string()),
+        'created_date_time': pa.array([today] * rows, pa.date32()),
+        'current_version': pa.array([True] * rows, pa.bool_()),
+        'year': pa.array([today.year] * rows, pa.int32()),
+        'month': pa.array([today.month] * rows, pa.int32()),
+        'day': pa.array([today.day] * rows, pa.int32()),
+    })
+    logging.info("Query Results:")
+    logging.info(transformed_data.slice(0, 20).to_pandas())
+    return transformed_data
+
+def local_write_parquet(s3_client, bucket_name, file_key, data):
+    with S3MultipartWriter(s3_client, bucket_name, file_key, content_type='parquet') as sink:
+        pq.write_table(data, sink)
+
+def get_records_per_file(source_bytes, source_rows):
+    if not target_file_bytes or not source_bytes or not source_rows:
+        return max_records_per_file
+    return max(1, min(max_records_per_file, target_file_bytes * source_rows // source_bytes))
+
+def get_dimension_file_key(column):
+    return f'{dimension_prefix_key}/{column}.parquet'
+
+# {value: key} of the dimension table of the column, empty before its first run
+def read_dimension(s3_client, column):
+    try:
+        body = s3_client.get_object(Bucket=bucket_name, Key=get_dimension_file_key(column))['Body'].read()
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        return {}
+    dimension = pq.read_table(pa.BufferReader(body))
+    return dict(zip(dimension[column].to_pylist(), dimension[f'{column}_key'].to_pylist()))
+
+def get_dimension_table(column, dimension):
+    return pa.table({f'{column}_key': pa.array(list(dimension.values()), pa.int32()),
+                     column: pa.array(list(dimension), pa.string())})
+
+# adds the values not in the dimension yet with the next keys, the dimension table is only rewritten when it grew
+def update_dimension(s3_client, column, values):
+    dimension = read_dimension(s3_client, column)
+    new_values = sorted({str(value) for value in values if value is not None} - set(dimension))
+    if new_values:
+        next_key = max(dimension.values(), default=0) + 1
+        dimension.update({value: next_key + offset for offset, value in enumerate(new_values)})
+        local_write_parquet(s3_client, bucket_name, get_dimension_file_key(column), get_dimension_table(column, dimension))
+        logging.info(f'{len(new_values)} new values added to the {column} dimension, {len(dimension)} values')
+    return dimension
+
+# The dimension is small, so the lookup of every row is a broadcast hash join: index_in finds the row of the value in
+# the dimension table and take reads its key, the fact rows keep their order
+def local_encode_dimensions(s3_client, data):
+    for column in dimension_columns:
+        if column not in data.column_names:
+            continue
+        values = pc.cast(data[column], pa.string())
+        dimension = get_dimension_table(column, update_dimension(s3_client, column, pc.unique(values).to_pylist()))
+        keys = dimension[f'{column}_key'].take(pc.index_in(values, value_set=dimension[column].combine_chunks()))
+        data = data.set_column(data.column_names.index(column), f'{column}_key', keys)
+    return data
+
+def spark_encode_dimensions(spark, s3_client, data):
+    from pyspark.sql import functions as F
+    for column in dimension_columns:
+        if column not in data.columns:
+            continue
+        values = [row[0] for row in data.select(F.col(column).cast('string')).distinct().collect()]
+        dimension = get_dimension_table(column, update_dimension(s3_client, column, values)).to_pandas()
+        data = (data.withColumn(column, F.col(column).cast('string'))
+                .join(F.broadcast(spark.createDataFrame(dimension)), column, 'left').drop(column))
+    return data
+
+def get_quarantine_prefix(destination_prefix):
+    return f'{destination_prefix}_quarantine'
+
+# SCD2 columns of a batch: the row_hash of the tracked columns and an empty expired_date_time, one row per fact_guid.
+# Returns the batch and the rows of the fact_guids with more than one row_hash, which are left out of the batch.
+def local_scd2_batch(batch):
+    row_keys = pc.binary_join_element_wise(*[nvl_string(batch, column) for column in scd_tracked_columns], '-')
+    batch = batch.append_column('row_hash', hash_strings(row_keys))
+    versions = batch.group_by('fact_guid').aggregate([('row_hash', 'count_distinct')])
+    conflict_mask = pc.is_in(batch['fact_guid'],
+                             value_set=versions.filter(pc.greater(versions['row_hash_count_distinct'], 1))['fact_guid'])
+    conflicts = batch.filter(conflict_mask)
+    batch = batch.filter(pc.invert(conflict_mask))
+    # the other duplicates are the same row delivered again, the first one is kept
+    batch = batch.append_column('row_number', pa.array(range(batch.num_rows), pa.int64()))
+    first_rows = batch.group_by('fact_guid').aggregate([('row_number', 'min')])['row_number_min']
+    if len(first_rows) < batch.num_rows:
+        logging.info(f'{batch.num_rows - len(first_rows)} duplicated rows are dropped')
+    batch = batch.take(first_rows.take(pc.sort_indices(first_rows))).drop_columns(['row_number'])
+    return batch.append_column('expired_date_time', pa.nulls(batch.num_rows, pa.date32())), conflicts
+
+# {partition path: [file keys]} of an output written by local_write_partitioned or spark
+def get_output_partitions(s3_client, destination_prefix):
+    partitions = {}
+    for key in list_keys(s3_client, bucket_name, f'{destination_prefix}/'):
+        if key.endswith('.parquet'):
+            partition_path = key[len(destination_prefix) + 1:].rpartition('/')[0]
+            partitions.setdefault(partition_path, []).append(key)
+    return partitions
+
+def read_output_file(s3_client, file_key, columns=None):
+    parquet_file = pq.ParquetFile(pa.BufferReader(s3_client.get_object(Bucket=bucket_name, Key=file_key)['Body'].read()))
+    if columns is not None:
+        columns = [column for column in columns if column in parquet_file.schema_arrow.names]
+    return parquet_file.read(columns=columns)
+
+# The current rows of an SCD2 output are indexed in {destination}_current.parquet (fact_guid, row_hash, partition
+# path), with the list of the output files it was written for in its metadata
+def get_scd2_index_key(destination_prefix):
+    return f'{destination_prefix}_current.parquet'
+
+# {fact_guid: (row_hash, partition path)} of the current rows. The index is used when it lists the files of the output,
+# else (first merge, or a run which failed after writing the partitions) the key columns of every partition are read.
+def read_scd2_current(s3_client, destination_prefix, partitions):
+    file_keys = sorted(key for partition_file_keys in partitions.values() for key in partition_file_keys)
+    try:
+        index = read_output_file(s3_client, get_scd2_index_key(destination_prefix))
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        index = None
+    if index is not None and json.loads(index.schema.metadata[b'files']) == file_keys:
+        return dict(zip(index['fact_guid'].to_pylist(),
+                        zip(index['row_hash'].to_pylist(), index['partition_path'].to_pylist())))
+    if partitions:
+        logging.info(f'no index of the current rows of {destination_prefix}, reading {len(partitions)} partitions')
+
+    current = {}
+    for partition_path, partition_file_keys in partitions.items():
+        for partition_file_key in partition_file_keys:
+            existing = read_output_file(s3_client, partition_file_key, ['fact_guid', 'row_hash', 'current_version'])
+            row_hashes = existing['row_hash'].to_pylist() if 'row_hash' in existing.column_names else [None] * existing.num_rows
+            for guid, row_hash, current_version in zip(existing['fact_guid'].to_pylist(), row_hashes,
+                                                       existing['current_version'].to_pylist()):
+                if current_version:
+                    current[guid] = (row_hash, partition_path)
+    return current
+
+# written once the merged partitions are written, for the files of the output at that point
+def write_scd2_current(s3_client, destination_prefix, current):
+    file_keys = sorted(key for partition_file_keys in get_output_partitions(s3_client, destination_prefix).values()
+                       for key in partition_file_keys)
+    index = pa.table({
+        'fact_guid': pa.array(list(current), pa.int64() if key_hash == 'xxhash64' else pa.string()),
+        'row_hash': pa.array([row_hash for row_hash, _ in current.values()], pa.int64() if key_hash == 'xxhash64' else pa.string()),
+        'partition_path': pa.array([partition_path for _, partition_path in current.values()], pa.string()),
+    }).replace_schema_metadata({'files': json.dumps(file_keys)})
+    local_write_parquet(s3_client, bucket_name, get_scd2_index_key(destination_prefix), index)
+
+# Local SCD2 merge: returns the rows of the partitions to rewrite (the partitions of the new rows and of the expired
+# rows, with all their other rows unchanged), to be written with local_write_partitioned, and the current rows for
+# write_scd2_current. The current rows come from the index, so only the partitions to rewrite are read.
+def local_scd2_merge(s3_client, batch, destination_prefix, columns, today=None):
+    today = today or date.today()
+    batch, conflicts = local_scd2_batch(batch)
+    if conflicts.num_rows:
+        quarantine_file_key = f'{get_quarantine_prefix(destination_prefix)}/{today}-{uuid.uuid4().hex}.parquet'
+        local_write_parquet(s3_client, bucket_name, quarantine_file_key, conflicts)
+        logging.error(f'{conflicts.num_rows} rows share a fact_guid with different tracked columns, '
+                      f'written to {quarantine_file_key}')
+    partitions = get_output_partitions(s3_client, destination_prefix)
+    current = read_scd2_current(s3_client, destination_prefix, partitions)
+
+    changed_mask = [guid not in current or current[guid][0] != row_hash
+                    for guid, row_hash in zip(batch['fact_guid'].to_pylist(), batch['row_hash'].to_pylist())]
+    inserts = batch.filter(pa.array(changed_mask, pa.bool_()))
+    expired = {}
+    for guid in inserts['fact_guid'].to_pylist():
+        if guid in current:
+            expired.setdefault(current[guid][1], set()).add(guid)
+    logging.info(f'{inserts.num_rows} new or changed rows of {batch.num_rows}, {sum(map(len, expired.values()))} rows expired')
+    for guid, row_hash, values in zip(inserts['fact_guid'].to_pylist(), inserts['row_hash'].to_pylist(),
+                                      inserts.select(columns).to_pylist()):
+        current[guid] = (row_hash, get_partition_path(columns, [values[column] for column in columns]))
+    if not inserts.num_rows:
+        return inserts, current
+
+    affected = set(expired) | set(split_partitions(inserts.select(columns), columns))
+    tables = [inserts]
+    for partition_path in sorted(affected & set(partitions)):
+        existing = pa.concat_tables([read_output_file(s3_client, partition_file_key)
+                                     for partition_file_key in partitions[partition_path]], promote_options='permissive')
+        # the partition values are in the path, not in the files
+        for column, value in zip(columns, partition_path.split('/')):
+            existing = existing.append_column(column, pa.array([int(value.split('=', 1)[1])] * existing.num_rows,
+                                                               batch.schema.field(column).type))
+        expire_mask = pc.and_(existing['current_version'],
+                              pc.is_in(existing['fact_guid'], value_set=pa.array(list(expired.get(partition_path, ())),
+                                                                                 existing.schema.field('fact_guid').type)))
+        if 'expired_date_time' not in existing.column_names:
+            existing = existing.append_column('expired_date_time', pa.nulls(existing.num_rows, pa.date32()))
+        existing = existing.set_column(existing.column_names.index('current_version'), 'current_version',
+                                       pc.if_else(expire_mask, False, existing['current_version']))
+        existing = existing.set_column(existing.column_names.index('expired_date_time'), 'expired_date_time',
+                                       pc.if_else(expire_mask, pa.scalar(today, pa.date32()), existing['expired_date_time']))
+        tables.append(existing)
+    return pa.concat_tables(tables, promote_options='permissive'), current
+
+# Spark SCD2 merge, the same change set as local_scd2_merge with joins. The result reads the files it replaces, so it
+# is checkpointed before it is written.
+def spark_scd2_merge(spark, s3_client, batch, destination_prefix, columns):
+    from pyspark.sql import functions as F
+    key_hash_function = F.xxhash64 if key_hash == 'xxhash64' else F.md5
+    row_keys = F.concat_ws('-', *[F.coalesce(F.col(column).cast('string'), F.lit('')) for column in scd_tracked_columns])
+    from pyspark.sql import Window
+    batch = (batch.withColumn('row_hash', key_hash_function(row_keys))
+             .withColumn('versions', F.size(F.collect_set('row_hash').over(Window.partitionBy('fact_guid')))))
+    conflicts = batch.filter(F.col('versions') > 1).drop('versions')
+    conflicts.write.parquet(f"s3://{bucket_name}/{get_quarantine_prefix(destination_prefix)}", mode="append")
+    batch = (batch.filter(F.col('versions') == 1).drop('versions')
+             .dropDuplicates(['fact_guid'])
+             .withColumn('expired_date_time', F.lit(None).cast('date')))
+    if not get_output_partitions(s3_client, destination_prefix):
+        return batch
+
+    existing = spark.read.parquet(f"s3://{bucket_name}/{destination_prefix}")
+    for column in ('row_hash', 'expired_date_time'):
+        if column not in existing.columns:
+            existing = existing.withColumn(column, F.lit(None).cast(batch.schema[column].dataType))
+    current = existing.filter(F.col('current_version')).select(
+        'fact_guid', F.col('row_hash').alias('current_row_hash'), *[F.col(column).alias(f'current_{column}') for column in columns])
+    changes = (batch.join(current, 'fact_guid', 'left')
+               .filter(F.col(f'current_{columns[0]}').isNull() | ~F.col('current_row_hash').eqNullSafe(F.col('row_hash'))))
+    inserts = changes.select(*batch.columns)
+    expired = (changes.filter(F.col(f'current_{columns[0]}').isNotNull())
+               .select('fact_guid', *[F.col(f'current_{column}').alias(column) for column in columns])
+               .withColumn('expire', F.lit(True)))
+    affected = inserts.select(*columns).union(expired.select(*columns)).distinct()
+
+    expire = F.coalesce(F.col('expire'), F.lit(False)) & F.col('current_version')
+    kept = (existing.join(F.broadcast(affected), columns, 'left_semi')
+            .join(F.broadcast(expired), ['fact_guid', *columns], 'left')
+            .withColumn('expired_date_time', F.when(expire, F.current_date()).otherwise(F.col('expired_date_time')))
+            .withColumn('current_version', F.when(expire, F.lit(False)).otherwise(F.col('current_version')))
+            .drop('expire'))
+    return kept.unionByName(inserts).localCheckpoint()
+
+# hive path of a partition like spark writes it, e.g. year=2023/month=9/day=15
+def get_partition_path(columns, values):
+    return '/'.join(f'{column}={value}' for column, value in zip(columns, values))
+
+# {partition path: rows of the partition without the partition columns}, {'': data} without partition columns
+def split_partitions(data, columns):
+    if not columns:
+        return {'': data}
+    partitions = {}
+    for values in data.select(columns).group_by(columns).aggregate([]).to_pylist():
+        mask = None
+        for column in columns:
+            column_mask = pc.equal(data[column], values[column]) if values[column] is not None else pc.is_null(data[column])
+            mask = column_mask if mask is None else pc.and_(mask, column_mask)
+        partition_path = get_partition_path(columns, [values[column] for column in columns])
+        partitions[partition_path] = data.filter(mask).drop_columns(columns)
+    return partitions
+
+# Local dynamic partition overwrite: the files of every partition of data are written first, then the files which
+# were in those partitions before are deleted. Partitions without rows in data are not touched.
+def local_write_partitioned(s3_client, bucket_name, destination_prefix, data, columns, records_per_file):
+    run_id = uuid.uuid4().hex
+    written_file_keys = []
+    for partition_path, partition_data in split_partitions(data, columns).items():
+        partition_prefix = f'{destination_prefix}/{partition_path}'.rstrip('/')
+        previous_file_keys = list_keys(s3_client, bucket_name, f'{partition_prefix}/')
+        partition_file_keys = []
+        for number, offset in enumerate(range(0, max(partition_data.num_rows, 1), records_per_file)):
+            partition_file_key = f'{partition_prefix}/part-{number:05d}-{run_id}.snappy.parquet'
+            local_write_parquet(s3_client, bucket_name, partition_file_key, partition_data.slice(offset, records_per_file))
+            partition_file_keys.append(partition_file_key)
+        delete_sources(s3_client, bucket_name, [key for key in previous_file_keys if key not in partition_file_keys])
+        logging.info(f'{partition_prefix} replaced with {len(partition_file_keys)} files')
+        written_file_keys.extend(partition_file_keys)
+    return written_file_keys
 
 config = configparser.RawConfigParser()
 aws_credentials_path = '~/.aws/credentials'
@@ -108,65 +552,168 @@ aws_access_key_id, aws_secret_access_key = get_aws_credentials(aws_credentials_p
 # Insert the region_name and bucket_name for testing
 region_name = ''
 bucket_name = ''
-prefix_key = r'demo/ingestion/year=2023/month=09/day=15'
-destination_prefix_key = r'demo/post_ingestion/year=2023/month=09/day=15'
-destination_file_key = f'{destination_prefix_key}/transformed_data.parquet'
-file_key = fr'{prefix_key}/xAPI-Edu-Data.parquet'
+# Input discovery: every file under source_prefix_key whose name matches source_file_pattern and which is not in
+# the watermark (same key, ETag and LastModified) is read. The watermark is a json object in the bucket, written only
+# once the outputs are written and checked, so a failed run reads the same files again on the next run.
+source_prefix_key = r'demo/ingestion/'
+source_file_pattern = 'xAPI-Edu-Data*.parquet'
+watermark_key = r'demo/state/question_10_watermark.json'
+destination_prefix_key = r'demo/post_ingestion'
+fact_destination_prefix_key = f'{destination_prefix_key}/fact'
 filter_column = 'raisedhands'
-s3_path = f's3://{bucket_name}/{file_key}'
+# destination of option 1, option 2 goes to fact_destination_prefix_key. Option 1 is partitioned by
+# source_file_column, the id of the source file of the rows (get_source_file_id), so a run only replaces the partitions
+# of its input files: a new file adds its partition, a rewritten file replaces its rows, the other files are kept.
+filter_destination_prefix_key = f'{destination_prefix_key}/{filter_column}_over_60'
+source_file_column = 'source_file_id'
+dimension_prefix_key = f'{destination_prefix_key}/dimensions'
 
 
-if __name__ == '__main__':
-    # 0. set up the s3 and glue_client
-    s3_client = boto3.client('s3', aws_access_key_id=aws_access_key_id, 
-                          aws_secret_access_key=aws_secret_access_key, 
-                          region_name=region_name)
+# The transformation plan: {output name: (spark transformation, local transformation, destination prefix,
+# partition columns, merge mode)}, the merge mode is 'overwrite' or 'scd2'. Every output is computed from the same
+# read of the input files.
+def get_transformation_plan(s3_client, spark=None):
+    return {
+        # option 1. using spark transformation, usually better performance but harder to understand the transformation steps
+        # overwrites only the partitions of the input files
+        'filtered': (transformation_source_data, local_transformation_source_data, filter_destination_prefix_key,
+                     [source_file_column], 'overwrite'),
+        # option 2. using spark SQL transformation, it is easier but might be slow in performance
+        # 3.2 with the categorical columns encoded by the dimension tables
+        'fact': (lambda data: spark_encode_dimensions(spark, s3_client,
+                                                      transformation_source_data_via_sql(spark, data, sql_query, sql_table)),
+                 lambda data: local_encode_dimensions(s3_client, local_transformation_source_data_via_sql(data)),
+                 fact_destination_prefix_key, partition_columns, fact_merge_mode),
+    }
 
-    glue_client = boto3.client('glue', aws_access_key_id=aws_access_key_id, 
-                          aws_secret_access_key=aws_secret_access_key, 
-                          region_name=region_name)
+# writes the outputs at the same time, each write reads the cached source, then drops the cache.
+# Returns the _SUCCESS marker of every output.
+def run_spark_plan(spark, s3_client, source_data, plan, records_per_file):
+    # overwrite replaces only the partitions present in the output instead of the whole destination
+    spark.conf.set("spark.sql.sources.partitionOverwriteMode", "dynamic")
     try:
+        outputs = {}
+        for name, (spark_transformation, _, destination_prefix, columns, merge_mode) in plan.items():
+            transformed_data = spark_transformation(source_data)
+            if merge_mode == 'scd2':
+                transformed_data = spark_scd2_merge(spark, s3_client, transformed_data, destination_prefix, columns)
+            outputs[name] = (transformed_data, destination_prefix, columns)
+
+        def write(name):
+            transformed_data, destination_prefix, columns = outputs[name]
+            writer = (transformed_data.repartition(*columns) if columns else transformed_data).write
+            if columns:
+                writer = writer.partitionBy(*columns)
+            writer.option("maxRecordsPerFile", records_per_file).parquet(f"s3://{bucket_name}/{destination_prefix}",
+                                                                        mode="overwrite")
+            logging.info(f'{name} written to {destination_prefix}')
+            return f'{destination_prefix}/_SUCCESS'
+
+        with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+            return list(executor.map(write, outputs))
+    finally:
+        source_data.unpersist()
+
+# returns the files written for every output
+def run_local_plan(s3_client, source_data, plan, records_per_file):
+    def write(name):
+        _, local_transformation, destination_prefix, columns, merge_mode = plan[name]
+        transformed_data = local_transformation(source_data)
+        if merge_mode == 'scd2':
+            transformed_data, current = local_scd2_merge(s3_client, transformed_data, destination_prefix, columns)
+        written_file_keys = local_write_partitioned(s3_client, bucket_name, destination_prefix,
+                                                    transformed_data, columns, records_per_file)
+        if merge_mode == 'scd2':
+            write_scd2_current(s3_client, destination_prefix, current)
+        logging.info(f'{name} written to {destination_prefix}')
+        return written_file_keys
 
+    with ThreadPoolExecutor(max_workers=len(plan)) as executor:
+        return [file_key for written_file_keys in executor.map(write, plan) for file_key in written_file_keys]
+
+
+# Spark backend, for inputs too large for one process. Returns True when the outputs are written.
+def run_spark(s3_client, input_files):
+    spark = None
+    try:
         # uncomment for actual glue job usage
         # glue_client.start_job_run(JobName = 'my_test_Job')
 
         # 1. start the spark session since to prepare for large data processing
-        # uncomment for actual glue job usage
+        # uncomment for actual glue job usage (from awsglue.utils import getResolvedOptions)
         # args = getResolvedOptions(sys.argv,['JOB_NAME'])
-        sc = SparkContext()
-        glueContext = GlueContext(sc)
-        spark = glueContext.spark_session
-        logger = glueContext.get_logger()
-        job = Job(glueContext)
+        spark, job = start_spark()
 
         # uncomment for actual glue job usage
         # job.init(args['JOB_NAME'], args)
         
-        # 2. check if the file exist. use spark to read the parquet file
-        file_exist(s3_client, bucket_name, file_key)
-        # need to add in the check in glue_read_parquet 
-        source_data = glue_read_parquet(spark,s3_path)
+        # 2. use spark to read the parquet files, they were found by the listing of get_input_files
+        source_data, source_rows = glue_read_parquet(spark, list(input_files))
+        records_per_file = get_records_per_file(sum(metadata['Size'] for metadata in input_files.values()), source_rows)
 
         # 3. transform the data to make it available for analysis (two option: spark transformation or spark SQL)
-
-        # option 1. using spark transformation, usually better performance but harder to understand the transformation steps
-        transformed_data = transformation_source_data(source_data)
-
-        # option 2. using spark SQL transformation, it is easier but might be slow in performance
-        transformed_data = transformation_source_data_via_sql(source_data,sql_query,sql_table)
-        
         # 4. load the transformed data to S3
         # load the transformed data back to S3 in a seperate folder in post_ingestion
-        transformed_data.write.parquet(f"s3://{destination_file_key}", mode="overwrite")
+        written_file_keys = run_spark_plan(spark, s3_client, source_data, get_transformation_plan(s3_client, spark),
+                                           records_per_file)
 
         # 5. check if the write-to-s3 file exist
-        file_exist(s3_client, bucket_name, destination_file_key)
+        for written_file_key in written_file_keys:
+            file_exist(s3_client, bucket_name, written_file_key)
         # uncomment for actual glue job usage
         # job.commit()
+        return True
     except Exception as e:
         logging.error("Error: Failed to copy data from S3 to Redshift.")
         logging.error(e)
+        return False
     # Stop the SparkSession
     finally:
         # 6. close the spark session
-        spark.stop()
+        if spark is not None:
+            spark.stop()
+
+# Local backend, the same steps with pyarrow in this process. Returns True when the outputs are written.
+def run_local(s3_client, input_files):
+    try:
+        # 2. read the parquet files
+        source_data = local_read_parquet(s3_client, bucket_name, list(input_files))
+
+        # 3-4. transform the data with option 1 and option 2 as with spark, and load them to S3 in post_ingestion
+        records_per_file = get_records_per_file(sum(metadata['Size'] for metadata in input_files.values()),
+                                                source_data.num_rows)
+        written_file_keys = run_local_plan(s3_client, source_data, get_transformation_plan(s3_client), records_per_file)
+        # the source table is released once the plan is done
+        source_data = None
+
+        # 5. check if the write-to-s3 file exist
+        for written_file_key in written_file_keys:
+            file_exist(s3_client, bucket_name, written_file_key)
+        return True
+    except Exception as e:
+        logging.error("Error: Failed to transform the data locally.")
+        logging.error(e)
+        return False
+
+
+if __name__ == '__main__':
+    # 0. set up the s3 and glue_client
+    s3_client = boto3.client('s3', aws_access_key_id=aws_access_key_id, 
+                          aws_secret_access_key=aws_secret_access_key, 
+                          region_name=region_name)
+
+    glue_client = boto3.client('glue', aws_access_key_id=aws_access_key_id, 
+                          aws_secret_access_key=aws_secret_access_key, 
+                          region_name=region_name)
+
+    # 0. only the input files new or changed since the last successful run are processed
+    watermark = read_watermark(s3_client)
+    input_files = get_input_files(s3_client, watermark)
+    if not input_files:
+        logging.info('no new input files, nothing to transform')
+    else:
+        # 1. pick the backend from the size of the input
+        run = run_local if get_backend(input_files) == 'local' else run_spark
+        # 5. the watermark moves only after a successful write
+        if run(s3_client, input_files):
+            commit_watermark(s3_client, watermark, input_files)
@@ -16,6 +16,7 @@
 
 # Assumption: 
 # - Assume the script is standalone not linked to other scripts. some of the functions are repeated in other questions. Importing function would be a good practice.
+# - s3_metadata.py and s3_archive.py are deployed with the script, the bucket and file checks and the archiving are shared with the other questions
 # - Table is already created in redshift
 # - Data require small-medium workload (up to 1 million) and in CSV format. Else, Glue will be a better option.
 # - This is a batch ETL not streaming (real-time) ETL
@@ -29,22 +30,39 @@
 # Step 1. Connect to Redshift and S3
 # Step 2. check for if bucket and file exist
 # Step 3. Create a cursor
+# Step 3.0 Validate the files against the table columns and reject the bad files before the COPY
+# Step 3.1 Split the files into compressed parts for every slice of the cluster and list them in a manifest
 # Step 4. Copy query with credentials. This is where you could do basic transformation and filter to the data with copy command (extract and transform)
 # Step 5. Commit the transaction (load)
-# Step 6. Get the row copied to redshift for checking purposes 
+# Step 6. Get the row copied to redshift for checking purposes from the COPY, and record it in the load audit table
 # Step 7. Move the CSV file from demo/ingestion to demo/archives to prevent double extraction, and keep the raw file in archive
 # Step 8. Move the object to archive
-# Step 9. Close the cursor and connection
+# Step 9. Close the cursor, the connection is kept open for the next warm invocation
 ##################################################################################################################################################################
 
+import io
 import os
+import sys
 import logging
 import boto3
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.compute as pc
 import configparser
+from s3_metadata import bucket_exist, get_object_metadata, list_keys
+from s3_archive import archive_objects, delete_sources
+from s3_multipart import S3MultipartWriter
 import redshift_connector
 import json
+import csv
+import math
+import time
+import zlib
+import threading
 import urllib.parse
+from datetime import date, datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 
 # Set up AWS credentials (ensure AWS CLI or environment variables are configured)
@@ -78,10 +96,56 @@ redshift_user = ''
 redshift_password = ''
 iam = ''
 
+# The connection is kept at module level and reused by warm lambda invocations.
+# It is checked with SELECT 1 only when it has been idle for connection_idle_check_seconds, and replaced once it is
+# older than connection_max_age_seconds
+connection_idle_check_seconds = 60
+connection_max_age_seconds = 3600
+
 # Redshift table
 # insert the redshift table to fit to the testing
 table = ''
 
+# one row per loaded file, written in the same transaction as the COPY
+load_audit_table = 'etl_load_audit'
+
+# Batching: every file of the event (and the files buffered by earlier warm invocations) is listed in one COPY manifest
+# and loaded with a single COPY and commit, since redshift commits are serialised across the cluster.
+# The batch is loaded once it reaches batch_max_files or batch_max_bytes, or once the oldest file waited
+# batch_max_wait_seconds. batch_max_wait_seconds = 0 loads every event as its own batch.
+batch_mode = True
+batch_max_files = 500
+batch_max_bytes = 1024 * 1024 * 1024
+batch_max_wait_seconds = 0
+manifest_prefix = 'demo/manifests'
+# a file which failed in batch_max_attempts batches is moved to demo/dead_letter instead of being queued again,
+# so it does not keep the files batched with it from loading
+batch_max_attempts = 3
+
+# Splitting: a single file is loaded by a single slice, so before the COPY every file is streamed into
+# slice count * parts_per_slice compressed parts next to the file (demo/ingestion -> demo/split), and the COPY loads the parts from a manifest.
+# Small files get fewer parts, none smaller than split_min_part_bytes, and a file of one part is loaded as it is, without
+# a rewrite. The parts and the files loaded as they are have their own COPY (a COPY has one compression), in the same
+# transaction. Parts are cut at line ends, so the files must not have quoted fields with line breaks. split_compression is 'GZIP' or 'ZSTD' (needs the zstandard package).
+split_mode = True
+parts_per_slice = 1
+split_compression = 'GZIP'
+split_min_part_bytes = 16 * 1024 * 1024
+split_chunk_size = 1024 * 1024
+
+# Backfill: partitions loaded at the same time and the file recording the partitions already loaded
+ingestion_prefix = 'demo/ingestion'
+backfill_max_workers = 4
+backfill_checkpoint_path = 'backfill_checkpoint.json'
+
+# Validation: before the COPY every file is streamed through the pyarrow csv reader and checked against the columns of
+# the target table (column count, types, not null and varchar length). A file with errors is moved to demo/rejected
+# with its first validation_max_errors bad rows logged, and is never sent to redshift.
+# With split_mode on, the parts are cut from the bytes read by the validation, so a valid file is read once.
+validation_mode = True
+validation_max_errors = 20
+validation_block_size = 4 * 1024 * 1024
+
 logging.basicConfig(level = logging.INFO)
 
 # Obtain the access key and access key if no hardcoded values were given 
@@ -97,21 +161,6 @@ def get_aws_credentials(aws_credentials_path):
     
 
 
-def bucket_exist(s3,bucket_name):
-    buckets = s3.list_buckets()['Buckets']
-    for bucket in buckets:
-        if bucket['Name'] == bucket_name:
-            logging.info(f'This bucket {bucket_name} is found')
-        else:
-            logging.error(f'This bucket {bucket_name} is not found...')
-
-def file_exist(s3, bucket_name, file_key):
-    keys = s3.list_objects_v2(Bucket=bucket_name)['Contents']
-    for key in keys:
-        if key['Key'] == file_key:
-            logging.info(f'{file_key} is found in {bucket_name}')
-    file_format_csv(file_key)
-
 def file_format_csv(file_key):
     file_extension = file_key.split('.')[-1]
     if file_extension == 'csv':
@@ -126,35 +175,671 @@ def table_exists(cur, table_exist_query):
     else:
         logging.error(f"The table '{table}' does not exist in Redshift.")
 
-def move_object(s3_client,bucket_name,source_file_key,destination_file_key):\
-    # copy the object to destination location
-    s3_client.copy_object(
-    CopySource={'Bucket': bucket_name, 'Key': source_file_key},
-    Bucket=bucket_name,
-    Key=destination_file_key
+def connect_redshift():
+    return redshift_connector.connect(
+        host=redshift_host,
+        port=redshift_port,
+        database=redshift_database,
+        user=redshift_user,
+        password=redshift_password
     )
 
-    # delete the object from the source location
-    s3_client.delete_object(Bucket=bucket_name, Key=source_file_key)
+class RedshiftConnectionManager:
+    def __init__(self, connect, idle_check_seconds, max_age_seconds):
+        self.connect = connect
+        self.idle_check_seconds = idle_check_seconds
+        self.max_age_seconds = max_age_seconds
+        self.conn = None
+        self.created_time = None
+        self.last_used_time = None
+        self.connect_count = 0
+        self.reuse_count = 0
+
+    def is_alive(self):
+        try:
+            cur = self.conn.cursor()
+            cur.execute('SELECT 1')
+            cur.fetchone()
+            cur.close()
+            return True
+        except Exception as e:
+            logging.warning(f'redshift connection is not alive, reconnecting: {e}')
+            return False
+
+    def get(self):
+        now = time.monotonic()
+        if self.conn is not None and now - self.created_time >= self.max_age_seconds:
+            logging.info(f'redshift connection is {now - self.created_time:.0f} seconds old, reconnecting')
+            self.close()
+        elif self.conn is not None and now - self.last_used_time >= self.idle_check_seconds and not self.is_alive():
+            self.close()
+        if self.conn is None:
+            self.conn = self.connect()
+            self.created_time = time.monotonic()
+            self.connect_count += 1
+        else:
+            self.reuse_count += 1
+        self.last_used_time = time.monotonic()
+        return self.conn
+
+    # drop the connection after a connection error, the next get() opens a new one
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception as e:
+                logging.warning(f'error closing the redshift connection: {e}')
+        self.conn = None
+        self.created_time = None
+
+    def metrics(self):
+        age = time.monotonic() - self.created_time if self.conn is not None else 0
+        return {'connection_age_seconds': round(age, 3), 'connect_count': self.connect_count,
+                'reuse_count': self.reuse_count}
+
+redshift_connection = RedshiftConnectionManager(connect_redshift, connection_idle_check_seconds,
+                                                connection_max_age_seconds)
+
+# errors of a connection which is gone (closed by the cluster, network reset) rather than of the query
+connection_errors = (redshift_connector.InterfaceError, redshift_connector.OperationalError, OSError)
+
+# Connects (or reuses the connection) and runs the first query of the batch. A connection which turns out to be dead
+# is dropped and the query is tried once more on a new connection. Returns the connection and its cursor.
+def open_cursor(connection, first_query):
+    for attempt in range(2):
+        conn = cur = None
+        try:
+            conn = connection.get()
+            cur = conn.cursor()
+            first_query(cur)
+            return conn, cur
+        except connection_errors as e:
+            if cur is not None:
+                try:
+                    cur.close()
+                except Exception:
+                    pass
+            connection.close()
+            if attempt:
+                raise
+            logging.warning(f'redshift connection failed, reconnecting once: {e}')
+
+# Stand-in for an SQS queue: files wait in memory across warm invocations of the same lambda container until the batch
+# is ready. Files still waiting when the container is recycled stay in demo/ingestion and are picked up again by a replay.
+# The files of a batch which failed to load are put back and loaded again with the next batch, up to max_attempts times.
+class LocalBatchQueue:
+    def __init__(self, max_files, max_bytes, max_wait_seconds, max_attempts=batch_max_attempts):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_wait_seconds = max_wait_seconds
+        self.max_attempts = max_attempts
+        self.files = []
+        self.size = 0
+        self.first_put_time = None
+        # (bucket, key) -> failed loads of the file
+        self.attempts = {}
+
+    # an event delivered again for a file already waiting is ignored
+    def put(self, bucket_name, file_key, size):
+        if any(file_bucket == bucket_name and queued_key == file_key for file_bucket, queued_key, _ in self.files):
+            return
+        if self.first_put_time is None:
+            self.first_put_time = time.monotonic()
+        self.files.append((bucket_name, file_key, size))
+        self.size += size
+
+    def ready(self):
+        if not self.files:
+            return False
+        return (len(self.files) >= self.max_files or self.size >= self.max_bytes
+                or time.monotonic() - self.first_put_time >= self.max_wait_seconds)
+
+    def drain(self):
+        files = self.files
+        self.files = []
+        self.size = 0
+        self.first_put_time = None
+        return files
 
-    logging.info(f'S3 object moved from {source_file_key} to {destination_file_key}')
+    # back at the front of the queue, the files which came in meanwhile are loaded after them.
+    # Returns the files given up after max_attempts failed loads, they are not queued again.
+    def requeue(self, files):
+        queued = {(file_bucket, file_key) for file_bucket, file_key, _ in self.files}
+        retry_files = []
+        given_up = []
+        for file_bucket, file_key, size in files:
+            attempts = self.attempts.get((file_bucket, file_key), 0) + 1
+            if attempts >= self.max_attempts:
+                self.attempts.pop((file_bucket, file_key), None)
+                given_up.append((file_bucket, file_key, size))
+                continue
+            self.attempts[(file_bucket, file_key)] = attempts
+            if (file_bucket, file_key) not in queued:
+                retry_files.append((file_bucket, file_key, size))
+        self.files = retry_files + self.files
+        self.size += sum(size for _, _, size in retry_files)
+        if self.first_put_time is None and self.files:
+            self.first_put_time = time.monotonic()
+        return given_up
 
-def count_row_table(cursor,query):
-    cursor.execute(query)
+    # the files loaded (or rejected) start again from no failed attempt
+    def done(self, files):
+        for file_bucket, file_key, _ in files:
+            self.attempts.pop((file_bucket, file_key), None)
+
+batch_queue = LocalBatchQueue(batch_max_files, batch_max_bytes, batch_max_wait_seconds)
+
+# every (bucket, key, size, eTag) of the S3 event records, size and eTag are None when the record has none
+def get_event_files(event):
+    return [(record['s3']['bucket']['name'], urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8'),
+             record['s3']['object'].get('size'), record['s3']['object'].get('eTag'))
+            for record in event['Records']]
+
+# the size of the event record is the size of the object the event was sent for. The size of the HEAD is used when the
+# record has none, or when the object was overwritten since the event (its ETag is not the eTag of the record)
+def get_event_file_size(metadata, size, etag):
+    if size is None or metadata.get('ETag', '').strip('"') != (etag or '').strip('"'):
+        return metadata.get('ContentLength', 0)
+    return size
+
+# content_length is only required by COPY for columnar files, it is given when known
+def write_copy_manifest(s3_client, bucket_name, files):
+    entries = []
+    for file_bucket, file_key, size in files:
+        entry = {'url': f's3://{file_bucket}/{file_key}', 'mandatory': True}
+        if size:
+            entry['meta'] = {'content_length': size}
+        entries.append(entry)
+    manifest_key = f'{manifest_prefix}/{datetime.now().strftime("%Y-%m-%dT%H%M%S%f")}.manifest'
+    s3_client.put_object(Bucket=bucket_name, Key=manifest_key, Body=json.dumps({'entries': entries}).encode('utf-8'),
+                         ContentType='application/json')
+    logging.info(f'manifest {manifest_key} written with {len(entries)} files')
+    return manifest_key
+
+def get_copy_query(table, s3_path, aws_access_key_id, aws_secret_access_key, manifest=False, compression=''):
+    return f"""
+    COPY {table}
+    FROM '{s3_path}'
+    FORMAT AS CSV
+    IGNOREHEADER 1
+    delimiter ','
+    DATEFORMAT 'auto'
+    TIMEFORMAT 'auto'
+    {'MANIFEST' if manifest else ''}
+    {compression}
+    access_key_id '{aws_access_key_id}'
+    secret_access_key '{aws_secret_access_key}';
+    """
+
+def get_slice_count(cursor):
+    cursor.execute('SELECT COUNT(*) FROM stv_slices;')
     return int(cursor.fetchone()[0])
 
-def row_copied_to_rs(post_count,pre_count,table_rs):
-    rows_copied = post_count - pre_count
-    logging.info(f'{rows_copied} rows copied to {table_rs}')
+def get_compressor(compression):
+    if compression == 'GZIP':
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if compression == 'ZSTD':
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError(f'unsupported split_compression {compression}')
+
+# One compressed part being streamed to S3, every part starts with the header so IGNOREHEADER 1 holds for each of them
+class CompressedPart:
+    def __init__(self, s3_client, bucket_name, file_key, header, compression):
+        self.file_key = file_key
+        self.compressor = get_compressor(compression)
+        self.writer = S3MultipartWriter(s3_client, bucket_name, file_key)
+        self.raw_size = 0
+        self.write(header)
+
+    def write(self, data):
+        self.raw_size += len(data)
+        self.writer.write(self.compressor.compress(data))
+
+    def close(self):
+        self.writer.write(self.compressor.flush())
+        return self.writer.close()
+
+    def abort(self):
+        self.writer.abort()
+
+# parts of a file of size bytes, at most part_count and none smaller than split_min_part_bytes. part_count is only
+# called for a file larger than split_min_part_bytes, the others have one part.
+def get_split_part_count(size, part_count):
+    if size <= split_min_part_bytes:
+        return 1
+    return max(1, min(part_count(), math.ceil(size / split_min_part_bytes)))
+
+# Cuts the data fed to it into part_count parts of about the same size, a part is closed at the first line end after
+# it reaches its share of the object. The data comes from split_object, or from the validation read of the object.
+class ObjectSplitter:
+    def __init__(self, s3_client, bucket_name, file_key, size, part_count, compression):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.file_key = file_key
+        self.size = size
+        self.part_count = get_split_part_count(size, lambda: part_count)
+        self.compression = compression
+        self.extension = 'gz' if compression == 'GZIP' else 'zst'
+        self.part_prefix = get_split_file_key(file_key).rsplit('.', 1)[0]
+        self.header = None
+        self.pending = b''
+        self.target = None
+        self.parts = []
+        self.part = None
+
+    def start(self, header):
+        self.header = header
+        self.pending = b''
+        self.target = max(1, math.ceil((self.size - len(header)) / self.part_count))
+
+    def feed(self, data):
+        try:
+            if self.header is None:
+                self.pending += data
+                if b'\n' not in self.pending:
+                    return
+                header, newline, data = self.pending.partition(b'\n')
+                self.start(header + newline)
+            self.write(data)
+        except Exception:
+            self.abort()
+            raise
+
+    def new_part(self):
+        return CompressedPart(self.s3_client, self.bucket_name,
+                              f'{self.part_prefix}.part{len(self.parts):04d}.{self.extension}', self.header,
+                              self.compression)
+
+    def write(self, data):
+        while data:
+            if self.part is None:
+                self.part = self.new_part()
+            room = self.target - (self.part.raw_size - len(self.header))
+            cut = data.find(b'\n', max(room - 1, 0)) if len(self.parts) < self.part_count - 1 and len(data) >= room else -1
+            if cut == -1:
+                self.part.write(data)
+                return
+            self.part.write(data[:cut + 1])
+            self.parts.append((self.part.file_key, self.part.close()))
+            self.part = None
+            data = data[cut + 1:]
+
+    # [(part key, compressed size)]
+    def close(self):
+        try:
+            if self.header is None:
+                self.start(self.pending)
+            if self.part is None and not self.parts:
+                self.part = self.new_part()
+            if self.part is not None:
+                self.parts.append((self.part.file_key, self.part.close()))
+                self.part = None
+        except Exception:
+            self.abort()
+            raise
+        logging.info(f'{self.file_key} split into {len(self.parts)} {self.compression} parts')
+        return self.parts
+
+    def abort(self):
+        if self.part is not None:
+            self.part.abort()
+            self.part = None
+        delete_sources(self.s3_client, self.bucket_name, [part_key for part_key, _ in self.parts])
+        self.parts = []
+
+# Streams the object in split_chunk_size chunks into the parts. Returns [(part key, compressed size)].
+def split_object(s3_client, bucket_name, file_key, size, part_count, compression):
+    splitter = ObjectSplitter(s3_client, bucket_name, file_key, size, part_count, compression)
+    body = s3_client.get_object(Bucket=bucket_name, Key=file_key)['Body']
+    try:
+        for chunk in body.iter_chunks(split_chunk_size):
+            splitter.feed(chunk)
+    except Exception:
+        splitter.abort()
+        raise
+    finally:
+        body.close()
+    return splitter.close()
+
+# the parts of a batch file for every slice of the cluster, the slice count is read once per batch
+def get_batch_part_count(cur):
+    slice_count = []
+
+    def part_count():
+        if not slice_count:
+            slice_count.append(get_slice_count(cur))
+        return slice_count[0] * parts_per_slice
+    return part_count
+
+# (bucket, key, size, source url) of the objects the COPY loads, the parts of each batch file when split_mode is on.
+# A file of one part is loaded as it is. split_files has the parts of the files already split while they were validated.
+def get_load_files(s3_client, cur, batch_files, split_files=None):
+    if not split_mode:
+        return [(file_bucket, file_key, size, f's3://{file_bucket}/{file_key}')
+                for file_bucket, file_key, size in batch_files]
+    split_files = dict(split_files or {})
+    part_count = get_batch_part_count(cur)
+    load_files = []
+    try:
+        for file_bucket, file_key, size in batch_files:
+            parts = split_files.pop((file_bucket, file_key), None)
+            if parts is None and get_split_part_count(size, part_count) == 1:
+                load_files.append((file_bucket, file_key, size, f's3://{file_bucket}/{file_key}'))
+                continue
+            if parts is None:
+                parts = split_object(s3_client, file_bucket, file_key, size, part_count(), split_compression)
+            for part_key, part_size in parts:
+                load_files.append((file_bucket, part_key, part_size, f's3://{file_bucket}/{file_key}'))
+    except Exception:
+        remove_split_parts(s3_client, load_files)
+        for (file_bucket, file_key), parts in split_files.items():
+            delete_sources(s3_client, file_bucket, [part_key for part_key, _ in parts])
+        raise
+    return load_files
+
+# {compression: load files} for the COPY of each compression, the files loaded as they are and the split parts
+def get_copy_groups(load_files):
+    groups = {}
+    for file_bucket, file_key, size, source_url in load_files:
+        compression = '' if f's3://{file_bucket}/{file_key}' == source_url else split_compression
+        groups.setdefault(compression, []).append((file_bucket, file_key, size, source_url))
+    return groups
+
+def remove_split_parts(s3_client, load_files):
+    parts = {}
+    for file_bucket, file_key, size, source_url in load_files:
+        if f's3://{file_bucket}/{file_key}' != source_url:
+            parts.setdefault(file_bucket, []).append(file_key)
+    for file_bucket, part_keys in parts.items():
+        delete_sources(s3_client, file_bucket, part_keys)
+
+def get_table_schema(cursor, table_rs):
+    cursor.execute(f"""
+    SELECT column_name, data_type, is_nullable, character_maximum_length
+    FROM information_schema.columns
+    WHERE table_name = '{table_rs}'
+    ORDER BY ordinal_position;
+    """)
+    return [(name, data_type.lower(), is_nullable == 'YES', max_length)
+            for name, data_type, is_nullable, max_length in cursor.fetchall()]
+
+integer_pattern = r'^\s*[-+]?\d+\s*$'
+decimal_pattern = r'^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$'
+boolean_values = ['t', 'f', 'true', 'false', '1', '0', 'y', 'n', 'yes', 'no']
+integer_types = ('smallint', 'integer', 'bigint')
+decimal_types = ('numeric', 'decimal', 'real', 'double precision')
+# the usual layouts recognised by DATEFORMAT and TIMEFORMAT 'auto' of the COPY. Timestamps are a date, optionally
+# followed by a time with or without seconds and a utc offset; fractional seconds, a 'T' separator and a 'Z' are
+# normalised before the formats are tried.
+date_formats = ['%Y-%m-%d', '%Y/%m/%d', '%Y%m%d', '%m/%d/%Y', '%d %b %Y', '%b %d %Y', '%d-%b-%Y']
+time_formats = ['', ' %H:%M:%S', ' %H:%M:%S%z', ' %H:%M', ' %H:%M%z']
+
+def valid_format_mask(column, formats):
+    mask = None
+    for format in formats:
+        valid = pc.is_valid(pc.strptime(column, format=format, unit='s', error_is_null=True))
+        mask = valid if mask is None else pc.or_(mask, valid)
+    return mask
+
+def valid_timestamp_mask(column):
+    column = pc.utf8_trim_whitespace(column)
+    column = pc.replace_substring_regex(column, r'^(\S+)T(\d)', r'\1 \2')
+    column = pc.replace_substring_regex(column, r'(:\d{2})\.\d+', r'\1')
+    column = pc.replace_substring_regex(column, r'\s*Z$', '+00')
+    column = pc.replace_substring_regex(column, r'\s+([-+]\d{2}(:?\d{2})?)$', r'\1')
+    return valid_format_mask(column, [date_format + time_format for date_format in date_formats
+                                      for time_format in time_formats])
+
+# True for every non empty value which COPY can load into the redshift type, values are checked as strings so the
+# bad values can be reported as they are in the file
+def valid_type_mask(column, data_type):
+    if data_type in integer_types:
+        return pc.match_substring_regex(column, integer_pattern)
+    if data_type in decimal_types:
+        return pc.match_substring_regex(column, decimal_pattern)
+    if data_type == 'boolean':
+        return pc.is_in(pc.utf8_lower(pc.utf8_trim_whitespace(column)), value_set=pa.array(boolean_values))
+    if data_type == 'date':
+        return valid_format_mask(pc.utf8_trim_whitespace(column), date_formats)
+    if data_type.startswith('timestamp'):
+        return valid_timestamp_mask(column)
+    return None
+
+class ValidationResult:
+    def __init__(self, file_key):
+        self.file_key = file_key
+        self.rows_checked = 0
+        self.errors = []
+
+    @property
+    def valid(self):
+        return not self.errors
+
+    # (row number, column, value, reason). A row with the wrong number of columns has its line number in the file,
+    # the other rows are numbered among the well formed rows with the header as row 1
+    def add_error(self, row_number, column, value, reason):
+        self.errors.append((row_number, column, value, reason))
+
+# Reads the body for the csv reader and hands every chunk read to on_data as well. The reader reads ahead on its own
+# thread, so on_data is detached under the lock before the caller drops what it got.
+class TeeStream(io.RawIOBase):
+    def __init__(self, body, on_data):
+        self.body = body
+        self.on_data = on_data
+        self.lock = threading.Lock()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        with self.lock:
+            data = self.body.read(len(buffer)) if self.on_data else b''
+            if data:
+                self.on_data(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def detach(self):
+        with self.lock:
+            self.on_data = None
+
+# Streams the object in validation_block_size record batches, so memory stays at about one block, and stops at
+# max_errors bad rows. Every column is read as a string and checked with vectorized compute functions.
+# on_data gets the raw bytes of the object as they are read, the whole object when the file is valid.
+def validate_csv_object(s3_client, bucket_name, file_key, schema, max_errors, on_data=None):
+    result = ValidationResult(file_key)
+    column_names = [name for name, _, _, _ in schema]
+
+    def invalid_row(row):
+        if len(result.errors) < max_errors:
+            result.add_error(row.number, None, row.text[:200],
+                             f'expected {row.expected_columns} columns, got {row.actual_columns}')
+        return 'skip'
+
+    # the header is read on its own so the data can be read with the table columns, all as strings
+    head = s3_client.get_object(Bucket=bucket_name, Key=file_key, Range='bytes=0-65535')['Body'].read()
+    header = next(csv.reader([head.decode('utf-8', errors='replace').split('\n', 1)[0]]), [])
+    if len(header) != len(column_names):
+        result.add_error(1, None, ','.join(header), f'{len(header)} columns in the header, {table} has {len(column_names)}')
+        return result
+
+    body = s3_client.get_object(Bucket=bucket_name, Key=file_key)['Body']
+    stream = TeeStream(body, on_data) if on_data else None
+    try:
+        reader = pa_csv.open_csv(
+            stream or body,
+            read_options=pa_csv.ReadOptions(block_size=validation_block_size, skip_rows=1, column_names=column_names),
+            parse_options=pa_csv.ParseOptions(invalid_row_handler=invalid_row),
+            convert_options=pa_csv.ConvertOptions(column_types={name: pa.string() for name in column_names},
+                                                  strings_can_be_null=False, quoted_strings_can_be_null=False),
+        )
+        for batch in reader:
+            first_row = result.rows_checked + 2
+            result.rows_checked += batch.num_rows
+            for index, (name, data_type, nullable, max_length) in enumerate(schema):
+                column = batch.column(index)
+                empty = pc.equal(pc.utf8_trim_whitespace(column), '')
+                is_text = data_type.startswith('character') or data_type in ('text', 'varchar', 'char')
+                checks = []
+                if not nullable and not is_text:
+                    checks.append((empty, 'null value in a NOT NULL column'))
+                type_mask = valid_type_mask(column, data_type)
+                if type_mask is not None:
+                    checks.append((pc.and_(pc.invert(empty), pc.invert(type_mask)), f'not a valid {data_type}'))
+                if is_text and max_length:
+                    checks.append((pc.greater(pc.binary_length(column), max_length),
+                                   f'longer than {max_length} bytes'))
+                for bad, reason in checks:
+                    for row_index in pc.indices_nonzero(bad).to_pylist():
+                        if len(result.errors) >= max_errors:
+                            return result
+                        result.add_error(first_row + row_index, name, column[row_index].as_py(), reason)
+            if len(result.errors) >= max_errors:
+                return result
+    except pa.ArrowInvalid as e:
+        result.add_error(None, None, None, str(e))
+    finally:
+        if stream:
+            stream.detach()
+        body.close()
+    return result
+
+def get_rejected_file_key(file_key):
+    return file_key.replace('ingestion','rejected')
+
+# Validates every file of the batch, moves the bad files to rejected and returns the files which can be loaded.
+# When split_mode is on the files of more than one part are split from the same read, so they are read once, and
+# {(bucket, key): parts} of the valid files is returned with them.
+def validate_batch_files(s3_client, cur, batch_files):
+    schema = get_table_schema(cur, table)
+    part_count = get_batch_part_count(cur)
+    valid_files = []
+    split_files = {}
+    rejected = {}
+    try:
+        for file_bucket, file_key, size in batch_files:
+            splitter = (ObjectSplitter(s3_client, file_bucket, file_key, size, part_count(), split_compression)
+                        if split_mode and get_split_part_count(size, part_count) > 1 else None)
+            try:
+                result = validate_csv_object(s3_client, file_bucket, file_key, schema, validation_max_errors,
+                                             splitter.feed if splitter else None)
+            except Exception:
+                if splitter:
+                    splitter.abort()
+                raise
+            if result.valid:
+                logging.info(f'{file_key} is valid, {result.rows_checked} rows checked')
+                valid_files.append((file_bucket, file_key, size))
+                if splitter:
+                    split_files[(file_bucket, file_key)] = splitter.close()
+                continue
+            if splitter:
+                splitter.abort()
+            logging.error(f'{file_key} is rejected, {len(result.errors)} bad rows found:')
+            for row_number, column, value, reason in result.errors:
+                logging.error(f'row {row_number} column {column} value {value!r}: {reason}')
+            rejected.setdefault(file_bucket, []).append((file_key, get_rejected_file_key(file_key)))
+        for file_bucket, moves in rejected.items():
+            archive_objects(s3_client, file_bucket, moves)
+    except Exception:
+        for (file_bucket, file_key), parts in split_files.items():
+            delete_sources(s3_client, file_bucket, [part_key for part_key, _ in parts])
+        raise
+    return valid_files, split_files
+
+def get_split_file_key(file_key):
+    return file_key.replace('ingestion','split')
+
+def get_archive_file_key(file_key):
+    return file_key.replace('ingestion','archive')
+
+def get_dead_letter_file_key(file_key):
+    return file_key.replace('ingestion','dead_letter')
+
+# the files of a failed batch which are still in ingestion, a file rejected or archived during the attempt is not
+# loaded again. The objects are checked with a new HEAD, not the cached one of the event.
+def get_unloaded_files(s3_client, batch_files):
+    return [(file_bucket, file_key, size) for file_bucket, file_key, size in batch_files
+            if get_object_metadata(s3_client, file_bucket, file_key, use_cache=False) is not None]
+
+# The rows loaded are read from the COPY itself instead of counting the whole table before and after the COPY.
+# pg_last_copy_count() is the number of rows loaded by the last COPY of the session (pg_last_copy_id()), it is recorded
+# in the transaction of the COPY as the total of the COPY (of the batch, or of its files of one compression). Redshift has no per file row count: rows_loaded is only
+# known for a batch of one file, and lines_scanned stays NULL until stl_load_commits is read after the commit.
+load_audit_table_query = f"""
+    CREATE TABLE IF NOT EXISTS {load_audit_table} (
+        copy_query_id INTEGER,
+        table_name VARCHAR(256),
+        file_key VARCHAR(1024),
+        lines_scanned BIGINT,
+        rows_loaded BIGINT,
+        batch_rows_loaded BIGINT,
+        loaded_at TIMESTAMP DEFAULT GETDATE()
+    );
+"""
+
+# set once the first load of the lambda container is committed, the CREATE is rolled back with a failed load
+load_audit_table_ready = False
+
+def create_load_audit_table(cursor):
+    if not load_audit_table_ready:
+        cursor.execute(load_audit_table_query)
+
+def get_copy_count(cursor):
+    cursor.execute('SELECT pg_last_copy_id(), pg_last_copy_count();')
+    copy_query_id, rows_copied = cursor.fetchone()
+    return int(copy_query_id), int(rows_copied)
+
+def get_copy_file_lines(cursor, copy_query_id):
+    cursor.execute(f"""
+    SELECT TRIM(filename), SUM(lines_scanned)
+    FROM stl_load_commits
+    WHERE query = {copy_query_id}
+    GROUP BY 1;
+    """)
+    return {filename: int(lines) for filename, lines in cursor.fetchall()}
+
+# one row per batch file with the total of the COPY, in the transaction of the COPY
+def record_load_audit(cursor, table_rs, batch_files, copy_query_id, rows_copied):
+    rows = [(copy_query_id, table_rs, f's3://{file_bucket}/{file_key}', None,
+             rows_copied if len(batch_files) == 1 else None, rows_copied)
+            for file_bucket, file_key, size in batch_files]
+    cursor.executemany(f"""
+    INSERT INTO {load_audit_table} (copy_query_id, table_name, file_key, lines_scanned, rows_loaded, batch_rows_loaded)
+    VALUES (%s, %s, %s, %s, %s, %s);
+    """, rows)
+    logging.info(f'{rows_copied} rows copied to {table_rs} by COPY {copy_query_id}')
     return rows_copied
 
-def lambda_handler(event, context):
+# lines_scanned of every batch file (the lines of all the parts of a split file, header lines included), read from
+# stl_load_commits once the COPY is committed. The load is already committed, so a failure only leaves them NULL.
+def update_load_audit_lines(connection, cursor, load_files, copy_query_id):
+    try:
+        file_lines = get_copy_file_lines(cursor, copy_query_id)
+        source_lines = {}
+        for file_bucket, file_key, size, source_url in load_files:
+            lines = file_lines.get(f's3://{file_bucket}/{file_key}')
+            if lines is not None:
+                source_lines[source_url] = source_lines.get(source_url, 0) + lines
+        cursor.executemany(f"""
+        UPDATE {load_audit_table} SET lines_scanned = %s
+        WHERE copy_query_id = %s AND file_key = %s;
+        """, [(lines, copy_query_id, source_url) for source_url, lines in source_lines.items()])
+        connection.commit()
+    except Exception as e:
+        logging.warning(f'lines scanned of COPY {copy_query_id} not recorded: {e}')
+        try:
+            connection.rollback()
+        except Exception as e:
+            logging.warning(f'error rolling back the lines scanned update: {e}')
 
+def lambda_handler(event, context):
     logging.info("Received event: " + json.dumps(event, indent=2))
-    # Get the object from the event and show its content type
-    bucket_name = event['Records'][0]['s3']['bucket']['name']
-    file_key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
-    archive_file_key = file_key.replace('ingestion','archive')
+    # Get the objects from the event, only the first one is loaded when batch_mode is off
+    event_files = get_event_files(event)
+    if not batch_mode:
+        event_files = event_files[:1]
 
     # 0. connecting to AWS S3 
     aws_access_key_id, aws_secret_access_key = get_aws_credentials(aws_credentials_path)
@@ -163,33 +848,59 @@ def lambda_handler(event, context):
                       aws_secret_access_key=aws_secret_access_key, 
                       region_name=region_name)
 
-    # 1. Check if the bucket and csv file exists
-    bucket_exist(s3_client,bucket_name)
-    file_exist(s3_client, bucket_name, file_key)
+    # 1. Check if the bucket and csv file exists. S3 can deliver an event again for a file which was already archived,
+    # a missing file is dropped instead of failing the whole batch. The HEAD is always sent, a cached one could be
+    # older than the archiving of the file
+    found_files = []
+    for bucket_name, file_key, size, etag in event_files:
+        bucket_exist(s3_client,bucket_name)
+        metadata = get_object_metadata(s3_client, bucket_name, file_key, use_cache=False)
+        if metadata is None:
+            logging.error(f'{file_key} is not found in {bucket_name}')
+            continue
+        logging.info(f'{file_key} is found in {bucket_name}')
+        file_format_csv(file_key)
+        # the size decides the number of split parts
+        found_files.append((bucket_name, file_key, get_event_file_size(metadata, size, etag)))
+    event_files = found_files
+    if batch_mode:
+        for bucket_name, file_key, size in event_files:
+            batch_queue.put(bucket_name, file_key, size)
+        if not batch_queue.ready():
+            logging.info(f'{len(batch_queue.files)} files waiting for the next batch')
+            return
+        batch_files = batch_queue.drain()
+    else:
+        batch_files = event_files
+    if not batch_files:
+        logging.error('no file of the event is left in ingestion, nothing is loaded')
+        return
 
-    # 2. Connect to redshift assuming that the redshift
+    failed_files = load_batch(s3_client, batch_files, aws_access_key_id, aws_secret_access_key, redshift_connection)
+    if batch_mode:
+        batch_queue.done([file for file in batch_files if file not in failed_files])
+        if failed_files:
+            given_up = batch_queue.requeue(failed_files)
+            logging.error(f'{len(failed_files) - len(given_up)} files put back in the batch queue for the next invocation')
+            if given_up:
+                logging.error(f'{len(given_up)} files failed {batch_queue.max_attempts} times, moved to dead_letter: '
+                              f'{[file_key for _, file_key, _ in given_up]}')
+                moves = {}
+                for file_bucket, file_key, size in given_up:
+                    moves.setdefault(file_bucket, []).append((file_key, get_dead_letter_file_key(file_key)))
+                for file_bucket, bucket_moves in moves.items():
+                    archive_objects(s3_client, file_bucket, bucket_moves)
 
-    conn = redshift_connector.connect(
-        host=redshift_host,
-        port=redshift_port,
-        database=redshift_database,
-        user=redshift_user,
-        password=redshift_password
-    )
+# Steps 2 to 9 for a batch of (bucket, key, size). Returns [] once the batch is loaded and archived (or all its files
+# are rejected), and the files of the batch still left in ingestion when the load failed.
+def load_batch(s3_client, batch_files, aws_access_key_id, aws_secret_access_key, connection):
+    global load_audit_table_ready
+    bucket_name = batch_files[0][0]
 
-    # 3. Create a cursor
-    cur = conn.cursor()
-    
     # prepare the queries
-    copy_query = f"""
-    COPY {table}
-    FROM 's3://{bucket_name}/{file_key}'
-    FORMAT AS CSV
-    IGNOREHEADER 1
-    delimiter ','
-    access_key_id '{aws_access_key_id}'
-    secret_access_key '{aws_secret_access_key}';
-    """
+    conn = cur = None
+    manifest_keys = []
+    load_files = []
 
     table_exist_query = f"""
     SELECT EXISTS (
@@ -199,45 +910,192 @@ def lambda_handler(event, context):
     );
     """
 
-    table_count_query = f"""
-    SELECT count(1)
-    FROM {table}
-    ;
-    """
 
     try:
-        table_exists(cur, table_exist_query)
+        # 2. Connect to redshift assuming that the redshift
+        # the connection of a previous warm invocation is reused when it is still alive, and opened again once when
+        # it fails the first query
+        # 3. Create a cursor
+        conn, cur = open_cursor(connection, lambda cur: table_exists(cur, table_exist_query))
+        logging.info(f'redshift connection metrics: {connection.metrics()}')
+        create_load_audit_table(cur)
+
+        # 3.0 validate the files and reject the bad ones before any COPY
+        split_files = {}
+        if validation_mode:
+            batch_files, split_files = validate_batch_files(s3_client, cur, batch_files)
+            if not batch_files:
+                logging.error('no valid file left in the batch, nothing is loaded')
+                conn.rollback()
+                return []
+
+        # 3.1 split the files into compressed parts for every slice of the cluster, the validated files are already split
+        # a batch of files (or parts) is loaded from a manifest in a single COPY, one per compression
+        load_files = get_load_files(s3_client, cur, batch_files, split_files)
+        copies = []
+        for compression, copy_files in get_copy_groups(load_files).items():
+            if len(copy_files) > 1:
+                manifest_key = write_copy_manifest(s3_client, bucket_name,
+                                                   [(file_bucket, file_key, size) for file_bucket, file_key, size, _ in copy_files])
+                manifest_keys.append(manifest_key)
+                copy_query = get_copy_query(table, f's3://{bucket_name}/{manifest_key}',
+                                            aws_access_key_id, aws_secret_access_key, manifest=True, compression=compression)
+            else:
+                copy_query = get_copy_query(table, f's3://{bucket_name}/{copy_files[0][1]}',
+                                            aws_access_key_id, aws_secret_access_key, compression=compression)
+
+            # 4. Copy query with credentials
+            cur.execute(copy_query)
+
+            # 6. Get the row copied to redshift for checking purposes, recorded with the load in the same transaction
+            copy_query_id, rows_copied = get_copy_count(cur)
+            source_urls = {source_url for _, _, _, source_url in copy_files}
+            record_load_audit(cur, table, [(file_bucket, file_key, size) for file_bucket, file_key, size in batch_files
+                                           if f's3://{file_bucket}/{file_key}' in source_urls],
+                              copy_query_id, rows_copied)
+            copies.append((copy_query_id, copy_files))
 
-        pre_row_count = count_row_table(cur,table_count_query)
-        
-        # 4. Copy query with credentials
-        cur.execute(copy_query)
         # 5. Commit the transaction
         conn.commit()
-        post_row_count = count_row_table(cur,table_count_query)
-
-        # 6. Get the row copied to redshift for checking purposes
-        row_copied_to_rs(post_row_count,pre_row_count,table)
+        load_audit_table_ready = True
+        for copy_query_id, copy_files in copies:
+            update_load_audit_lines(conn, cur, copy_files, copy_query_id)
         # 7. Move the CSV file from demo/ingestion to demo/archives to prevent double extraction, and keep the raw file in archive
 
-        # 8. Move the object to archive
-        move_object(s3_client,bucket_name, file_key, archive_file_key)
+        # 8. Move the objects (and their manifest) to archive as a group, only once the batch is committed
+        # the copies run in parallel and the sources are deleted together once every copy is verified
+        moves = {}
+        for file_bucket, file_key, size in batch_files:
+            moves.setdefault(file_bucket, []).append((file_key, get_archive_file_key(file_key)))
+        for manifest_key in manifest_keys:
+            archive_manifest_key = manifest_key.replace(manifest_prefix, f'{manifest_prefix}/archive', 1)
+            moves.setdefault(bucket_name, []).append((manifest_key, archive_manifest_key))
+        for file_bucket, bucket_moves in moves.items():
+            archive_objects(s3_client, file_bucket, bucket_moves)
+        # the parts are only a copy of the archived files
+        remove_split_parts(s3_client, load_files)
 
         logging.info("Data loaded from S3 to Redshift successfully.")
+        return []
     except Exception as e:
         logging.error("Error: Failed to copy data from S3 to Redshift.")
         logging.error(e)
+        # the batch is not archived, its files stay in ingestion to be replayed
+        logging.error(f'{len(batch_files)} files were not loaded: {[file_key for _, file_key, _ in batch_files]}')
+        try:
+            if conn is not None:
+                conn.rollback()
+        except Exception:
+            # the connection itself is broken, the next invocation reconnects
+            connection.close()
+        remove_split_parts(s3_client, load_files)
+        return get_unloaded_files(s3_client, batch_files)
+    finally:
+        # 9. Close the cursor, the connection stays open for the next warm invocation
+        if cur is not None:
+            cur.close()
+
+
+def get_partition_prefix(day):
+    return f'{ingestion_prefix}/year={day:%Y}/month={day:%m}/day={day:%d}/'
+
+def read_checkpoint(checkpoint_path):
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            return json.load(f)
+    return {'completed_partitions': []}
+
+# the checkpoint is written to a temporary file and renamed, so an interrupted run never leaves a partial checkpoint
+def write_checkpoint(checkpoint_path, checkpoint):
+    temporary_path = f'{checkpoint_path}.tmp'
+    with open(temporary_path, 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(temporary_path, checkpoint_path)
+
+# s3 urls of the files already recorded in the load audit table
+def get_loaded_files(cursor, table_rs):
+    if not load_audit_table_ready:
+        create_load_audit_table(cursor)
+    cursor.execute(f"""
+    SELECT DISTINCT file_key
+    FROM {load_audit_table}
+    WHERE table_name = '{table_rs}';
+    """)
+    return {file_key for file_key, in cursor.fetchall()}
+
+# Backfill: loads every csv under the ingestion partitions (year=/month=/day=) from start_date to end_date, one batch
+# per partition and backfill_max_workers partitions at a time, each worker with its own redshift connection.
+# A completed partition is written to the checkpoint, so an interrupted run starts again from the partitions left.
+# A file already in the load audit table (loaded by a run which stopped before archiving it) is only archived.
+def backfill(bucket_name, start_date, end_date, max_workers=None, checkpoint_path=None):
+    max_workers = max_workers or backfill_max_workers
+    checkpoint_path = checkpoint_path or backfill_checkpoint_path
+    aws_access_key_id, aws_secret_access_key = get_aws_credentials(aws_credentials_path)
+    s3_client = boto3.client('s3', aws_access_key_id=aws_access_key_id,
+                      aws_secret_access_key=aws_secret_access_key,
+                      region_name=region_name)
+    bucket_exist(s3_client, bucket_name)
+
+    checkpoint = read_checkpoint(checkpoint_path)
+    completed = set(checkpoint['completed_partitions'])
+    days = [start_date + timedelta(days=offset) for offset in range((end_date - start_date).days + 1)]
+    partitions = [get_partition_prefix(day) for day in days if get_partition_prefix(day) not in completed]
+    logging.info(f'{len(partitions)} partitions to backfill, {len(days) - len(partitions)} already in {checkpoint_path}')
+
+    connection = RedshiftConnectionManager(connect_redshift, connection_idle_check_seconds, connection_max_age_seconds)
+    cur = connection.get().cursor()
+    try:
+        loaded_files = get_loaded_files(cur, table)
     finally:
-        # 9. Close the cursor and connection
         cur.close()
-        conn.close()
+        connection.close()
+
+    checkpoint_lock = threading.Lock()
+    worker_connections = threading.local()
+    all_connections = []
+
+    def load_partition(prefix):
+        if not hasattr(worker_connections, 'connection'):
+            worker_connections.connection = RedshiftConnectionManager(connect_redshift, connection_idle_check_seconds,
+                                                                      connection_max_age_seconds)
+            all_connections.append(worker_connections.connection)
+        index = list_keys(s3_client, bucket_name, prefix)
+        keys = sorted(key for key in index if key.endswith('.csv'))
+        done = [key for key in keys if f's3://{bucket_name}/{key}' in loaded_files]
+        if done:
+            logging.info(f'{len(done)} files under {prefix} are already loaded, archiving them')
+            archive_objects(s3_client, bucket_name, [(key, get_archive_file_key(key)) for key in done])
+        batch_files = [(bucket_name, key, index[key]['Size']) for key in keys if key not in done]
+        if batch_files and load_batch(s3_client, batch_files, aws_access_key_id, aws_secret_access_key,
+                                      worker_connections.connection):
+            return False
+        with checkpoint_lock:
+            checkpoint['completed_partitions'].append(prefix)
+            write_checkpoint(checkpoint_path, checkpoint)
+        logging.info(f'{prefix} backfilled with {len(batch_files)} files')
+        return True
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(load_partition, partitions))
+    finally:
+        for worker_connection in all_connections:
+            worker_connection.close()
+    failed = [prefix for prefix, ok in zip(partitions, results) if not ok]
+    logging.info(f'backfill done, {len(partitions) - len(failed)} partitions loaded, {len(failed)} failed: {failed}')
+    return failed
 
 
 # uncomment this section for exact lambda usage on AWS
 if __name__ == '__main__':
+    # backfill a date range: python "question 2.py" backfill <bucket_name> 2023-09-01 2023-09-30
+    if len(sys.argv) == 5 and sys.argv[1] == 'backfill':
+        backfill(sys.argv[2], date.fromisoformat(sys.argv[3]), date.fromisoformat(sys.argv[4]))
+        sys.exit(0)
     # mock a fake event to lambda_handler
     # 0. lambda listen to S3 event
     file = open('fake_event.json')
     fake_event = json.load(file)
     logging.info(fake_event)
-    lambda_handler(fake_event, 'context')
\ No newline at end of file
+    lambda_handler(fake_event, 'context')
+    redshift_connection.close()
\ No newline at end of file
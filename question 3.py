@@ -13,6 +13,7 @@
 
 # Assumption: 
 # - Assume the script is standalone not linked to other scripts. some of the functions are repeated in other questions. Importing function would be a good practice.
+# - s3_metadata.py, s3_archive.py, s3_multipart.py and s3_partitions.py are deployed with the script, the bucket and file checks and the archiving are shared with the other questions
 # - Assume that eventbridge has schedule to trigger lambda daily at specific time, 3am  cron(0 0 19 1/1 * ? *)
 # - Data require small-medium workload (up to 1 million) and in CSV format. Else, Glue will be a better option.
 # - This is a batch ETL not streaming (real-time) ETL
@@ -26,20 +27,42 @@
 # Step 0. lambda schedule for daily extraction. The schedule comes on 3am to avoid heavy compution during daytime.
 # Step 1. Connect API and S3 and check API connection
 # Step 2. check for if bucket and file exist
-# Step 3. Call the API to get the reponse
+# Step 3. Call the API to get the reponse, concurrently for each date_time window when backfilling a range
+# Step 3a. skip the windows not modified or with the same items as the last fetch, the run stops if nothing changed
+# Step 3-6 in streaming_mode: parse the items as they arrive and upload them as parquet row groups of a multipart upload
 # Step 4. pandas to do the transformation
 # Step 5. convert dataframe to parquet for compression
-# Step 6. load the parquet to S3
+# Step 6. load the parquet to S3, under the year=/month=/day=/hour= partition of the event timestamp of the rows
+# Step 6a. list the new files with their row counts and min/max timestamps in the partition manifest
+# Compaction (scheduled apart from the lambda): merge the small files of each partition into sorted files of a target size
 ##################################################################################################################################################################
 
-import requests
-from datetime import datetime
+import aiohttp
+import asyncio
+import ijson
+import random
+import time
+from datetime import datetime, timedelta
 import os
 import logging
 import boto3
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import configparser
 import json
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import hashlib
+from urllib.parse import urlencode
+from botocore.exceptions import ClientError
+from s3_metadata import bucket_exist, invalidate, list_keys
+from s3_archive import delete_sources
+from s3_multipart import S3MultipartWriter
+from s3_partitions import (parse_event_time, get_partition, get_partition_prefix, get_manifest_key, read_manifest,
+                           update_manifest, prune_partitions)
 
 
 # Set up AWS credentials (ensure AWS CLI or environment variables are configured)
@@ -62,7 +85,62 @@ aws_credentials_path = '~/.aws/credentials'
 # specifiy the URL. For this question 10 example, we will use a actual api for get request (API is about Singapore PSI)
 # change the URL to fit to the testing
 URL = 'https://api.data.gov.sg/v1/environment/pm25'
-key_prefix = 'demo/ingestion/year=2023/month=09/day=15/'
+# The parquet files are written under hive partitions year=/month=/day=/hour= of the event timestamp of their rows,
+# and listed with their row counts and min/max timestamps in the manifest of key_prefix (see s3_partitions.py)
+key_prefix = 'demo/ingestion/pm25'
+event_time_column = 'timestamp'
+
+# API extraction: date_time windows are fetched concurrently over one pooled session.
+# api_concurrency caps the requests in flight, api_rate_per_second and api_burst set the token bucket rate limit,
+# failed requests (connection errors, timeouts, 429 and 5xx) are retried api_max_retries times with exponential backoff
+api_concurrency = 8
+api_rate_per_second = 5
+api_burst = 5
+api_max_retries = 5
+api_backoff_seconds = 0.5
+api_timeout_seconds = 30
+api_retry_status = (429, 500, 502, 503, 504)
+
+# Streaming: items are parsed one at a time from the API responses and written as parquet row groups of
+# parquet_row_group_size rows straight into a multipart upload, so memory stays at about one row group.
+# The columns of the parquet are fixed by item_schema, keys of the items which are not in it are dropped.
+streaming_mode = True
+parquet_row_group_size = 50000
+# the parquet writes and part uploads run on one writer thread, off the event loop, and the items of a response are
+# handed to it stream_batch_items at a time
+stream_batch_items = 1000
+# every open file buffers up to a row group and an upload part, so at most max_open_writers files are open at a time.
+# The least recently used file is closed to open a new one, and a later item of its partition opens the next file.
+max_open_writers = 16
+item_schema = pa.schema([
+    ('timestamp', pa.string()),
+    ('update_timestamp', pa.string()),
+    ('readings.pm25_one_hourly.west', pa.int64()),
+    ('readings.pm25_one_hourly.east', pa.int64()),
+    ('readings.pm25_one_hourly.central', pa.int64()),
+    ('readings.pm25_one_hourly.south', pa.int64()),
+    ('readings.pm25_one_hourly.north', pa.int64()),
+    ('created_date_time', pa.string()),
+])
+
+# Dedupe: the ETag/Last-Modified and a hash of the items of every fetch are kept in a json state object in the bucket,
+# keyed by the url and the parameters. The next fetch sends If-None-Match/If-Modified-Since, and a 304 or items with
+# the same hash as last time are skipped, so an unchanged snapshot is neither transformed nor written to S3.
+# In streaming_mode the raw items of a window are spooled while it is hashed, in memory up to window_spool_memory_bytes
+# and in a temporary file past it, and only a changed window is replayed into the parquet writers.
+dedupe_mode = True
+fetch_state_key = 'demo/state/api_fetch_state.json'
+window_spool_memory_bytes = 8 * 1024 * 1024
+
+# Compaction: the files of a partition smaller than compaction_small_file_bytes are merged, sorted by
+# compaction_sort_key so the row group min/max statistics prune well, into files of about compaction_target_bytes.
+# Only the files listed in the manifest are compacted, a partition needs at least compaction_min_files small files,
+# and compaction_max_workers partitions are compacted at a time.
+compaction_target_bytes = 128 * 1024 * 1024
+compaction_small_file_bytes = 32 * 1024 * 1024
+compaction_min_files = 2
+compaction_sort_key = 'timestamp'
+compaction_max_workers = 4
 
 logging.basicConfig(level = logging.INFO)
 
@@ -77,20 +155,6 @@ def get_aws_credentials(aws_credentials_path):
     else:
         logging.error(f'{config_path[0]} is not a aws config file')
 
-def bucket_exist(client,bucket_name):
-    buckets = client.list_buckets()['Buckets']
-    for bucket in buckets:
-        if bucket['Name'] == bucket_name:
-            logging.info(f'This bucket {bucket_name} is found')
-        else:
-            logging.error(f'This bucket {bucket_name} is not found...')
-
-def file_exist(client, bucket_name, file_key):
-    keys = client.list_objects_v2(Bucket=bucket_name)['Contents']
-    for key in keys:
-        if key['Key'] == file_key:
-            logging.info(f'{file_key} is found in {bucket_name}')
-
 def file_format_parquet(file_key):
     file_extension = file_key.split('.')[-1]
     if file_extension == 'parquet':
@@ -98,32 +162,403 @@ def file_format_parquet(file_key):
     else:
         logging.error(f'{file_key} is not parquet file')
 
-def move_object(client,bucket_name,source_file_key,destination_file_key):\
-    # copy the object to destination location
-    client.copy_object(
-    CopySource={'Bucket': bucket_name, 'Key': source_file_key},
-    Bucket=bucket_name,
-    Key=destination_file_key
-    )
-
-    # delete the object from the source location
-    client.delete_object(Bucket=bucket_name, Key=source_file_key)
-
-    logging.info(f'S3 object moved from {source_file_key} to {destination_file_key}')
 def get_datetime_now():
     return datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
 
-def PARAMS():
-    date_time = get_datetime_now()
+def PARAMS(date_time=None):
+    date_time = date_time or get_datetime_now()
     return {'date_time':date_time}
 
-def request(url,parameters):
-    r = requests.get(url,params=parameters)
-    if r.status_code == 200:
-        logging.info(f'successful API {r.status_code}')
-        return r
-    else:
-        logging.error(f'error API {r.status_code}')
+# PARAMS for every step between start and end (both datetime), e.g. every hour of a month for a backfill
+def get_date_time_windows(start, end, step=timedelta(hours=1)):
+    windows = []
+    while start <= end:
+        windows.append(PARAMS(start.strftime("%Y-%m-%dT%H:%M:%S")))
+        start += step
+    return windows
+
+# Token bucket shared by all the requests, a request waits for a token so no more than rate requests per second
+# (after a burst of capacity requests) reach the API
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def get_backoff_seconds(attempt, retry_after=None):
+    if retry_after is not None and retry_after.isdigit():
+        return float(retry_after)
+    return api_backoff_seconds * 2 ** attempt * (1 + random.random())
+
+async def read_json(r, index, parameters):
+    return await r.json()
+
+# the validators of a response, sent back as If-None-Match/If-Modified-Since by the next fetch
+def get_validators(r):
+    return {name: r.headers[name] for name in ('ETag', 'Last-Modified') if name in r.headers}
+
+# raised by a read_response when the api_info status of the response is not healthy, the window is failed
+class UnhealthyResponse(Exception):
+    pass
+
+# (status, validators, result of read_response) of a window, status is None when the window failed
+async def fetch_window(session, url, index, parameters, semaphore, token_bucket, read_response=read_json, headers=None):
+    for attempt in range(api_max_retries + 1):
+        retry_after = None
+        async with semaphore:
+            await token_bucket.acquire()
+            try:
+                async with session.get(url, params=parameters, headers=headers) as r:
+                    if r.status == 200:
+                        logging.info(f'successful API {r.status} {parameters}')
+                        try:
+                            return r.status, get_validators(r), await read_response(r, index, parameters)
+                        except UnhealthyResponse as e:
+                            logging.error(f'{e}, the window is skipped')
+                            return None, {}, None
+                    if r.status == 304:
+                        logging.info(f'API not modified {parameters}')
+                        return r.status, get_validators(r), None
+                    if r.status not in api_retry_status:
+                        logging.error(f'error API {r.status} {parameters}')
+                        return None, {}, None
+                    retry_after = r.headers.get('Retry-After')
+                    logging.warning(f'API {r.status} for {parameters}, attempt {attempt + 1}')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.warning(f'API request failed for {parameters}, attempt {attempt + 1}: {e!r}')
+        if attempt < api_max_retries:
+            await asyncio.sleep(get_backoff_seconds(attempt, retry_after))
+    logging.error(f'error API {parameters} failed after {api_max_retries + 1} attempts')
+    return None, {}, None
+
+# headers_list gives the request headers of every window, on_window(index, status, validators, result) is awaited
+# as soon as a window is done
+async def fetch_windows(url, windows, read_response=read_json, headers_list=None, on_window=None):
+    semaphore = asyncio.Semaphore(api_concurrency)
+    token_bucket = TokenBucket(api_rate_per_second, api_burst)
+    connector = aiohttp.TCPConnector(limit=api_concurrency)
+    timeout = aiohttp.ClientTimeout(total=api_timeout_seconds)
+    headers_list = headers_list or [None] * len(windows)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        async def fetch(index, parameters):
+            response = await fetch_window(session, url, index, parameters, semaphore, token_bucket, read_response,
+                                          headers_list[index])
+            if on_window is not None:
+                await on_window(index, *response)
+            return response
+        return await asyncio.gather(*(fetch(index, parameters) for index, parameters in enumerate(windows)))
+
+# [(parameters, status, validators, json response or None)] for every window, in the order of the windows.
+# The url can point to a local stub server for testing.
+def extract(url, windows, headers_list=None):
+    responses = asyncio.run(fetch_windows(url, windows, headers_list=headers_list))
+    return [(parameters, *response) for parameters, response in zip(windows, responses)]
+
+# Parses the items of a response one at a time from the HTTP stream and hands them to on_items(index, items) in
+# batches of stream_batch_items. A response which breaks after some of its items were handed over cannot be retried
+# without duplicates, so it fails the extraction instead. A response whose api_info status is not healthy fails
+# its window only, like get_body_reponse does for the non streaming path.
+def stream_items_reader(on_items):
+    async def read_items(r, index, parameters):
+        emitted = 0
+        status = None
+        builder = None
+        items = []
+        try:
+            async for prefix, event, value in ijson.parse_async(r.content, use_float=True):
+                if prefix == 'items.item' and event == 'start_map':
+                    builder = ijson.ObjectBuilder()
+                if builder is not None:
+                    builder.event(event, value)
+                    if prefix == 'items.item' and event == 'end_map':
+                        items.append(builder.value)
+                        builder = None
+                        if len(items) >= stream_batch_items:
+                            await on_items(index, items)
+                            emitted += len(items)
+                            items = []
+                elif prefix == 'api_info.status':
+                    status = value
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if emitted:
+                raise RuntimeError(f'API response for {parameters} broke after {emitted} items') from e
+            raise
+        if items:
+            await on_items(index, items)
+            emitted += len(items)
+        if status != 'healthy':
+            raise UnhealthyResponse(f'API status is {status} for {parameters}')
+        return emitted
+    return read_items
+
+# streams the items of every window to on_item(index, item) and calls on_window(index, status, validators, number
+# of items) once a window is done, status is None for a failed window. Both run on one writer thread in the order
+# the items arrive, so the writes and uploads never block the event loop.
+def extract_items(url, windows, on_item, headers_list=None, on_window=None):
+    def add_items(index, items):
+        for item in items:
+            on_item(index, item)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        async def run():
+            loop = asyncio.get_running_loop()
+
+            async def on_items(index, items):
+                await loop.run_in_executor(executor, add_items, index, items)
+
+            async def on_window_done(index, status, validators, item_count):
+                if on_window is not None:
+                    await loop.run_in_executor(executor, on_window, index, status, validators, item_count)
+
+            return await fetch_windows(url, windows, stream_items_reader(on_items), headers_list, on_window_done)
+        return asyncio.run(run())
+
+# sha256 of the items with sorted keys, so the same readings give the same hash whatever the order of the json keys.
+# It is updated one item at a time, so a streamed window is hashed without holding its items.
+class ItemsHash:
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+
+    def update(self, item):
+        self.sha256.update(json.dumps(item, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8'))
+        self.sha256.update(b'\n')
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+def get_items_hash(items):
+    items_hash = ItemsHash()
+    for item in items:
+        items_hash.update(item)
+    return items_hash.hexdigest()
+
+# The raw items of a streamed window, hashed as they arrive and kept as json lines until the window is known to be
+# changed. The SpooledTemporaryFile moves to disk past max_memory_bytes, so a large window does not grow the memory.
+class WindowSpool:
+    def __init__(self, max_memory_bytes):
+        self.items_hash = ItemsHash()
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_memory_bytes, mode='w+b')
+
+    def add(self, item):
+        self.items_hash.update(item)
+        self.file.write(json.dumps(item, separators=(',', ':')).encode('utf-8'))
+        self.file.write(b'\n')
+
+    def hexdigest(self):
+        return self.items_hash.hexdigest()
+
+    def items(self):
+        self.file.seek(0)
+        for line in self.file:
+            yield json.loads(line)
+
+    def close(self):
+        self.file.close()
+
+# Fetch state of every (url, parameters) kept as one json object in S3:
+# {state key: {'ETag', 'Last-Modified', 'content_hash', 'updated_date_time'}}
+class FetchStateStore:
+    def __init__(self, s3_client, bucket_name, file_key):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.file_key = file_key
+        self.state = self.load()
+        self.pending = {}
+
+    def load(self):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.file_key)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            return {}
+        return json.loads(response['Body'].read())
+
+    # the scheduled run asks for now, whose date_time changes every run, so it is kept under the url alone
+    @staticmethod
+    def get_state_key(url, parameters=None):
+        if not parameters:
+            return url
+        return f'{url}?{urlencode(sorted(parameters.items()))}'
+
+    def get_headers(self, state_key):
+        entry = self.state.get(state_key, {})
+        headers = {}
+        if entry.get('ETag'):
+            headers['If-None-Match'] = entry['ETag']
+        if entry.get('Last-Modified'):
+            headers['If-Modified-Since'] = entry['Last-Modified']
+        return headers
+
+    def unchanged(self, state_key, content_hash):
+        return self.state.get(state_key, {}).get('content_hash') == content_hash
+
+    # staged until commit, so a snapshot whose upload fails is fetched again on the next run
+    def update(self, state_key, validators, content_hash):
+        self.pending[state_key] = {**validators, 'content_hash': content_hash, 'updated_date_time': get_datetime_now()}
+
+    def commit(self):
+        if not self.pending:
+            return
+        self.state.update(self.pending)
+        self.s3_client.put_object(Bucket=self.bucket_name, Key=self.file_key,
+                                  Body=json.dumps(self.state, indent=2).encode('utf-8'), ContentType='application/json')
+        invalidate(self.bucket_name, self.file_key)
+        logging.info(f'fetch state of {len(self.pending)} windows saved to {self.file_key}')
+        self.pending = {}
+
+# flattened like pd.json_normalize, e.g. {'readings': {'pm25_one_hourly': {'west': 10}}} gives
+# {'readings.pm25_one_hourly.west': 10}
+def flatten_item(item, prefix=''):
+    flat = {}
+    for key, value in item.items():
+        if isinstance(value, dict):
+            flat.update(flatten_item(value, f'{prefix}{key}.'))
+        else:
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+# Buffers flattened items and writes them as parquet row groups with item_schema into a multipart upload
+class ParquetStreamWriter:
+    def __init__(self, s3_client, bucket_name, file_key, schema, row_group_size):
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.sink = S3MultipartWriter(s3_client, bucket_name, file_key, content_type='parquet')
+        self.writer = pq.ParquetWriter(self.sink, schema)
+        self.rows = []
+        self.row_count = 0
+        self.created_date_time = get_datetime_now()
+
+    def add(self, item):
+        self.rows.append(flatten_item(item))
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = [name for name in self.schema.names if name != 'created_date_time']
+        df = pd.DataFrame.from_records(self.rows, columns=columns)
+        # create timestamp for audit purpose
+        df['created_date_time'] = self.created_date_time
+        df = transformation_function(df)
+        self.writer.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+        self.row_count += len(self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        self.sink.close()
+        return self.row_count
+
+    def abort(self):
+        self.rows = []
+        self.sink.abort()
+
+# Routes every item to the ParquetStreamWriter of its group (the API window it comes from) and of the partition of its
+# event timestamp, a file is opened the first time one of their items arrives. The files of a group are closed together
+# once the window is kept (close_group), or dropped when it is not (abort_group), e.g. when the window failed.
+# Keeps the row count and min/max timestamps of every file for the manifest.
+class PartitionedParquetWriter:
+    def __init__(self, s3_client, bucket_name, key_prefix, schema, row_group_size, now, max_writers=None):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key_prefix = key_prefix
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.now = now
+        self.max_writers = max_writers
+        # {(group, partition): open writer}, the least recently used first
+        self.writers = OrderedDict()
+        # {file_key: stats} of every file opened, and the number of files opened in every partition
+        self.files = {}
+        self.partition_files = {}
+
+    def add(self, item, group=None):
+        timestamp = item[event_time_column]
+        event_time = parse_event_time(timestamp)
+        partition = get_partition(event_time)
+        writer = self.writers.get((group, partition))
+        if writer is not None:
+            self.writers.move_to_end((group, partition))
+        else:
+            if self.max_writers and len(self.writers) >= self.max_writers:
+                self.close_writer(next(iter(self.writers)))
+            part = self.partition_files.get(partition, 0)
+            self.partition_files[partition] = part + 1
+            file_key = get_ingestion_key_parquet_path(self.bucket_name, self.key_prefix, partition, self.now, part)
+            writer = self.writers[(group, partition)] = ParquetStreamWriter(self.s3_client, self.bucket_name, file_key,
+                                                                            self.schema, self.row_group_size)
+            self.files[file_key] = {'group': group, 'partition': partition, 'rows': 0, 'closed': False,
+                                    'min_timestamp': timestamp, 'max_timestamp': timestamp,
+                                    'min_event_time': event_time, 'max_event_time': event_time}
+        stats = self.files[writer.sink.file_key]
+        stats['rows'] += 1
+        if event_time < stats['min_event_time']:
+            stats['min_timestamp'], stats['min_event_time'] = timestamp, event_time
+        if event_time > stats['max_event_time']:
+            stats['max_timestamp'], stats['max_event_time'] = timestamp, event_time
+        writer.add(item)
+
+    # the file is uploaded but stays part of its group, it is deleted if the group is dropped later
+    def close_writer(self, key):
+        writer = self.writers.pop(key)
+        try:
+            writer.close()
+        except Exception:
+            writer.abort()
+            del self.files[writer.sink.file_key]
+            raise
+        self.files[writer.sink.file_key]['closed'] = True
+
+    # uploads the files of the group, they are all dropped when one of them fails to close
+    def close_group(self, group):
+        try:
+            for key in [key for key in self.writers if key[0] == group]:
+                self.close_writer(key)
+        except Exception:
+            self.abort_group(group)
+            raise
+
+    # aborts the open files of the group and deletes the ones already closed
+    def abort_group(self, group):
+        for key in [key for key in self.writers if key[0] == group]:
+            self.writers.pop(key).abort()
+        file_keys = [file_key for file_key, stats in self.files.items() if stats['group'] == group]
+        delete_sources(self.s3_client, self.bucket_name, [file_key for file_key in file_keys if self.files[file_key]['closed']])
+        for file_key in file_keys:
+            del self.files[file_key]
+
+    # {file_key: {'partition', 'rows', 'min_timestamp', 'max_timestamp'}} of the files written. When a file fails to
+    # close, every file is dropped so no partition is left half written.
+    def close(self):
+        try:
+            for group in {group for group, _ in self.writers}:
+                self.close_group(group)
+        except Exception:
+            self.abort()
+            raise
+        return {file_key: {name: stats[name] for name in ('partition', 'rows', 'min_timestamp', 'max_timestamp')}
+                for file_key, stats in self.files.items()}
+
+    def abort(self):
+        for group in {stats['group'] for stats in self.files.values()}:
+            self.abort_group(group)
 
 def get_body_reponse(response):
     if response['api_info']['status'] == 'healthy':
@@ -140,9 +575,11 @@ def transformation_function(df):
     # do transformation here
     return df
 
-def get_ingestion_key_parquet_path(bucket, key_prefix, now):
-    # obtain the s3 path to the parquet
-    path = f'{key_prefix}/{datetime.now().strftime("%Y-%m-%d")}/transformed_{now}.parquet'
+def get_ingestion_key_parquet_path(bucket, key_prefix, partition, now, part=0):
+    # obtain the s3 path to the parquet in the partition of its rows, the next files of a run in the same partition
+    # are numbered
+    name = f'transformed_{now}' if not part else f'transformed_{now}-{part:04d}'
+    path = f'{get_partition_prefix(key_prefix, partition)}/{name}.parquet'
     logging.info(f'{path} will be stored in {bucket}')
     return path
 
@@ -165,10 +602,111 @@ def lambda_handler(event, context):
     datetime_now = get_datetime_now()
     try:
         # 3. Call an API to get a response
-        r = request(URL,PARAMS())
-        content = r.json()
-        data = get_body_reponse(content)
-        items = data['items']
+        # an event with start_date_time and end_date_time backfills every hour of the range, else only now is fetched
+        if 'start_date_time' in event:
+            windows = get_date_time_windows(datetime.fromisoformat(event['start_date_time']),
+                                            datetime.fromisoformat(event['end_date_time']))
+            state_keys = [FetchStateStore.get_state_key(URL, parameters) for parameters in windows]
+        else:
+            windows = [PARAMS()]
+            state_keys = [FetchStateStore.get_state_key(URL)]
+
+        # 3a. conditional requests with the validators of the last fetch of every window
+        fetch_state = FetchStateStore(s3_client, bucket_name, fetch_state_key) if dedupe_mode else None
+        headers_list = [fetch_state.get_headers(state_key) for state_key in state_keys] if dedupe_mode else None
+
+        # windows which failed or were unchanged, for the log when nothing is written
+        skipped = {'failed': 0, 'unchanged': 0}
+
+        # items of a window are kept only when the window is not modified (no 304) and their hash changed
+        def keep_window(index, status, validators, content_hash):
+            if status is None:
+                logging.error(f'no healthy response for {windows[index]}')
+                skipped['failed'] += 1
+                return False
+            if not dedupe_mode:
+                return status == 200
+            if status == 304:
+                skipped['unchanged'] += 1
+                return False
+            changed = not fetch_state.unchanged(state_keys[index], content_hash)
+            if not changed:
+                logging.info(f'items of {windows[index]} unchanged since the last fetch, skipped')
+                skipped['unchanged'] += 1
+            # the validators are refreshed either way, so the next fetch of unchanged items can get a 304
+            fetch_state.update(state_keys[index], validators, content_hash)
+            return changed
+
+        def log_nothing_written():
+            if skipped['unchanged']:
+                logging.info(f"API snapshot unchanged for {skipped['unchanged']} windows, nothing written to S3")
+            if skipped['failed']:
+                logging.error(f"{skipped['failed']} of {len(windows)} windows failed, nothing written to S3")
+
+        # 3-6. stream the items through the transformation into parquet row groups uploaded as they are written
+        if streaming_mode:
+            # the items of every window go to files of their own, uploaded once the window is kept or dropped when it
+            # failed. With dedupe_mode the items are spooled and hashed first, and only the items of a changed window
+            # are transformed and written, an unchanged window never reaches the writers
+            writer = PartitionedParquetWriter(s3_client, bucket_name, key_prefix, item_schema, parquet_row_group_size,
+                                              datetime_now, max_open_writers)
+            spools = {}
+
+            def on_item(index, item):
+                if not dedupe_mode:
+                    writer.add(item, index)
+                    return
+                spool = spools.get(index)
+                if spool is None:
+                    spool = spools[index] = WindowSpool(window_spool_memory_bytes)
+                spool.add(item)
+
+            def on_window(index, status, validators, item_count):
+                spool = spools.pop(index, None) or WindowSpool(window_spool_memory_bytes)
+                try:
+                    if not keep_window(index, status, validators, spool.hexdigest()):
+                        writer.abort_group(index)
+                        return
+                    if dedupe_mode:
+                        for item in spool.items():
+                            writer.add(item, index)
+                    writer.close_group(index)
+                finally:
+                    spool.close()
+
+            try:
+                extract_items(URL, windows, on_item, headers_list, on_window)
+                files = writer.close()
+            except Exception:
+                writer.abort()
+                raise
+            finally:
+                for spool in spools.values():
+                    spool.close()
+            # 6a. list the new files in the partition manifest
+            if files:
+                update_manifest(s3_client, bucket_name, get_manifest_key(key_prefix), files)
+            if dedupe_mode:
+                fetch_state.commit()
+            if not files:
+                log_nothing_written()
+                return
+            logging.info(f'{sum(stats["rows"] for stats in files.values())} rows streamed to {len(files)} partitions')
+            logging.info("Data loaded from API to S3 successfully.")
+            return
+
+        items = []
+        for index, (parameters, status, validators, content) in enumerate(extract(URL, windows, headers_list)):
+            data = get_body_reponse(content) if content else None
+            if status == 200 and data is None:
+                status = None
+            if keep_window(index, status, validators, get_items_hash(data['items']) if data else None):
+                items.extend(data['items'])
+        if not items:
+            if dedupe_mode:
+                fetch_state.commit()
+            log_nothing_written()
+            return
         dataframe = json_normalised_dataframe(items)
 
         # 4. pandas to do the transformation
@@ -176,19 +714,34 @@ def lambda_handler(event, context):
         # sample the dataframe
         logging.info(transformed_dataframe.head(5))
 
-        # 5. convert dataframe to parquet for compression
-        df_parquet = transformed_dataframe.to_parquet(engine='pyarrow')
-
-        # specify the key to the parquet
-        s3_key_parquet = get_ingestion_key_parquet_path(bucket_name, key_prefix, datetime_now)
-
-        # 6. load the parquet to S3
-        s3_client.put_object(
-        Bucket=bucket_name,
-        Key=s3_key_parquet,
-        Body=df_parquet,  
-        ContentType='parquet'  
-        )
+        # 5-6. convert each partition of the dataframe to parquet for compression and load it to S3
+        event_times = transformed_dataframe[event_time_column].map(parse_event_time)
+        files = {}
+        for partition, partition_dataframe in transformed_dataframe.groupby(event_times.map(get_partition)):
+            df_parquet = partition_dataframe.to_parquet(engine='pyarrow', index=False)
+
+            # specify the key to the parquet
+            s3_key_parquet = get_ingestion_key_parquet_path(bucket_name, key_prefix, partition, datetime_now)
+
+            s3_client.put_object(
+            Bucket=bucket_name,
+            Key=s3_key_parquet,
+            Body=df_parquet,  
+            ContentType='parquet'  
+            )
+            invalidate(bucket_name, s3_key_parquet)
+            partition_event_times = event_times[partition_dataframe.index]
+            files[s3_key_parquet] = {
+                'partition': partition,
+                'rows': len(partition_dataframe),
+                'min_timestamp': partition_dataframe[event_time_column][partition_event_times.idxmin()],
+                'max_timestamp': partition_dataframe[event_time_column][partition_event_times.idxmax()],
+            }
+
+        # 6a. list the new files in the partition manifest
+        update_manifest(s3_client, bucket_name, get_manifest_key(key_prefix), files)
+        if dedupe_mode:
+            fetch_state.commit()
 
         logging.info("Data loaded from API to S3 successfully.")
     except Exception as e:
@@ -196,8 +749,95 @@ def lambda_handler(event, context):
         logging.error(e)
 
 
+# the small files of the partition grouped in bins of up to compaction_target_bytes, in key order
+def get_compaction_bins(partition_files, index):
+    small_files = sorted(file_key for file_key in partition_files
+                         if file_key in index and index[file_key]['Size'] < compaction_small_file_bytes)
+    bins = []
+    size = 0
+    for file_key in small_files:
+        if not bins or size + index[file_key]['Size'] > compaction_target_bytes:
+            bins.append([])
+            size = 0
+        bins[-1].append(file_key)
+        size += index[file_key]['Size']
+    return [file_keys for file_keys in bins if len(file_keys) > 1]
+
+# Reads the files of a bin, sorts their rows and writes them as one parquet. The multipart upload only makes the object
+# visible once it is complete, so a reader never sees a partly written compacted file.
+def compact_files(s3_client, bucket_name, file_keys, compacted_file_key):
+    tables = [pq.read_table(pa.BufferReader(s3_client.get_object(Bucket=bucket_name, Key=file_key)['Body'].read()))
+              for file_key in file_keys]
+    table = pa.concat_tables(tables, promote_options='permissive')
+    if compaction_sort_key in table.column_names:
+        table = table.sort_by(compaction_sort_key)
+    with S3MultipartWriter(s3_client, bucket_name, compacted_file_key, content_type='parquet') as sink:
+        pq.write_table(table, sink, row_group_size=parquet_row_group_size)
+    return table.num_rows
+
+# Compacts the partitions of the manifest with rows between start and end (all of them when None). The compacted
+# files replace their sources in the manifest in one write, and the sources are deleted only after that, so the
+# manifest never lists a row twice. Run it when question 3 is not writing to the same prefix.
+def compact(bucket_name, start=None, end=None, max_workers=None):
+    max_workers = max_workers or compaction_max_workers
+    aws_access_key_id, aws_secret_access_key = get_aws_credentials(aws_credentials_path)
+    s3_client = boto3.client('s3', aws_access_key_id=aws_access_key_id,
+                      aws_secret_access_key=aws_secret_access_key,
+                      region_name=region_name)
+    bucket_exist(s3_client, bucket_name)
+
+    manifest_key = get_manifest_key(key_prefix)
+    partitions = prune_partitions(read_manifest(s3_client, bucket_name, manifest_key), start, end)
+    datetime_now = get_datetime_now()
+
+    def compact_partition(partition_entry):
+        partition, entry = partition_entry
+        index = list_keys(s3_client, bucket_name, get_partition_prefix(key_prefix, partition) + '/')
+        bins = get_compaction_bins(entry['files'], index)
+        if sum(len(file_keys) for file_keys in bins) < compaction_min_files:
+            return {}, []
+        compacted = {}
+        try:
+            for number, file_keys in enumerate(bins):
+                compacted_file_key = f'{get_partition_prefix(key_prefix, partition)}/compacted_{datetime_now}_{number}.parquet'
+                rows = compact_files(s3_client, bucket_name, file_keys, compacted_file_key)
+                stats = [entry['files'][file_key] for file_key in file_keys]
+                compacted[compacted_file_key] = {
+                    'partition': partition,
+                    'rows': rows,
+                    'min_timestamp': min((file_stats['min_timestamp'] for file_stats in stats), key=parse_event_time),
+                    'max_timestamp': max((file_stats['max_timestamp'] for file_stats in stats), key=parse_event_time),
+                }
+                logging.info(f'{len(file_keys)} files of {partition} compacted into {compacted_file_key} with {rows} rows')
+        except Exception as e:
+            # the partition is left as it was, without the files compacted so far
+            logging.error(f'failed to compact {partition}')
+            logging.error(e)
+            delete_sources(s3_client, bucket_name, list(compacted))
+            return {}, []
+        return compacted, [file_key for file_keys in bins for file_key in file_keys]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(compact_partition, partitions.items()))
+    compacted_files = {file_key: stats for compacted, _ in results for file_key, stats in compacted.items()}
+    source_file_keys = [file_key for _, file_keys in results for file_key in file_keys]
+    if not compacted_files:
+        logging.info(f'nothing to compact in {len(partitions)} partitions')
+        return {}
+
+    update_manifest(s3_client, bucket_name, manifest_key, compacted_files, source_file_keys)
+    deleted = delete_sources(s3_client, bucket_name, source_file_keys)
+    logging.info(f'{len(source_file_keys)} files compacted into {len(compacted_files)}, {len(deleted)} sources deleted')
+    return compacted_files
+
+
 # uncomment this section for exact lambda usage on AWS
 if __name__ == '__main__':
+    # compact the small files of the partitions: python "question 3.py" compact <bucket_name> [2023-09-01T00:00:00 2023-09-30T23:00:00]
+    if len(sys.argv) in (3, 5) and sys.argv[1] == 'compact':
+        bounds = [datetime.fromisoformat(value) for value in sys.argv[3:5]] or [None, None]
+        compact(sys.argv[2], *bounds)
+        sys.exit(0)
     # mock a fake event to lambda_handler
     # 0. lambda listen to S3 event, the script will run when event is sent
     # please modify the bucket name in fake_event to test the script
@@ -0,0 +1,117 @@
+# Shared server-side archiving (copy then delete) of S3 objects for the question scripts.
+# Objects up to multipart_threshold are copied with copy_object, larger objects (copy_object stops at 5 GB) are copied
+# with multipart upload_part_copy, the parts being copied at the same time.
+# Many keys are archived in parallel, and a source is only deleted once its copy is verified, with delete_objects
+# removing up to 1000 sources per call.
+##################################################################################################################################################################
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from s3_metadata import invalidate
+
+
+multipart_threshold = 512 * 1024 * 1024
+part_size = 256 * 1024 * 1024
+max_part_workers = 8
+max_object_workers = 8
+
+# delete_objects accepts at most 1000 keys per call
+delete_batch_size = 1000
+
+
+def copy_object_multipart(s3_client, bucket_name, source_file_key, destination_file_key, head):
+    size = head['ContentLength']
+    create_args = {'Bucket': bucket_name, 'Key': destination_file_key, 'Metadata': head.get('Metadata', {})}
+    if head.get('ContentType'):
+        create_args['ContentType'] = head['ContentType']
+    upload_id = s3_client.create_multipart_upload(**create_args)['UploadId']
+
+    def copy_part(part):
+        part_number, start = part
+        end = min(start + part_size, size) - 1
+        response = s3_client.upload_part_copy(
+            Bucket=bucket_name,
+            Key=destination_file_key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            CopySource={'Bucket': bucket_name, 'Key': source_file_key},
+            CopySourceRange=f'bytes={start}-{end}',
+            CopySourceIfMatch=head['ETag'],
+        )
+        return {'PartNumber': part_number, 'ETag': response['CopyPartResult']['ETag']}
+
+    parts = list(enumerate(range(0, size, part_size), start=1))
+    try:
+        with ThreadPoolExecutor(max_workers=max_part_workers) as executor:
+            completed_parts = list(executor.map(copy_part, parts))
+        s3_client.complete_multipart_upload(Bucket=bucket_name, Key=destination_file_key, UploadId=upload_id,
+                                            MultipartUpload={'Parts': completed_parts})
+    except Exception:
+        s3_client.abort_multipart_upload(Bucket=bucket_name, Key=destination_file_key, UploadId=upload_id)
+        raise
+    logging.info(f'{source_file_key} copied in {len(parts)} parts')
+
+# The copy is done when the destination exists with the same size. A single part copy of an object which is not
+# KMS encrypted also keeps the ETag (the MD5 of the content), which is compared as well.
+def verify_copy(s3_client, bucket_name, head, destination_file_key):
+    destination_head = s3_client.head_object(Bucket=bucket_name, Key=destination_file_key)
+    if destination_head['ContentLength'] != head['ContentLength']:
+        return False
+    if (head['ContentLength'] <= multipart_threshold and '-' not in head['ETag']
+            and head.get('ServerSideEncryption') != 'aws:kms'):
+        return destination_head['ETag'] == head['ETag']
+    return True
+
+def copy_and_verify(s3_client, bucket_name, source_file_key, destination_file_key):
+    head = s3_client.head_object(Bucket=bucket_name, Key=source_file_key)
+    if head['ContentLength'] > multipart_threshold:
+        copy_object_multipart(s3_client, bucket_name, source_file_key, destination_file_key, head)
+    else:
+        s3_client.copy_object(
+        CopySource={'Bucket': bucket_name, 'Key': source_file_key},
+        Bucket=bucket_name,
+        Key=destination_file_key,
+        CopySourceIfMatch=head['ETag'],
+        )
+    invalidate(bucket_name, destination_file_key)
+    return verify_copy(s3_client, bucket_name, head, destination_file_key)
+
+def delete_sources(s3_client, bucket_name, source_file_keys):
+    deleted = []
+    for start in range(0, len(source_file_keys), delete_batch_size):
+        batch = source_file_keys[start:start + delete_batch_size]
+        response = s3_client.delete_objects(Bucket=bucket_name,
+                                            Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+        failed = {error['Key'] for error in response.get('Errors', [])}
+        for error in response.get('Errors', []):
+            logging.error(f"failed to delete {error['Key']}: {error.get('Message')}")
+        deleted.extend(key for key in batch if key not in failed)
+    for key in deleted:
+        invalidate(bucket_name, key)
+    return deleted
+
+# moves is a list of (source_file_key, destination_file_key) in bucket_name, returns the moved source keys.
+# A source whose copy failed or could not be verified is kept and logged.
+def archive_objects(s3_client, bucket_name, moves):
+    def move(source_destination):
+        source_file_key, destination_file_key = source_destination
+        try:
+            if copy_and_verify(s3_client, bucket_name, source_file_key, destination_file_key):
+                return source_file_key
+            logging.error(f'copy of {source_file_key} to {destination_file_key} could not be verified')
+        except Exception as e:
+            logging.error(f'failed to copy {source_file_key} to {destination_file_key}')
+            logging.error(e)
+        return None
+
+    with ThreadPoolExecutor(max_workers=max_object_workers) as executor:
+        copied = [key for key in executor.map(move, moves) if key is not None]
+    deleted = delete_sources(s3_client, bucket_name, copied)
+    logging.info(f'{len(deleted)} of {len(moves)} S3 objects moved in {bucket_name}')
+    return deleted
+
+def move_object(s3_client, bucket_name, source_file_key, destination_file_key):
+    moved = archive_objects(s3_client, bucket_name, [(source_file_key, destination_file_key)])
+    if moved:
+        logging.info(f'S3 object moved from {source_file_key} to {destination_file_key}')
+    return bool(moved)
@@ -0,0 +1,100 @@
+# Shared S3 metadata checks for the question scripts.
+# bucket_exist and file_exist use head_bucket/head_object, one request whatever the number of objects in the bucket,
+# instead of list_buckets and an unpaginated list_objects_v2 that stops at 1000 keys.
+# list_keys builds a paginated index of a prefix for the scripts that need to enumerate objects.
+# Results are kept in a module level cache with a TTL, so warm lambda invocations reuse them. Only found objects and
+# buckets are cached, a missing one is asked again, and file_exist always sends its HEAD as a load depends on it.
+##################################################################################################################################################################
+
+import time
+import logging
+from botocore.exceptions import ClientError
+
+
+# seconds a cached result is reused, set to 0 to disable the cache
+cache_ttl_seconds = 300
+
+# (kind, bucket_name, key or prefix) -> (expiry time, result)
+_cache = {}
+
+not_found_codes = ('404', 'NoSuchBucket', 'NoSuchKey', 'NotFound')
+
+
+def _cache_get(cache_key):
+    entry = _cache.get(cache_key)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+    _cache.pop(cache_key, None)
+    return None
+
+def _cache_put(cache_key, result):
+    if cache_ttl_seconds > 0:
+        _cache[cache_key] = (time.monotonic() + cache_ttl_seconds, result)
+    return result
+
+def clear_cache():
+    _cache.clear()
+
+# drop the cached results of an object which was written, moved or deleted, and of the listings that contain it
+def invalidate(bucket_name, file_key):
+    _cache.pop(('object', bucket_name, file_key), None)
+    for cache_key in [cache_key for cache_key in list(_cache) if cache_key[0] == 'prefix' and cache_key[1] == bucket_name
+                      and file_key.startswith(cache_key[2])]:
+        _cache.pop(cache_key, None)
+
+# head_object metadata (ContentLength, ETag, LastModified ...) or None if the object does not exist.
+# use_cache=False always sends the HEAD, its result replaces the cached one.
+def get_object_metadata(s3, bucket_name, file_key, use_cache=True):
+    cache_key = ('object', bucket_name, file_key)
+    cached = _cache_get(cache_key) if use_cache else None
+    if cached is not None:
+        return cached
+    try:
+        response = s3.head_object(Bucket=bucket_name, Key=file_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in not_found_codes:
+            raise
+        # a missing object is not cached, it can be written by the next request
+        _cache.pop(cache_key, None)
+        return None
+    metadata = {name: response[name] for name in ('ContentLength', 'ETag', 'LastModified') if name in response}
+    return _cache_put(cache_key, metadata)
+
+def bucket_exist(s3, bucket_name):
+    cache_key = ('bucket', bucket_name, '')
+    found = _cache_get(cache_key)
+    if found is None:
+        try:
+            s3.head_bucket(Bucket=bucket_name)
+            found = _cache_put(cache_key, True)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in not_found_codes:
+                raise
+            found = False
+    if found:
+        logging.info(f'This bucket {bucket_name} is found')
+    else:
+        logging.error(f'This bucket {bucket_name} is not found...')
+    return found
+
+def file_exist(s3, bucket_name, file_key, use_cache=False):
+    found = get_object_metadata(s3, bucket_name, file_key, use_cache=use_cache) is not None
+    if found:
+        logging.info(f'{file_key} is found in {bucket_name}')
+    else:
+        logging.error(f'{file_key} is not found in {bucket_name}')
+    return found
+
+# {key: {'Size', 'ETag', 'LastModified'}} of every object under the prefix, following the continuation tokens
+def list_keys(s3, bucket_name, prefix):
+    cache_key = ('prefix', bucket_name, prefix)
+    index = _cache_get(cache_key)
+    if index is not None:
+        return index
+    index = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            index[obj['Key']] = {'Size': obj['Size'], 'ETag': obj['ETag'], 'LastModified': obj['LastModified']}
+    logging.info(f'{len(index)} objects found under s3://{bucket_name}/{prefix}')
+    return _cache_put(cache_key, index)
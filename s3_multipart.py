@@ -0,0 +1,81 @@
+# Shared streaming writer to S3 for the question scripts.
+# Bytes written are buffered up to part_size and sent as the parts of a multipart upload, so memory stays at about one
+# part whatever the size of the object. An object smaller than one part is sent with a single put_object.
+##################################################################################################################################################################
+
+import logging
+from s3_metadata import invalidate
+
+
+# S3 parts have to be at least 5 MB, except the last one
+min_part_size = 5 * 1024 * 1024
+
+
+class S3MultipartWriter:
+    def __init__(self, s3_client, bucket_name, file_key, part_size=8 * 1024 * 1024, content_type=None):
+        if part_size < min_part_size:
+            raise ValueError(f'part_size {part_size} is smaller than the S3 minimum of {min_part_size}')
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.file_key = file_key
+        self.part_size = part_size
+        self.content_type = content_type
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.size = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def upload_part(self, data):
+        if self.upload_id is None:
+            create_args = {'Bucket': self.bucket_name, 'Key': self.file_key}
+            if self.content_type:
+                create_args['ContentType'] = self.content_type
+            self.upload_id = self.s3_client.create_multipart_upload(**create_args)['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(Bucket=self.bucket_name, Key=self.file_key, UploadId=self.upload_id,
+                                              PartNumber=part_number, Body=data)
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+
+    def close(self):
+        if self.closed:
+            return self.size
+        if self.upload_id is None:
+            put_args = {'Bucket': self.bucket_name, 'Key': self.file_key, 'Body': bytes(self.buffer)}
+            if self.content_type:
+                put_args['ContentType'] = self.content_type
+            self.s3_client.put_object(**put_args)
+        else:
+            if self.buffer:
+                self.upload_part(bytes(self.buffer))
+            self.s3_client.complete_multipart_upload(Bucket=self.bucket_name, Key=self.file_key,
+                                                     UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+        self.buffer = bytearray()
+        self.closed = True
+        invalidate(self.bucket_name, self.file_key)
+        logging.info(f'{self.size} bytes written to s3://{self.bucket_name}/{self.file_key} in {max(len(self.parts), 1)} parts')
+        return self.size
+
+    # drop the parts already uploaded when the object cannot be completed
+    def abort(self):
+        if self.upload_id is not None and not self.closed:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.file_key, UploadId=self.upload_id)
+        self.buffer = bytearray()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
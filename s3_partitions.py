@@ -0,0 +1,86 @@
+# Shared event-time partitioning of the parquet outputs for the question scripts.
+# Rows are written under hive partitions year=/month=/day=/hour= of their own event timestamp, and a json manifest
+# next to the partitions lists every partition with its files, row counts and min/max event timestamps.
+# Readers (e.g. question 10) load the manifest and prune the partitions outside their time range instead of listing S3.
+##################################################################################################################################################################
+
+import json
+import logging
+from datetime import datetime
+from botocore.exceptions import ClientError
+from s3_metadata import invalidate
+
+
+manifest_name = '_manifest.json'
+
+
+# event timestamps are iso strings like '2023-09-01T08:00:00+08:00', partitions use their local date and hour
+def parse_event_time(value):
+    return datetime.fromisoformat(value).replace(tzinfo=None)
+
+def get_partition(event_time):
+    return f'year={event_time:%Y}/month={event_time:%m}/day={event_time:%d}/hour={event_time:%H}'
+
+def get_partition_prefix(key_prefix, partition):
+    return f"{key_prefix.rstrip('/')}/{partition}"
+
+def get_manifest_key(key_prefix):
+    return f"{key_prefix.rstrip('/')}/{manifest_name}"
+
+def read_manifest(s3_client, bucket_name, manifest_key):
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=manifest_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        return {'partitions': {}}
+    return json.loads(response['Body'].read())
+
+# files is {file_key: {'partition', 'rows', 'min_timestamp', 'max_timestamp'}} of the files written, removed_file_keys
+# are files replaced or deleted since. The partition totals are recomputed from their files.
+# The manifest is rewritten whole, so the writers of one prefix have to run one at a time.
+def update_manifest(s3_client, bucket_name, manifest_key, files, removed_file_keys=()):
+    manifest = read_manifest(s3_client, bucket_name, manifest_key)
+    partitions = manifest['partitions']
+    removed_file_keys = set(removed_file_keys)
+    for entry in partitions.values():
+        entry['files'] = {file_key: stats for file_key, stats in entry['files'].items()
+                          if file_key not in removed_file_keys}
+    for file_key, stats in files.items():
+        entry = partitions.setdefault(stats['partition'], {'files': {}})
+        entry['files'][file_key] = {name: stats[name] for name in ('rows', 'min_timestamp', 'max_timestamp')}
+
+    for partition in list(partitions):
+        partition_files = partitions[partition]['files']
+        if not partition_files:
+            del partitions[partition]
+            continue
+        partitions[partition].update({
+            'rows': sum(stats['rows'] for stats in partition_files.values()),
+            'min_timestamp': min((stats['min_timestamp'] for stats in partition_files.values()), key=parse_event_time),
+            'max_timestamp': max((stats['max_timestamp'] for stats in partition_files.values()), key=parse_event_time),
+        })
+    manifest['updated_date_time'] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+
+    s3_client.put_object(Bucket=bucket_name, Key=manifest_key, Body=json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'),
+                         ContentType='application/json')
+    invalidate(bucket_name, manifest_key)
+    logging.info(f'{len(files)} files added and {len(removed_file_keys)} removed in {manifest_key}, {len(partitions)} partitions')
+    return manifest
+
+# {partition: entry} of the partitions with rows between start and end (naive datetimes in event local time, None for
+# no bound)
+def prune_partitions(manifest, start=None, end=None):
+    selected = {}
+    for partition, entry in manifest['partitions'].items():
+        if start is not None and parse_event_time(entry['max_timestamp']) < start:
+            continue
+        if end is not None and parse_event_time(entry['min_timestamp']) > end:
+            continue
+        selected[partition] = entry
+    logging.info(f'{len(selected)} of {len(manifest["partitions"])} partitions selected between {start} and {end}')
+    return selected
+
+# file keys of the selected partitions, ready for a reader
+def get_partition_files(partitions):
+    return [file_key for entry in partitions.values() for file_key in sorted(entry['files'])]
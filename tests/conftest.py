@@ -0,0 +1,41 @@
+# Shared fixtures of the tests: the question scripts are loaded from their files (their names have spaces), and S3 is
+# mocked by moto with fake credentials in a temporary home, as the scripts read ~/.aws/credentials.
+##################################################################################################################################################################
+
+import os
+import sys
+import importlib.util
+import boto3
+import pytest
+from moto import mock_aws
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_path)
+
+import s3_metadata
+
+
+bucket_name = 'test-bucket'
+sample_path = os.path.join(repo_path, 'xAPI-Edu-Data.csv')
+
+
+def load_script(file_name):
+    spec = importlib.util.spec_from_file_location(file_name.replace(' ', '_')[:-3], os.path.join(repo_path, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture
+def s3_client(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / '.aws')
+    (tmp_path / '.aws' / 'credentials').write_text('[default]\naws_access_key_id = testing\naws_secret_access_key = testing\n')
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    s3_metadata.clear_cache()
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=bucket_name)
+        yield client
+    s3_metadata.clear_cache()
@@ -0,0 +1,126 @@
+import csv
+import io
+from conftest import bucket_name, sample_path, load_script
+
+
+q1 = load_script('question 1.py')
+
+
+def test_select_query_casts_a_scalar_numeric_filter():
+    query = q1.SelectQuery(['Topic', 'raisedhands'], [('raisedhands', '>', 50), ('Semester', '=', 'F')])
+    assert query.to_sql() == ('SELECT s."Topic", s."raisedhands" FROM s3object s '
+                              'WHERE CAST(s."raisedhands" AS FLOAT) > 50 AND s."Semester" = \'F\'')
+
+def test_select_query_casts_a_numeric_in_filter():
+    query = q1.SelectQuery(['Topic'], [('raisedhands', 'in', [10, 20])])
+    assert query.to_sql() == 'SELECT s."Topic" FROM s3object s WHERE CAST(s."raisedhands" AS FLOAT) IN (10, 20)'
+
+def test_select_query_without_filter_has_no_where():
+    query = q1.SelectQuery(['Topic', 'Class'])
+    assert query.to_sql() == 'SELECT s."Topic", s."Class" FROM s3object s'
+
+def test_select_query_scan_range_support():
+    assert q1.SelectQuery(['Topic']).supports_scan_range()
+    assert q1.SelectQuery(['Topic'], input_format='Parquet').supports_scan_range()
+    assert not q1.SelectQuery(['Topic'], compression_type='GZIP').supports_scan_range()
+
+# S3 Select stand-in which answers a SelectQuery from the csv rows in python: the columns of the rows matching its
+# filter, and the bytes of the scan range in the stats. Like S3 Select, a ScanRange gets the rows which start in it.
+class SelectClient:
+    def __init__(self, data, query):
+        self.rows = list(csv.DictReader(io.StringIO(data.decode('utf-8'))))
+        # byte offset of every row after the header, the sample has no quoted line breaks
+        self.row_starts = [offset + 1 for offset in range(len(data) - 1) if data[offset:offset + 1] == b'\n']
+        self.row_starts = self.row_starts[:len(self.rows)]
+        self.size = len(data)
+        self.query = query
+        self.scan_ranges = []
+
+    def head_object(self, **kwargs):
+        return {'ContentLength': self.size}
+
+    def select_object_content(self, **kwargs):
+        assert kwargs['Expression'] == self.query.to_sql()
+        start, end = 0, self.size - 1
+        if 'ScanRange' in kwargs:
+            start, end = kwargs['ScanRange']['Start'], kwargs['ScanRange']['End']
+            self.scan_ranges.append((start, end))
+        filters = q1.compile_filters(list(self.rows[0]), self.query.filter_spec)
+        output = io.StringIO()
+        writer = csv.writer(output, lineterminator='\n')
+        for row, row_start in zip(self.rows, self.row_starts):
+            if start <= row_start <= end and q1.row_matches(filters, list(row.values())):
+                writer.writerow([row[column] for column in self.query.columns])
+        payload = output.getvalue().encode('utf-8')
+        # cut inside a row so the rows are rebuilt across the events
+        return {'Payload': [{'Records': {'Payload': payload[:1001]}}, {'Records': {'Payload': payload[1001:]}},
+                            {'Stats': {'Details': {'BytesScanned': end - start + 1, 'BytesReturned': len(payload)}}}]}
+
+def test_select_and_arrow_backends_aggregate_the_same_rows(s3_client):
+    data = open(sample_path, 'rb').read()
+    s3_client.put_object(Bucket=bucket_name, Key='xAPI-Edu-Data.csv', Body=data)
+    filter_spec = [('raisedhands', '>', 50), ('Semester', '=', 'F')]
+    group_by, metrics = ['Topic', 'Class'], ['raisedhands', 'VisITedResources']
+
+    query = q1.SelectQuery(group_by + metrics, filter_spec)
+    select_result = q1.select_aggregate(SelectClient(data, query), bucket_name, 'xAPI-Edu-Data.csv', query,
+                                        q1.GroupByAggregator(query.columns, group_by, metrics))
+    arrow_result = q1.arrow_aggregate(s3_client, bucket_name, 'xAPI-Edu-Data.csv',
+                                      q1.GroupByAggregator(q1.source_columns, group_by, metrics, filter_spec),
+                                      64 * 1024, 16 * 1024)
+
+    # only the matching rows are returned, the scan is reported in bytes
+    assert select_result.rows_scanned is None and select_result.stats['BytesScanned'] == len(data)
+    assert select_result.stats['BytesReturned'] < len(data) // 5
+    assert arrow_result.rows_scanned == data.count(b'\n') - 1
+    assert 0 < select_result.rows_matched == arrow_result.rows_matched < arrow_result.rows_scanned
+    assert select_result.to_records() == arrow_result.to_records()
+    assert all(type(record['raisedhands_sum']) is int for record in arrow_result.to_records())
+
+def test_scan_ranges_merge_to_the_single_scan():
+    data = open(sample_path, 'rb').read()
+    query = q1.SelectQuery(['Topic', 'Class', 'raisedhands', 'VisITedResources'], [('Semester', '=', 'F')])
+
+    def get_aggregator():
+        return q1.GroupByAggregator(query.columns, ['Topic', 'Class'], ['raisedhands', 'VisITedResources'])
+    single_result = q1.select_aggregate(SelectClient(data, query), bucket_name, 'xAPI-Edu-Data.csv', query,
+                                        get_aggregator())
+    client = SelectClient(data, query)
+    ranged_result = q1.parallel_select_aggregate(client, bucket_name, 'xAPI-Edu-Data.csv', query, get_aggregator(),
+                                                 4096, 4)
+
+    # the ranges cover the object once, every row is aggregated by the one range it starts in
+    assert len(client.scan_ranges) == -(-len(data) // 4096) > 1
+    assert sorted(client.scan_ranges)[0][0] == 0 and sorted(client.scan_ranges)[-1][1] == len(data) - 1
+    assert ranged_result.stats['BytesScanned'] == single_result.stats['BytesScanned'] == len(data)
+    assert ranged_result.rows_matched == single_result.rows_matched > 0
+    assert ranged_result.to_records() == single_result.to_records()
+
+def test_arrow_numbers_split_like_to_number():
+    import pyarrow as pa
+    values = pa.array(['15', ' 7 ', '1.5', '', 'abc', '-3', '1e3'])
+    integers, decimals = q1.arrow_numbers(values)
+    expected = []
+    for value in values.to_pylist():
+        try:
+            expected.append(q1.to_number(value))
+        except ValueError:
+            expected.append(None)
+    assert [integer if integer is not None else decimal
+            for integer, decimal in zip(integers.to_pylist(), decimals.to_pylist())] == expected
+
+def test_sketch_aggregator_keeps_its_precision_and_k_through_to_dict():
+    columns = ['Topic', 'NationalITy', 'raisedhands']
+    aggregator = q1.SketchAggregator(columns, ['Topic'], ['NationalITy'], ['raisedhands'], precision=10, k=50)
+    aggregator.add(['IT', 'KW', '15'])
+    restored = q1.SketchAggregator.from_dict(aggregator.to_dict())
+    assert (restored.precision, restored.k) == (10, 50)
+    assert restored.distinct_columns == ['NationalITy'] and restored.quantile_columns == ['raisedhands']
+
+    # a group first seen in a later scan is merged into sketches of the saved size
+    later = aggregator.empty_copy()
+    later.add(['Math', 'JO', '30'])
+    restored.merge(later)
+    distinct, quantile = restored.groups[('Math',)]
+    assert distinct['NationalITy'].precision == 10 and quantile['raisedhands'].k == 50
+    assert restored.result().to_records([0.5]) == aggregator.merge(later).result().to_records([0.5])
@@ -0,0 +1,212 @@
+import io
+from datetime import date
+import pytest
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from conftest import bucket_name, sample_path, load_script
+
+
+def put_parquet(s3_client, file_key, data):
+    sink = io.BytesIO()
+    pq.write_table(data, sink)
+    s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=sink.getvalue())
+
+def read_output_keys(s3_client, prefix):
+    return [obj['Key'] for obj in s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix).get('Contents', [])
+            if obj['Key'].endswith('.parquet')]
+
+def read_output(s3_client, prefix):
+    keys = read_output_keys(s3_client, prefix)
+    return pa.concat_tables(pq.read_table(io.BytesIO(s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read()))
+                            for key in keys)
+
+def run(q10, s3_client):
+    watermark = q10.read_watermark(s3_client)
+    input_files = q10.get_input_files(s3_client, watermark)
+    assert q10.run_local(s3_client, input_files)
+    q10.commit_watermark(s3_client, watermark, input_files)
+    return input_files
+
+def test_filtered_output_keeps_the_rows_of_earlier_runs(s3_client, monkeypatch):
+    q10 = load_script('question 10.py')
+    q10.bucket_name = bucket_name
+    sample = pa_csv.read_csv(sample_path)
+    first, second = sample.slice(0, 240), sample.slice(240)
+    first_key = 'demo/ingestion/year=2023/month=09/day=15/xAPI-Edu-Data.parquet'
+    second_key = 'demo/ingestion/year=2023/month=09/day=16/xAPI-Edu-Data.parquet'
+    reads = []
+    local_read_parquet = q10.local_read_parquet
+    monkeypatch.setattr(q10, 'local_read_parquet', lambda s3_client, bucket_name, file_keys:
+                        reads.append(file_keys) or local_read_parquet(s3_client, bucket_name, file_keys))
+
+    put_parquet(s3_client, first_key, first)
+    assert len(run(q10, s3_client)) == 1
+    put_parquet(s3_client, second_key, second)
+    # the second run reads the new file once for both outputs
+    assert list(run(q10, s3_client)) == [second_key]
+    assert reads == [[first_key], [second_key]]
+
+    def expected(data):
+        return data.filter(pc.greater(data['raisedhands'], 60)).select(['gender', 'GradeID', 'raisedhands'])
+    filtered = read_output(s3_client, q10.filter_destination_prefix_key)
+    assert sorted(filtered.to_pylist(), key=str) == sorted(expected(sample).to_pylist(), key=str)
+
+    # a rewritten file replaces its own rows only
+    changed = first.slice(0, 120)
+    put_parquet(s3_client, first_key, changed)
+    assert list(run(q10, s3_client)) == [first_key]
+    filtered = read_output(s3_client, f'{q10.filter_destination_prefix_key}/{q10.source_file_column}='
+                                      f'{q10.get_source_file_id(first_key)}/')
+    assert sorted(filtered.to_pylist(), key=str) == sorted(expected(changed).to_pylist(), key=str)
+    filtered = read_output(s3_client, q10.filter_destination_prefix_key)
+    assert filtered.num_rows == expected(changed).num_rows + expected(second).num_rows
+
+def get_day(day):
+    class Day(date):
+        @classmethod
+        def today(cls):
+            return date(2023, 9, day)
+    return Day
+
+def test_scd2_batch_quarantines_conflicting_rows_and_drops_repeated_ones(s3_client):
+    q10 = load_script('question 10.py')
+    sample = pa_csv.read_csv(sample_path).slice(0, 3)
+    changed = sample.slice(0, 1).set_column(sample.column_names.index('raisedhands'), 'raisedhands', pa.array([99]))
+    facts = q10.local_transformation_source_data_via_sql(pa.concat_tables([sample, sample.slice(1, 1), changed]))
+    # the tracked columns have the key of the Relation dimension
+    facts = facts.set_column(facts.column_names.index('Relation'), 'Relation_key',
+                             pc.cast(pc.equal(facts['Relation'], 'Father'), pa.int32()))
+
+    batch, conflicts = q10.local_scd2_batch(facts)
+    assert batch['fact_guid'].to_pylist() == facts['fact_guid'].to_pylist()[1:3]
+    assert conflicts['fact_guid'].to_pylist() == [facts['fact_guid'][0].as_py()] * 2
+    assert sorted(conflicts['raisedhands'].to_pylist()) == sorted([sample['raisedhands'][0].as_py(), 99])
+
+def test_scd2_merge_reads_only_the_partitions_it_rewrites(s3_client, monkeypatch):
+    q10 = load_script('question 10.py')
+    q10.bucket_name = bucket_name
+    sample = pa_csv.read_csv(sample_path)
+    # one row of every fact_guid, so no row is quarantined or dropped
+    guids = q10.local_transformation_source_data_via_sql(sample)['fact_guid'].to_pylist()
+    sample = sample.take([guids.index(guid) for guid in dict.fromkeys(guids) if guids.count(guid) == 1])
+    first, second = sample.slice(0, 200), sample.slice(200)
+    read_keys = []
+    read_output_file = q10.read_output_file
+    monkeypatch.setattr(q10, 'read_output_file', lambda s3_client, file_key, columns=None:
+                        read_keys.append(file_key) or read_output_file(s3_client, file_key, columns))
+    fact_prefix = q10.fact_destination_prefix_key
+
+    monkeypatch.setattr(q10, 'date', get_day(15))
+    put_parquet(s3_client, 'demo/ingestion/year=2023/month=09/day=15/xAPI-Edu-Data.parquet', first)
+    run(q10, s3_client)
+
+    # new rows only: the partition of the first run is not read
+    monkeypatch.setattr(q10, 'date', get_day(16))
+    read_keys.clear()
+    put_parquet(s3_client, 'demo/ingestion/year=2023/month=09/day=16/xAPI-Edu-Data.parquet', second)
+    run(q10, s3_client)
+    assert [key for key in read_keys if key.startswith(f'{fact_prefix}/')] == []
+    facts = read_output(s3_client, f'{fact_prefix}/')
+    assert facts.num_rows == sample.num_rows
+    assert len(set(facts['fact_guid'].to_pylist())) == sample.num_rows
+
+    # a changed row expires its version in the partition of the first run, which is read and rewritten
+    monkeypatch.setattr(q10, 'date', get_day(17))
+    read_keys.clear()
+    changed = first.slice(0, 1)
+    changed = changed.set_column(changed.column_names.index('raisedhands'), 'raisedhands',
+                                 pc.add(changed['raisedhands'], 1))
+    put_parquet(s3_client, 'demo/ingestion/year=2023/month=09/day=17/xAPI-Edu-Data.parquet', changed)
+    run(q10, s3_client)
+    assert {key.rsplit('/', 1)[0] for key in read_keys if key.startswith(f'{fact_prefix}/')} == {
+        f'{fact_prefix}/year=2023/month=9/day=15'}
+    facts = read_output(s3_client, f'{fact_prefix}/')
+    assert facts.num_rows == sample.num_rows + 1
+    assert pc.sum(facts['current_version']).as_py() == sample.num_rows
+
+def test_dimension_keys_are_kept_and_an_unchanged_dimension_is_not_written(s3_client, monkeypatch):
+    q10 = load_script('question 10.py')
+    q10.bucket_name = bucket_name
+    writes = []
+    local_write_parquet = q10.local_write_parquet
+    monkeypatch.setattr(q10, 'local_write_parquet', lambda s3_client, bucket_name, file_key, data:
+                        writes.append(file_key) or local_write_parquet(s3_client, bucket_name, file_key, data))
+
+    assert q10.update_dimension(s3_client, 'Topic', ['Math', 'IT', None]) == {'IT': 1, 'Math': 2}
+    assert q10.update_dimension(s3_client, 'Topic', ['Math', 'IT']) == {'IT': 1, 'Math': 2}
+    assert writes == [q10.get_dimension_file_key('Topic')]
+    # a new value gets the next key, the others keep theirs
+    assert q10.update_dimension(s3_client, 'Topic', ['Arabic', 'Math']) == {'IT': 1, 'Math': 2, 'Arabic': 3}
+    assert q10.read_dimension(s3_client, 'Topic') == {'IT': 1, 'Math': 2, 'Arabic': 3}
+
+def test_a_changed_dimension_value_opens_a_new_version_and_an_unchanged_row_is_kept(s3_client, monkeypatch):
+    q10 = load_script('question 10.py')
+    q10.bucket_name = bucket_name
+    sample = pa_csv.read_csv(sample_path)
+    guids = q10.local_transformation_source_data_via_sql(sample)['fact_guid'].to_pylist()
+    sample = sample.take([guids.index(guid) for guid in dict.fromkeys(guids) if guids.count(guid) == 1][:20])
+    fact_prefix = q10.fact_destination_prefix_key
+
+    monkeypatch.setattr(q10, 'date', get_day(15))
+    put_parquet(s3_client, 'demo/ingestion/year=2023/month=09/day=15/xAPI-Edu-Data.parquet', sample)
+    run(q10, s3_client)
+    relations = q10.read_dimension(s3_client, 'Relation')
+
+    # the same rows again: nothing is written
+    monkeypatch.setattr(q10, 'date', get_day(16))
+    output_keys = read_output_keys(s3_client, f'{fact_prefix}/')
+    put_parquet(s3_client, 'demo/ingestion/year=2023/month=09/day=16/xAPI-Edu-Data.parquet', sample)
+    run(q10, s3_client)
+    assert read_output_keys(s3_client, f'{fact_prefix}/') == output_keys
+
+    # the Relation of the first row changes: its current row is expired and a new version is added
+    monkeypatch.setattr(q10, 'date', get_day(17))
+    changed = sample.slice(0, 2)
+    relation = 'Mum' if changed['Relation'][0].as_py() == 'Father' else 'Father'
+    changed = changed.set_column(changed.column_names.index('Relation'), 'Relation',
+                                 pa.array([relation, changed['Relation'][1].as_py()]))
+    put_parquet(s3_client, 'demo/ingestion/year=2023/month=09/day=17/xAPI-Edu-Data.parquet', changed)
+    run(q10, s3_client)
+
+    facts = read_output(s3_client, f'{fact_prefix}/').to_pylist()
+    assert len(facts) == sample.num_rows + 1
+    guid = q10.local_transformation_source_data_via_sql(changed)['fact_guid'][0].as_py()
+    versions = sorted((row for row in facts if row['fact_guid'] == guid), key=lambda row: row['current_version'])
+    assert [(row['current_version'], row['expired_date_time'], row['Relation_key']) for row in versions] == [
+        (False, date(2023, 9, 17), relations[sample['Relation'][0].as_py()]), (True, None, relations[relation])]
+    # the unchanged row of the batch keeps its one current version
+    unchanged_guid = q10.local_transformation_source_data_via_sql(changed)['fact_guid'][1].as_py()
+    assert [(row['current_version'], row['expired_date_time']) for row in facts
+            if row['fact_guid'] == unchanged_guid] == [(True, None)]
+
+# a local spark session, the test is skipped without pyspark or without a java runtime
+@pytest.fixture(scope='module')
+def spark():
+    pyspark_sql = pytest.importorskip('pyspark.sql')
+    try:
+        spark = pyspark_sql.SparkSession.builder.master('local[1]').config('spark.ui.enabled', 'false').getOrCreate()
+    except Exception as e:
+        pytest.skip(f'spark cannot start: {e}')
+    yield spark
+    spark.stop()
+
+def test_spark_and_local_plans_give_the_same_outputs(s3_client, spark):
+    q10 = load_script('question 10.py')
+    q10.bucket_name = bucket_name
+    file_key = 'demo/ingestion/year=2023/month=09/day=15/xAPI-Edu-Data.parquet'
+    put_parquet(s3_client, file_key, pa_csv.read_csv(sample_path))
+    # the spark backend reads the same rows as the local one, with the id of their source file
+    source_data = q10.local_read_parquet(s3_client, bucket_name, [file_key])
+    spark_source_data = spark.createDataFrame(source_data.to_pandas())
+
+    plan = q10.get_transformation_plan(s3_client, spark)
+    assert list(plan) == ['filtered', 'fact']
+    for name, (spark_transformation, local_transformation, _, _, _) in plan.items():
+        local_rows = local_transformation(source_data).to_pylist()
+        spark_rows = [row.asDict() for row in spark_transformation(spark_source_data).collect()]
+        assert local_rows, name
+        # the spark join puts the dimension keys after the other columns
+        assert (sorted(local_rows, key=lambda row: str(sorted(row.items())))
+                == sorted(spark_rows, key=lambda row: str(sorted(row.items())))), name
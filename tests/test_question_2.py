@@ -0,0 +1,254 @@
+import gzip
+import pytest
+import redshift_connector
+from conftest import bucket_name, sample_path, load_script
+
+
+@pytest.fixture
+def q2(s3_client, monkeypatch):
+    q2 = load_script('question 2.py')
+    monkeypatch.setattr(q2, 'region_name', 'us-east-1')
+    return q2
+
+def get_event(file_key, size=None, etag=None):
+    s3_object = {'key': file_key}
+    if size is not None:
+        s3_object.update(size=size, eTag=etag)
+    return {'Records': [{'s3': {'bucket': {'name': bucket_name}, 'object': s3_object}}]}
+
+def test_non_batch_mode_splits_by_the_object_size(q2, s3_client, monkeypatch):
+    file_key = 'demo/ingestion/year=2023/month=09/day=15/xAPI-Edu-Data.csv'
+    data = open(sample_path, 'rb').read()
+    s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=data)
+    monkeypatch.setattr(q2, 'batch_mode', False)
+    monkeypatch.setattr(q2, 'split_min_part_bytes', 8 * 1024)
+    loaded = []
+    monkeypatch.setattr(q2, 'load_batch', lambda s3_client, batch_files, *args: loaded.append(batch_files))
+
+    q2.lambda_handler(get_event(file_key), None)
+    assert loaded == [[(bucket_name, file_key, len(data))]]
+
+    parts = q2.split_object(s3_client, bucket_name, file_key, len(data), 4, 'GZIP')
+    assert len(parts) == 4
+    lines = []
+    for part_key, _ in parts:
+        part_lines = gzip.decompress(s3_client.get_object(Bucket=bucket_name, Key=part_key)['Body'].read()).splitlines()
+        lines.extend(part_lines[1:])
+    assert lines == data.splitlines()[1:]
+
+def test_timestamps_are_validated_like_the_copy_timeformat_auto(q2):
+    import pyarrow as pa
+    values = pa.array(['2023-09-15 12:00:00', '2023-09-15 12:00:00.123456', '2023-09-15T12:00:00Z',
+                       '2023-09-15 12:00:00+08:00', '2023-09-15 12:00', '2023/09/15 12:00:00', '2023-09-15',
+                       'Sep 15 2023 12:00:00', '2023-13-01 12:00:00', '12:00:00', 'yesterday'])
+    assert q2.valid_type_mask(values, 'timestamp without time zone').to_pylist() == [True] * 8 + [False] * 3
+
+# answers the schema and slice count queries of validate_batch_files
+class SchemaCursor:
+    def __init__(self, schema, slices):
+        self.schema = schema
+        self.slices = slices
+        self.rows = []
+
+    def execute(self, query):
+        self.rows = [(self.slices,)] if 'stv_slices' in query else list(self.schema)
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+def test_validation_splits_the_valid_files_from_the_same_read(q2, s3_client, monkeypatch):
+    data = open(sample_path, 'rb').read()
+    header = data.split(b'\n', 1)[0].decode().split(',')
+    schema = [(name, 'integer' if name in ('raisedhands', 'VisITedResources', 'AnnouncementsView', 'Discussion')
+               else 'character varying', 'NO', 64) for name in header]
+    valid_key = 'demo/ingestion/year=2023/month=09/day=15/valid.csv'
+    invalid_key = 'demo/ingestion/year=2023/month=09/day=15/invalid.csv'
+    s3_client.put_object(Bucket=bucket_name, Key=valid_key, Body=data)
+    s3_client.put_object(Bucket=bucket_name, Key=invalid_key, Body=data.replace(b',15,', b',x15,', 1))
+    monkeypatch.setattr(q2, 'split_min_part_bytes', 8 * 1024)
+    reads = []
+    get_object = s3_client.get_object
+    monkeypatch.setattr(s3_client, 'get_object', lambda **kwargs: reads.append(kwargs) or get_object(**kwargs))
+
+    batch_files = [(bucket_name, valid_key, len(data)), (bucket_name, invalid_key, len(data))]
+    valid_files, split_files = q2.validate_batch_files(s3_client, SchemaCursor(schema, 2), batch_files)
+    assert valid_files == batch_files[:1]
+    assert [kwargs['Key'] for kwargs in reads if 'Range' not in kwargs] == [valid_key, invalid_key]
+
+    parts = split_files[(bucket_name, valid_key)]
+    assert len(parts) == 2
+    lines = []
+    for part_key, _ in parts:
+        lines.extend(gzip.decompress(get_object(Bucket=bucket_name, Key=part_key)['Body'].read()).splitlines()[1:])
+    assert lines == data.splitlines()[1:]
+    split_keys = [obj['Key'] for obj in s3_client.list_objects_v2(Bucket=bucket_name, Prefix='demo/split/')['Contents']]
+    assert sorted(split_keys) == sorted(part_key for part_key, _ in parts)
+
+    load_files = q2.get_load_files(s3_client, None, valid_files, split_files)
+    assert [(file_key, size) for _, file_key, size, _ in load_files] == parts
+
+def test_failed_batch_is_loaded_again_with_the_next_batch(q2, s3_client, monkeypatch):
+    file_keys = [f'demo/ingestion/year=2023/month=09/day=15/xAPI-Edu-Data-{number}.csv' for number in range(3)]
+    for file_key in file_keys:
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=b'a,b\n1,2\n')
+    monkeypatch.setattr(q2, 'batch_queue', q2.LocalBatchQueue(2, 1024 * 1024, 3600))
+    loads = []
+    monkeypatch.setattr(q2, 'load_batch', lambda s3_client, batch_files, *args:
+                        loads.append(batch_files) or (list(batch_files) if len(loads) == 1 else []))
+
+    q2.lambda_handler(get_event(file_keys[0]), None)
+    q2.lambda_handler(get_event(file_keys[1]), None)
+    assert [file_key for _, file_key, _ in loads[0]] == file_keys[:2]
+    # the failed files are back in the queue and make the next batch ready
+    q2.lambda_handler(get_event(file_keys[2]), None)
+    assert [file_key for _, file_key, _ in loads[1]] == file_keys
+    assert q2.batch_queue.files == [] and q2.batch_queue.attempts == {}
+
+def test_missing_files_are_dropped_and_a_failing_file_goes_to_dead_letter(q2, s3_client, monkeypatch):
+    good_key, bad_key, archived_key = [f'demo/ingestion/year=2023/month=09/day=15/{name}.csv'
+                                       for name in ('good', 'bad', 'archived')]
+    for file_key in (good_key, bad_key):
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=b'a,b\n1,2\n')
+    monkeypatch.setattr(q2, 'batch_queue', q2.LocalBatchQueue(2, 1024 * 1024, 3600, max_attempts=2))
+    loads = []
+
+    # bad_key always fails, good_key is loaded and archived by the batch it is in
+    def load_batch(s3_client, batch_files, *args):
+        loads.append([file_key for _, file_key, _ in batch_files])
+        for file_bucket, file_key, _ in batch_files:
+            if file_key == good_key:
+                q2.archive_objects(s3_client, file_bucket, [(file_key, q2.get_archive_file_key(file_key))])
+        return q2.get_unloaded_files(s3_client, [file for file in batch_files if file[1] == bad_key])
+    monkeypatch.setattr(q2, 'load_batch', load_batch)
+
+    # an event delivered again for an archived file does not reach the batch
+    q2.lambda_handler(get_event(archived_key), None)
+    q2.lambda_handler(get_event(bad_key), None)
+    q2.lambda_handler(get_event(good_key), None)
+    assert loads == [[bad_key, good_key]]
+    assert [file_key for _, file_key, _ in q2.batch_queue.files] == [bad_key]
+
+    # the good file was archived, its event delivered again is dropped and only the bad file is tried
+    q2.lambda_handler(get_event(good_key), None)
+    q2.batch_queue.max_files = 1
+    q2.lambda_handler(get_event(archived_key), None)
+    assert loads[1] == [bad_key]
+    assert q2.batch_queue.files == []
+    keys = [obj['Key'] for obj in s3_client.list_objects_v2(Bucket=bucket_name, Prefix='demo/')['Contents']]
+    assert sorted(keys) == sorted([q2.get_archive_file_key(good_key), q2.get_dead_letter_file_key(bad_key)])
+
+def test_a_failed_connect_keeps_the_batch_in_the_queue(q2, s3_client, monkeypatch):
+    file_key = 'demo/ingestion/year=2023/month=09/day=15/xAPI-Edu-Data.csv'
+    s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=b'a,b\n1,2\n')
+    monkeypatch.setattr(q2, 'batch_queue', q2.LocalBatchQueue(1, 1024 * 1024, 3600))
+
+    def connect():
+        raise OSError('connection refused')
+    monkeypatch.setattr(q2, 'redshift_connection', q2.RedshiftConnectionManager(connect, 60, 3600))
+
+    q2.lambda_handler(get_event(file_key), None)
+    assert q2.batch_queue.files == [(bucket_name, file_key, 8)]
+
+class DeadCursor:
+    def execute(self, query):
+        raise redshift_connector.InterfaceError('connection closed by the server')
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self.cursor_class = cursor
+        self.closed = False
+
+    def cursor(self):
+        return self.cursor_class()
+
+    def close(self):
+        self.closed = True
+
+def test_a_dead_connection_is_replaced_once(q2):
+    connections = [FakeConnection(DeadCursor), FakeConnection(lambda: SchemaCursor([], 1))]
+    opened = iter(connections)
+    manager = q2.RedshiftConnectionManager(lambda: next(opened), 60, 3600)
+    manager.get()
+
+    conn, cur = q2.open_cursor(manager, lambda cur: cur.execute('SELECT 1'))
+    assert conn is connections[1] and connections[0].closed
+    assert manager.connect_count == 2
+
+    # a connection which fails again after the reconnect is not retried further
+    dead = iter([FakeConnection(DeadCursor), FakeConnection(DeadCursor), connections[1]])
+    manager = q2.RedshiftConnectionManager(lambda: next(dead), 60, 3600)
+    with pytest.raises(redshift_connector.InterfaceError):
+        q2.open_cursor(manager, lambda cur: cur.execute('SELECT 1'))
+    assert manager.conn is None and manager.connect_count == 2
+
+def test_a_file_of_one_part_is_loaded_as_it_is(q2, s3_client, monkeypatch):
+    small_key = 'demo/ingestion/year=2023/month=09/day=15/small.csv'
+    large_key = 'demo/ingestion/year=2023/month=09/day=15/large.csv'
+    data = open(sample_path, 'rb').read()
+    s3_client.put_object(Bucket=bucket_name, Key=small_key, Body=b'a,b\n1,2\n')
+    s3_client.put_object(Bucket=bucket_name, Key=large_key, Body=data)
+    monkeypatch.setattr(q2, 'split_min_part_bytes', 8 * 1024)
+
+    # the slice count is not even asked for a batch of small files
+    load_files = q2.get_load_files(s3_client, None, [(bucket_name, small_key, 8)])
+    assert load_files == [(bucket_name, small_key, 8, f's3://{bucket_name}/{small_key}')]
+    assert 'Contents' not in s3_client.list_objects_v2(Bucket=bucket_name, Prefix='demo/split/')
+
+    load_files = q2.get_load_files(s3_client, SchemaCursor([], 2), [(bucket_name, small_key, 8),
+                                                                    (bucket_name, large_key, len(data))])
+    groups = q2.get_copy_groups(load_files)
+    assert [file_key for _, file_key, _, _ in groups['']] == [small_key]
+    assert len(groups['GZIP']) == 2
+    assert {source_url for _, _, _, source_url in groups['GZIP']} == {f's3://{bucket_name}/{large_key}'}
+    q2.remove_split_parts(s3_client, load_files)
+    keys = [obj['Key'] for obj in s3_client.list_objects_v2(Bucket=bucket_name, Prefix='demo/')['Contents']]
+    assert sorted(keys) == sorted([small_key, large_key])
+
+def test_the_size_comes_from_the_event_unless_the_object_was_overwritten(q2, s3_client, monkeypatch):
+    file_key = 'demo/ingestion/year=2023/month=09/day=15/xAPI-Edu-Data.csv'
+    etag = s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=b'a,b\n1,2\n')['ETag'].strip('"')
+    monkeypatch.setattr(q2, 'batch_mode', False)
+    loaded = []
+    monkeypatch.setattr(q2, 'load_batch', lambda s3_client, batch_files, *args: loaded.append(batch_files))
+
+    q2.lambda_handler(get_event(file_key, 1000, etag), None)
+    # the event was sent for an older version of the object, the size of the HEAD is used
+    q2.lambda_handler(get_event(file_key, 1000, 'older-etag'), None)
+    assert loaded == [[(bucket_name, file_key, 1000)], [(bucket_name, file_key, 8)]]
+
+def test_backfill_resumes_from_the_partitions_left_in_the_checkpoint(q2, s3_client, monkeypatch, tmp_path):
+    prefixes = [f'demo/ingestion/year=2023/month=09/day={day}/' for day in (15, 16, 17)]
+    for prefix in prefixes:
+        s3_client.put_object(Bucket=bucket_name, Key=f'{prefix}xAPI-Edu-Data.csv', Body=b'a,b\n1,2\n')
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    monkeypatch.setattr(q2, 'connect_redshift', lambda: FakeConnection(lambda: SchemaCursor([], 1)))
+    monkeypatch.setattr(q2, 'get_loaded_files', lambda cursor, table_rs: set())
+    loaded = []
+    failing = {prefixes[1]}
+
+    def load_batch(s3_client, batch_files, *args):
+        prefix = batch_files[0][1].rpartition('/')[0] + '/'
+        loaded.append(prefix)
+        return batch_files if prefix in failing else []
+    monkeypatch.setattr(q2, 'load_batch', load_batch)
+
+    # the failed partition is left out of the checkpoint
+    assert q2.backfill(bucket_name, q2.date(2023, 9, 15), q2.date(2023, 9, 17), 2, checkpoint_path) == [prefixes[1]]
+    assert sorted(loaded) == prefixes
+    assert sorted(q2.read_checkpoint(checkpoint_path)['completed_partitions']) == [prefixes[0], prefixes[2]]
+
+    # the next run only loads the partition left
+    loaded.clear()
+    failing.clear()
+    assert q2.backfill(bucket_name, q2.date(2023, 9, 15), q2.date(2023, 9, 17), 2, checkpoint_path) == []
+    assert loaded == [prefixes[1]]
+    assert sorted(q2.read_checkpoint(checkpoint_path)['completed_partitions']) == prefixes
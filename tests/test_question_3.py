@@ -0,0 +1,175 @@
+import io
+import json
+import threading
+import pytest
+import pyarrow.parquet as pq
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from conftest import bucket_name, load_script
+
+
+q3 = load_script('question 3.py')
+
+
+def get_item(hour, minute):
+    return {'timestamp': f'2023-09-15T{hour:02d}:{minute:02d}:00+08:00', 'update_timestamp': None,
+            'readings': {'pm25_one_hourly': {'west': hour, 'east': minute, 'central': 1, 'south': 2, 'north': 3}}}
+
+def get_writer(s3_client):
+    return q3.PartitionedParquetWriter(s3_client, bucket_name, 'demo/ingestion/pm25', q3.item_schema, 10,
+                                       '2023-09-15T12:00:00', max_writers=2)
+
+def list_parquet(s3_client):
+    return sorted(obj['Key'] for obj in s3_client.list_objects_v2(Bucket=bucket_name).get('Contents', [])
+                  if obj['Key'].endswith('.parquet'))
+
+def test_partitioned_writer_closes_the_least_recently_used_file(s3_client):
+    writer = get_writer(s3_client)
+    # three partitions interleaved with two writers open at most
+    for minute in range(4):
+        for hour in (1, 2, 3):
+            writer.add(get_item(hour, minute), 0)
+            assert len(writer.writers) <= 2
+    files = writer.close()
+
+    assert sorted(files) == list_parquet(s3_client)
+    assert sum(stats['rows'] for stats in files.values()) == 12
+    for file_key, stats in files.items():
+        table = pq.read_table(io.BytesIO(s3_client.get_object(Bucket=bucket_name, Key=file_key)['Body'].read()))
+        assert table.num_rows == stats['rows']
+        assert stats['partition'] in file_key
+    partitions = {stats['partition'] for stats in files.values()}
+    assert partitions == {f'year=2023/month=09/day=15/hour={hour:02d}' for hour in (1, 2, 3)}
+    # every reopened partition gets a file of its own
+    assert len(files) > len(partitions)
+
+def test_partitioned_writer_drops_the_closed_files_of_an_aborted_group(s3_client):
+    writer = get_writer(s3_client)
+    for hour in (1, 2, 3):
+        writer.add(get_item(hour, 0), 'dropped')
+    writer.add(get_item(4, 0), 'kept')
+    writer.abort_group('dropped')
+    files = writer.close()
+
+    assert list(files) == list_parquet(s3_client)
+    assert [stats['partition'] for stats in files.values()] == ['year=2023/month=09/day=15/hour=04']
+
+# pm25 API stand-in: every date_time gets items_per_window items 18 minutes apart, the date_times of unhealthy get
+# an unhealthy api_info status
+class StubAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    items_per_window = 3
+    unhealthy = set()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        date_time = parse_qs(urlparse(self.path).query)['date_time'][0]
+        start = datetime.fromisoformat(date_time)
+        items = [{'timestamp': f'{start + timedelta(minutes=18 * number):%Y-%m-%dT%H:%M:%S}+08:00',
+                  'update_timestamp': f'{date_time}+08:00',
+                  'readings': {'pm25_one_hourly': {'west': number, 'east': 1, 'central': 2, 'south': 3, 'north': 4}}}
+                 for number in range(self.items_per_window)]
+        status = 'unhealthy' if date_time in self.unhealthy else 'healthy'
+        body = json.dumps({'items': items, 'api_info': {'status': status}}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+@pytest.fixture
+def api_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubAPIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/v1/environment/pm25'
+    server.shutdown()
+
+def test_extract_items_writes_off_the_event_loop(api_url):
+    threads = []
+    windows = q3.get_date_time_windows(datetime(2023, 9, 1), datetime(2023, 9, 1, 2))
+    done = []
+    q3.extract_items(api_url, windows, lambda index, item: threads.append(threading.current_thread()),
+                     on_window=lambda index, status, validators, item_count: done.append((index, status, item_count)))
+    assert len(threads) == 9 and threading.main_thread() not in threads
+    assert sorted(done) == [(0, 200, 3), (1, 200, 3), (2, 200, 3)]
+
+def test_unhealthy_window_is_skipped_and_the_others_are_written(s3_client, api_url, monkeypatch):
+    monkeypatch.setattr(q3, 'URL', api_url)
+    monkeypatch.setattr(q3, 'region_name', 'us-east-1')
+    monkeypatch.setattr(StubAPIHandler, 'unhealthy', {'2023-09-01T01:00:00'})
+    event = {'Records': [{'s3': {'bucket': {'name': bucket_name}}}],
+             'start_date_time': '2023-09-01T00:00:00', 'end_date_time': '2023-09-01T02:00:00'}
+    q3.lambda_handler(event, None)
+
+    manifest = q3.read_manifest(s3_client, bucket_name, q3.get_manifest_key(q3.key_prefix))
+    assert sum(entry['rows'] for entry in manifest['partitions'].values()) == 6
+    tables = [pq.read_table(io.BytesIO(s3_client.get_object(Bucket=bucket_name, Key=file_key)['Body'].read()))
+              for file_key in list_parquet(s3_client)]
+    timestamps = [timestamp for table in tables for timestamp in table['timestamp'].to_pylist()]
+    assert len(timestamps) == 6 and not [timestamp for timestamp in timestamps if timestamp.startswith('2023-09-01T01:')]
+    # the unhealthy window is fetched again by the next run
+    state = json.loads(s3_client.get_object(Bucket=bucket_name, Key=q3.fetch_state_key)['Body'].read())
+    assert len(state) == 2
+
+def test_unchanged_window_is_neither_transformed_nor_uploaded(s3_client, api_url, monkeypatch):
+    monkeypatch.setattr(q3, 'URL', api_url)
+    monkeypatch.setattr(q3, 'region_name', 'us-east-1')
+    event = {'Records': [{'s3': {'bucket': {'name': bucket_name}}}],
+             'start_date_time': '2023-09-01T00:00:00', 'end_date_time': '2023-09-01T01:00:00'}
+    q3.lambda_handler(event, None)
+    files = list_parquet(s3_client)
+    assert files
+
+    # the stub sends no validators, the second run only knows the windows are unchanged by their hash. A row group of
+    # one row would transform and write every item as soon as it reaches a writer
+    transformed = []
+    sinks = []
+    transformation_function = q3.transformation_function
+    S3MultipartWriter = q3.S3MultipartWriter
+    monkeypatch.setattr(q3, 'parquet_row_group_size', 1)
+    monkeypatch.setattr(q3, 'transformation_function', lambda df: transformed.append(df) or transformation_function(df))
+    monkeypatch.setattr(q3, 'S3MultipartWriter',
+                        lambda *args, **kwargs: sinks.append(args) or S3MultipartWriter(*args, **kwargs))
+    q3.lambda_handler(event, None)
+
+    assert transformed == []
+    assert sinks == []
+    assert list_parquet(s3_client) == files
+
+def read_rows(s3_client, file_keys):
+    return [row for file_key in file_keys for row in pq.read_table(io.BytesIO(
+        s3_client.get_object(Bucket=bucket_name, Key=file_key)['Body'].read())).to_pylist()]
+
+def test_compaction_keeps_the_rows_and_the_partitions(s3_client, monkeypatch):
+    monkeypatch.setattr(q3, 'region_name', 'us-east-1')
+    writer = q3.PartitionedParquetWriter(s3_client, bucket_name, q3.key_prefix, q3.item_schema, 10,
+                                         '2023-09-15T12:00:00', max_writers=2)
+    # three partitions interleaved with two writers open at most, every partition gets several small files
+    for minute in reversed(range(6)):
+        for hour in (1, 2, 3):
+            writer.add(get_item(hour, minute), 0)
+    files = writer.close()
+    manifest_key = q3.get_manifest_key(q3.key_prefix)
+    q3.update_manifest(s3_client, bucket_name, manifest_key, files)
+    before = q3.read_manifest(s3_client, bucket_name, manifest_key)['partitions']
+    rows = read_rows(s3_client, list_parquet(s3_client))
+    assert all(len(entry['files']) > 1 for entry in before.values())
+
+    compacted = q3.compact(bucket_name)
+
+    after = q3.read_manifest(s3_client, bucket_name, manifest_key)['partitions']
+    assert set(after) == set(before)
+    assert {partition: entry['rows'] for partition, entry in after.items()} == {
+        partition: entry['rows'] for partition, entry in before.items()}
+    # one sorted file per partition replaces the sources, which are deleted
+    assert len(compacted) == len(before)
+    assert list_parquet(s3_client) == sorted(compacted)
+    assert sorted(read_rows(s3_client, compacted), key=str) == sorted(rows, key=str)
+    for file_key, stats in compacted.items():
+        assert list(after[stats['partition']]['files']) == [file_key]
+        timestamps = [row['timestamp'] for row in read_rows(s3_client, [file_key])]
+        assert timestamps == sorted(timestamps) and len(timestamps) == stats['rows'] == 6
+        assert stats['partition'] in file_key
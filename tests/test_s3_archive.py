@@ -0,0 +1,80 @@
+import os
+import pytest
+import s3_archive
+from conftest import bucket_name
+
+
+source_key = 'demo/ingestion/a.csv'
+destination_key = 'demo/archive/a.csv'
+
+# records the requests sent to S3 in order, with the key they were sent for
+@pytest.fixture
+def calls(s3_client, monkeypatch):
+    calls = []
+    for name in ('copy_object', 'upload_part_copy', 'complete_multipart_upload', 'abort_multipart_upload', 'head_object',
+                 'delete_objects'):
+        method = getattr(s3_client, name)
+
+        def call(*args, method=method, name=name, **kwargs):
+            calls.append((name, kwargs.get('Key')))
+            return method(*args, **kwargs)
+        monkeypatch.setattr(s3_client, name, call)
+    return calls
+
+def list_keys(s3_client):
+    return sorted(obj['Key'] for obj in s3_client.list_objects_v2(Bucket=bucket_name).get('Contents', []))
+
+def test_the_source_is_deleted_after_the_copy_is_verified(s3_client, calls):
+    s3_client.put_object(Bucket=bucket_name, Key=source_key, Body=b'a,b\n1,2\n')
+    assert s3_archive.archive_objects(s3_client, bucket_name, [(source_key, destination_key)]) == [source_key]
+
+    assert list_keys(s3_client) == [destination_key]
+    assert calls == [('head_object', source_key), ('copy_object', destination_key),
+                     ('head_object', destination_key), ('delete_objects', None)]
+
+def test_the_source_is_kept_when_the_copy_is_not_verified(s3_client, calls, monkeypatch):
+    s3_client.put_object(Bucket=bucket_name, Key=source_key, Body=b'a,b\n1,2\n')
+    monkeypatch.setattr(s3_archive, 'verify_copy', lambda *args: False)
+    assert s3_archive.archive_objects(s3_client, bucket_name, [(source_key, destination_key)]) == []
+
+    assert source_key in list_keys(s3_client)
+    assert ('delete_objects', None) not in calls
+
+def test_the_source_is_kept_when_the_copy_fails(s3_client, calls):
+    s3_client.put_object(Bucket=bucket_name, Key=source_key, Body=b'a,b\n1,2\n')
+    moves = [(source_key, destination_key), ('demo/ingestion/missing.csv', 'demo/archive/missing.csv')]
+    assert s3_archive.archive_objects(s3_client, bucket_name, moves) == [source_key]
+    assert list_keys(s3_client) == [destination_key]
+
+# moto needs parts of 5 MB but the last one, a 6 MB object is copied in two parts
+@pytest.fixture
+def multipart(monkeypatch):
+    monkeypatch.setattr(s3_archive, 'multipart_threshold', 1024)
+    monkeypatch.setattr(s3_archive, 'part_size', 5 * 1024 * 1024)
+    return os.urandom(6 * 1024 * 1024)
+
+def test_a_multipart_copy_is_verified_before_the_delete(s3_client, calls, multipart):
+    s3_client.put_object(Bucket=bucket_name, Key=source_key, Body=multipart)
+    assert s3_archive.move_object(s3_client, bucket_name, source_key, destination_key)
+
+    assert list_keys(s3_client) == [destination_key]
+    assert s3_client.get_object(Bucket=bucket_name, Key=destination_key)['Body'].read() == multipart
+    names = [name for name, _ in calls]
+    assert names.count('upload_part_copy') == 2
+    assert names.index('delete_objects') > names.index('complete_multipart_upload')
+    assert names.index('delete_objects') > names.index('head_object', names.index('complete_multipart_upload'))
+
+def test_a_failed_part_copy_aborts_the_upload_and_keeps_the_source(s3_client, calls, multipart, monkeypatch):
+    s3_client.put_object(Bucket=bucket_name, Key=source_key, Body=multipart)
+    upload_part_copy = s3_client.upload_part_copy
+
+    def failing_upload_part_copy(**kwargs):
+        if kwargs['PartNumber'] == 2:
+            raise OSError('connection reset')
+        return upload_part_copy(**kwargs)
+    monkeypatch.setattr(s3_client, 'upload_part_copy', failing_upload_part_copy)
+    assert not s3_archive.move_object(s3_client, bucket_name, source_key, destination_key)
+
+    assert list_keys(s3_client) == [source_key]
+    assert [name for name, _ in calls if name in ('abort_multipart_upload', 'delete_objects')] == ['abort_multipart_upload']
+    assert not s3_client.list_multipart_uploads(Bucket=bucket_name).get('Uploads')
@@ -0,0 +1,59 @@
+import pytest
+import s3_metadata
+from conftest import bucket_name
+
+
+# counts the requests sent to S3 by name
+@pytest.fixture
+def calls(s3_client, monkeypatch):
+    calls = []
+    for name in ('head_object', 'head_bucket', 'get_paginator'):
+        method = getattr(s3_client, name)
+        monkeypatch.setattr(s3_client, name,
+                            lambda *args, method=method, name=name, **kwargs: calls.append(name) or method(*args, **kwargs))
+    return calls
+
+def test_object_metadata_is_cached_until_the_ttl_expires(s3_client, calls, monkeypatch):
+    s3_client.put_object(Bucket=bucket_name, Key='a.csv', Body=b'abc')
+    now = [1000.0]
+    monkeypatch.setattr(s3_metadata.time, 'monotonic', lambda: now[0])
+
+    first = s3_metadata.get_object_metadata(s3_client, bucket_name, 'a.csv')
+    assert s3_metadata.get_object_metadata(s3_client, bucket_name, 'a.csv') == first
+    assert first['ContentLength'] == 3 and calls == ['head_object']
+
+    now[0] += s3_metadata.cache_ttl_seconds + 1
+    s3_metadata.get_object_metadata(s3_client, bucket_name, 'a.csv')
+    assert calls == ['head_object'] * 2
+
+def test_a_missing_object_is_not_cached(s3_client, calls):
+    assert s3_metadata.get_object_metadata(s3_client, bucket_name, 'a.csv') is None
+    s3_client.put_object(Bucket=bucket_name, Key='a.csv', Body=b'abc')
+    assert s3_metadata.get_object_metadata(s3_client, bucket_name, 'a.csv')['ContentLength'] == 3
+    assert not s3_metadata.bucket_exist(s3_client, 'missing-bucket')
+    assert not s3_metadata.bucket_exist(s3_client, 'missing-bucket')
+    assert calls == ['head_object', 'head_object', 'head_bucket', 'head_bucket']
+
+def test_file_exist_always_sends_the_head(s3_client, calls):
+    s3_client.put_object(Bucket=bucket_name, Key='a.csv', Body=b'abc')
+    assert s3_metadata.get_object_metadata(s3_client, bucket_name, 'a.csv')
+    s3_client.delete_object(Bucket=bucket_name, Key='a.csv')
+    # the cached HEAD still says the file is there
+    assert s3_metadata.get_object_metadata(s3_client, bucket_name, 'a.csv')
+    assert not s3_metadata.file_exist(s3_client, bucket_name, 'a.csv')
+    assert calls == ['head_object', 'head_object']
+
+def test_list_keys_follows_the_pages_and_is_invalidated(s3_client, calls):
+    file_keys = sorted(f'prefix/{number:04d}.csv' for number in range(1005))
+    for file_key in file_keys:
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=b'')
+    s3_client.put_object(Bucket=bucket_name, Key='other/a.csv', Body=b'')
+
+    assert sorted(s3_metadata.list_keys(s3_client, bucket_name, 'prefix/')) == file_keys
+    assert len(s3_metadata.list_keys(s3_client, bucket_name, 'prefix/')) == 1005
+    assert calls == ['get_paginator']
+
+    s3_client.put_object(Bucket=bucket_name, Key='prefix/new.csv', Body=b'')
+    s3_metadata.invalidate(bucket_name, 'prefix/new.csv')
+    assert 'prefix/new.csv' in s3_metadata.list_keys(s3_client, bucket_name, 'prefix/')
+    assert calls == ['get_paginator'] * 2